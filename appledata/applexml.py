@@ -22,33 +22,89 @@
 #   2014-06-04: retrieve keywords from iPhoto database using sqlite
 #   2017-01-14: retrieve all necessary data entirely from Photos SQLite database
    
+import array
 import calendar
 import datetime
-import unicodedata
+import heapq
 import os
+import re
 import sys
 import sqlite3
+import threading
+import time
+import urllib
 
+import appledata.librarysnapshot as librarysnapshot
+import appledata.pathtable as pathtable
+import appledata.smartalbums as smartalbums
 import tilutil.systemutils as su
 
 
 APPLE_BASE = calendar.timegm((2001, 1, 1, 0, 0, 0, 0, 0, -1))
 APPLE_BASE2 = datetime.datetime.fromtimestamp(calendar.timegm((2001, 1, 1, 0, 0, 0)))
 
+_NAN = float('nan')
+
+# Number of rows fetched at a time when streaming query results.
+_FETCH_SIZE = 500
+
+# Compiled patterns used by the SQLite REGEXP function.
+_REGEXP_CACHE = {}
+
+# Dates converted by getappletime(), by Apple time stamp. Album dates and
+# images from the same import often share time stamps.
+_APPLE_TIME_CACHE = {}
+_APPLE_TIME_CACHE_SIZE = 50000
+
 
 def getappletime(value):
     '''Converts a numeric Apple time stamp into a date and time'''
+    date = _APPLE_TIME_CACHE.get(value)
+    if date is not None:
+        return date
     try:
         # datetime.datetime.fromtimestamp() takes only int, which limits it to 12/13/1901
         # as the earliest possible date. Use an alternate calculation for earlier dates.
         # This one however adjusts for daylight savings time, so summer times are off by an
         # hour from the time recorded in Photos.
         if APPLE_BASE + float(value) < -sys.maxint:
-            return APPLE_BASE2 + datetime.timedelta(seconds=float(value))
-        return datetime.datetime.fromtimestamp(APPLE_BASE + float(value))
+            date = APPLE_BASE2 + datetime.timedelta(seconds=float(value))
+        else:
+            date = datetime.datetime.fromtimestamp(APPLE_BASE + float(value))
     except (TypeError, ValueError) as _e:
         # bad time stamp in database, default to "now"
         return datetime.datetime.now()
+    if len(_APPLE_TIME_CACHE) >= _APPLE_TIME_CACHE_SIZE:
+        _APPLE_TIME_CACHE.clear()
+    _APPLE_TIME_CACHE[value] = date
+    return date
+
+
+def getapplestamp(date):
+    '''Converts a date and time into an Apple time stamp, the reverse of
+    getappletime().'''
+    return time.mktime(date.timetuple()) + date.microsecond / 1e6 - APPLE_BASE
+
+
+def appletimestamps(values):
+    '''Converts a sequence of Apple time stamps into an array of POSIX time
+    stamps, without building any datetime objects. Bad time stamps become NaN.
+
+    The result compares like the dates from getappletime(), so it can be used
+    to sort or select whole columns of dates cheaply.'''
+    stamps = array.array('d')
+    for value in values:
+        try:
+            stamps.append(APPLE_BASE + float(value))
+        except (TypeError, ValueError) as _e:
+            stamps.append(_NAN)
+    return stamps
+
+
+def getposixstamp(date):
+    '''Converts a date and time into a POSIX time stamp, comparable with the
+    results of appletimestamps().'''
+    return getapplestamp(date) + APPLE_BASE
 
 
 def get_photos_library_file(library_dir):
@@ -81,151 +137,857 @@ def get_photos_imageproxies_file(library_dir):
                       "library location.") % library_dir)
 
 
-def read_apple_library(photos_library_dir):
-    photos_dict = {}
+# Queries run against Library.apdb, with ImageProxies.apdb attached as "proxies"
+# and metaSchema.db attached as "meta".
+_VERSION_QUERY = 'select value from %s.LiGlobals where keyPath is ?'
+
+_FOLDER_QUERY = ('select uuid, modelId, name, folderPath from RKFolder '
+                 'where folderType = 1 and isInTrash = 0 and isMagic = 0')
+
+_ALBUM_WHERE = ('where a.albumType = 1 and a.albumSubclass = 3 '
+                'and a.isInTrash = 0 and a.isMagic = 0')
+
+_ALBUM_QUERY = ('select a.modelId, a.name, a.folderUuid, a.recentUserChangeDate, a.albumType, '
+                'av.versionId '
+                'from RKAlbum a left join RKAlbumVersion av on av.albumId = a.modelId ' +
+                _ALBUM_WHERE + ' %s order by a.modelId, av.rowid')
+
+# Album type of smart albums, which have no RKAlbumVersion rows. Their images
+# are selected by the conditions in filterData, see smartalbums.
+_SMART_ALBUM_TYPE = 2
+
+_SMART_ALBUM_QUERY = ('select a.modelId, a.name, a.folderUuid, a.recentUserChangeDate, '
+                      'a.albumType, a.filterData from RKAlbum a '
+                      'where a.albumType = 2 and a.isInTrash = 0 and a.isMagic = 0 '
+                      '%s order by a.modelId')
+
+_ALBUM_STAMP_QUERY = 'select a.modelId, a.recentUserChangeDate from RKAlbum a ' + _ALBUM_WHERE
+
+_MASTER_FROM = ('from RKMaster m '
+                'join RKVersion v on v.modelId = m.modelId and v.isInTrash = 0 ')
+
+_MASTER_WHERE = 'where m.importComplete = 1 and m.isInTrash = 0'
+
+_SMART_ALBUM_IMAGE_QUERY = ('select m.modelId ' + _MASTER_FROM + _MASTER_WHERE +
+                            ' and (%s) order by v.imageDate, m.modelId')
+
+_RESOURCE_WHERE = 'r.attachedModelType = 2 and r.resourceType = 4'
+
+_IMAGE_FROM = (_MASTER_FROM +
+               'left join proxies.RKModelResource r on r.attachedModelId = m.modelId '
+               'and ' + _RESOURCE_WHERE + ' ' + _MASTER_WHERE)
+
+# The last three columns tell if an image changed since the last load.
+_IMAGE_QUERY = ('select m.modelId, m.imagePath, v.name, v.imageDate, v.createDate, '
+                'r.resourceUuid, r.filename, '
+                'v.lastModifiedDate, m.fileModificationDate, r.resourceUuid ' +
+                _IMAGE_FROM + ' %s')
+
+_IMAGE_STAMP_QUERY = ('select m.modelId, v.lastModifiedDate, m.fileModificationDate, '
+                      'r.resourceUuid ' + _IMAGE_FROM)
+
+# The image query split in two, for reads of Library.apdb and ImageProxies.apdb
+# on separate connections.
+_MASTER_QUERY = ('select m.modelId, m.imagePath, v.name, v.imageDate, v.createDate, '
+                 'v.lastModifiedDate, m.fileModificationDate ' +
+                 _MASTER_FROM + _MASTER_WHERE)
+
+_RESOURCE_QUERY = ('select r.attachedModelId, r.resourceUuid, r.filename '
+                   'from RKModelResource r where ' + _RESOURCE_WHERE)
+
+_KEYWORD_QUERY = 'select modelId, name from RKKeyword'
+
+# One row per version, with the ids of all its keywords.
+_IMAGE_KEYWORD_QUERY = ('select versionId, group_concat(keywordId) '
+                        'from RKKeywordForVersion group by versionId')
+
+# One row per face of a named person, sorted by person.
+_FACE_QUERY = ('select p.modelId, p.name, f.imageModelId from RKPerson p '
+               'join RKFace f on f.personId = p.modelId '
+               "where p.name is not null and p.name != '' order by p.modelId")
+
+# Restricts images to the versions of the albums selected by a filter clause.
+_IMAGE_ALBUM_CLAUSE = ('and (m.modelId in (select av.versionId from RKAlbumVersion av '
+                       'join RKAlbum a on a.modelId = av.albumId ' + _ALBUM_WHERE + ' %s) '
+                       'or phoshare_smart_album_image(m.modelId))')
 
+# Maximum number of ids in one "in (...)" clause (SQLite allows 999 variables).
+_MAX_IDS = 500
+
+
+def _database_uri(database_file):
+    """Returns a read-only SQLite URI for a database file."""
+    if isinstance(database_file, unicode):
+        database_file = database_file.encode('utf-8')
+    return 'file:%s?mode=ro' % urllib.quote(database_file)
+
+
+def _connect_database(database_file):
+    """Opens a read-only connection to a single Photos database file."""
+    try:
+        conn = sqlite3.connect(_database_uri(database_file), uri=True)
+    except TypeError:
+        conn = sqlite3.connect(database_file)
+    conn.execute('pragma query_only = 1')
+    return conn
+
+
+def connect_photos_library(photos_library_dir):
+    """Opens a single read-only connection to the Photos databases.
+
+    Library.apdb is the main database, ImageProxies.apdb is attached as
+    "proxies" and metaSchema.db as "meta".
+    """
     photos_metaschema_file = get_photos_metaschema_file(photos_library_dir)
     photos_imageproxies_file = get_photos_imageproxies_file(photos_library_dir)
     photos_library_file = get_photos_library_file(photos_library_dir)
 
-    if photos_metaschema_file:
-        # Library Version
-        library_version = None
-        conn1 = sqlite3.connect(photos_metaschema_file)
-        c1 = conn1.cursor()
-        c1.execute('select value from LiGlobals where keyPath is ?', ("libraryCompatibleBackToVersion",))
-        for result in c1.fetchall():
-            library_version = int(result[0])
-        photos_dict['Application Version'] = library_version
-
-    if photos_imageproxies_file:
-        # Resources
-        conn3 = sqlite3.connect(photos_imageproxies_file)
-        c3 = conn3.cursor()
-        c3.execute('select attachedModelId, resourceUuid, filename from RKModelResource '
-                   'where attachedModelType = 2 and resourceType = 4')
-        resources_dict = {}
-        for result in c3.fetchall():
-            attached_model_id = int(result[0])
-            resource_dict = {}
-            resource_dict['resource_uuid'] = result[1]
-            resource_dict['filename'] = unicodedata.normalize("NFC", result[2])
-            resources_dict[attached_model_id] = resource_dict
-
-    if photos_metaschema_file:
-        # Folders
-        conn2 = sqlite3.connect(photos_library_file)
-        c2 = conn2.cursor()
-        c2.execute('select uuid, modelId, name, folderPath from RKFolder '
-                   'where folderType = 1 and isInTrash = 0 and isMagic = 0')
-        folders_by_id = {}
-        folders_by_uuid = {}
-        for result in c2.fetchall():
-            uuid = result[0]
-            model_id = int(result[1])
-            folder_dict = {}
-            folder_dict['name'] = result[2]
-            folder_dict['folderPath'] = result[3]
-            folders_by_uuid[uuid] = folder_dict
-            folders_by_id[model_id] = folder_dict
-
-        # Albums
-        c2 = conn2.cursor()
-        c2.execute('select modelId, name, folderUuid, recentUserChangeDate'
-                   ' from RKAlbum where albumType = 1 and albumSubclass = 3'
-                   ' and isInTrash = 0 and isMagic = 0')
-        albums = []
-        albums_by_id = {}
-        for result in c2.fetchall():
-            album_id = int(result[0])
-            album_data = {}
-            album_data['AlbumName'] = unicodedata.normalize("NFC", result[1])
-            album_data['AlbumDate'] = getappletime(result[3])
-            album_data['KeyList'] = []
-
-            # Load folder path
-            album_data['FolderPath'] = None
-            album_folder_uuid = result[2]
-            if album_folder_uuid in folders_by_uuid:
-                album_folder = folders_by_uuid[album_folder_uuid]
-                parent_folder_ids = album_folder['folderPath']
-                folder_path = ''
-                for folder_id in parent_folder_ids.split('/'):
-                    if folder_id and (int(folder_id) in folders_by_id):
-                        parent_folder = folders_by_id[int(folder_id)]
-                        folder_path = os.path.join(folder_path, parent_folder['name'])
-                album_data['FolderPath'] = folder_path
-
-            albums.append(album_data)
-            albums_by_id[album_id] = album_data
-        photos_dict['List of Albums'] = albums
-
-        # Versions
-        c2 = conn2.cursor()
-        c2.execute('select modelId, name, imageDate, createDate from RKVersion where isInTrash = 0')
-        versions_dict = {}
-        for result in c2.fetchall():
-            model_id = int(result[0])
-            version_dict = {}
-            version_name = None
-            if result[1]:
-                version_name = unicodedata.normalize("NFC", result[1])
-            version_dict['VersionName'] = version_name
-            if result[2]:
-                version_dict['VersionDate'] = getappletime(result[2])
-            else:
-                version_dict['VersionDate'] = getappletime(result[3])
-            versions_dict[model_id] = version_dict
-
-        # Masters
-        c2 = conn2.cursor()
-        c2.execute('select modelId, imagePath from RKMaster '
-                   'where importComplete = 1 and isInTrash = 0')
-        masters_dict = {}
-        for result in c2.fetchall():
-            model_id = int(result[0])
-            master_dict = {}
-            master_dict['ImagePath'] = unicodedata.normalize("NFC", result[1])
-            masters_dict[model_id] = master_dict
-
-        # Images
-        images = {}
-        for master_id in masters_dict:
-            image_data = {}
-
-            master_dict = masters_dict[master_id]
-            original_path = os.path.join(photos_library_dir, 'Masters', master_dict['ImagePath'])
-
-            if master_id in resources_dict:
-                resource_dict = resources_dict[master_id]
-                resource_uuid = resource_dict['resource_uuid']
-                folder1 = str(ord(resource_uuid[0]))
-                folder2 = str(ord(resource_uuid[1]))
-                filename = resource_dict['filename']
-                image_data['ImagePath'] = os.path.join(photos_library_dir, 'resources', 'modelresources',
-                                                       folder1, folder2, resource_uuid, filename)
-                image_data['OriginalPath'] = original_path
-            else:
-                image_data['ImagePath'] = original_path
-
-            version_dict = versions_dict[master_id]
-            image_data['Caption'] = version_dict['VersionName']
-            image_data['ImageDate'] = version_dict['VersionDate']
-            images[master_id] = image_data
-        photos_dict['Master Image List'] = images
-
-        # TODO Keywords
-        photos_dict['List of Keywords'] = []
-
-        # Album-Versions
-        c2 = conn2.cursor()
-        c2.execute('select albumId, versionId from RKAlbumVersion')
-        for result in c2.fetchall():
-            album_id = int(result[0])
-            version_id = int(result[1])
-
-            if album_id in albums_by_id:
-                album_data = albums_by_id[album_id]
-                album_data['KeyList'].append(version_id)
+    try:
+        conn = sqlite3.connect(_database_uri(photos_library_file), uri=True)
+        proxies_name = _database_uri(photos_imageproxies_file)
+        meta_name = _database_uri(photos_metaschema_file)
+    except TypeError:
+        # This sqlite3 module does not understand URIs, open the files directly.
+        conn = sqlite3.connect(photos_library_file)
+        proxies_name = photos_imageproxies_file
+        meta_name = photos_metaschema_file
+    # We never write to the library, make sure of it even without URI support.
+    conn.execute('pragma query_only = 1')
+    conn.execute('attach database ? as proxies', (proxies_name,))
+    conn.execute('attach database ? as meta', (meta_name,))
+    return conn
+
+
+# Tables read by the queries above, copied by copy_photos_library() from the
+# live database attached under the given name into the schema of the same name.
+_COPIED_TABLES = (('main', 'RKFolder'),
+                  ('main', 'RKAlbum'),
+                  ('main', 'RKAlbumVersion'),
+                  ('main', 'RKVersion'),
+                  ('main', 'RKMaster'),
+                  ('main', 'RKKeyword'),
+                  ('main', 'RKKeywordForVersion'),
+                  ('main', 'RKPerson'),
+                  ('main', 'RKFace'),
+                  ('proxies', 'RKModelResource'),
+                  ('meta', 'LiGlobals'))
+
+# Indexes for the joins of the queries above, which Photos does not define.
+_COPY_INDEXES = ('create index main.RKAlbumVersion_albumId on RKAlbumVersion (albumId)',
+                 'create index proxies.RKModelResource_attachedModelId '
+                 'on RKModelResource (attachedModelId)')
+
+_CREATE_TABLE_PATTERN = re.compile(r'^\s*create\s+table\s+', re.IGNORECASE)
+
+
+def copy_photos_library(photos_library_dir):
+    """Copies the Photos databases into a private in-memory snapshot.
+
+    The tables we read are copied in a single read transaction, so they are
+    consistent with each other and the live library is only read for as long
+    as the copy takes, even if Photos writes to it meanwhile. Returns a
+    read-only connection laid out like connect_photos_library()'s.
+    """
+    photos_metaschema_file = get_photos_metaschema_file(photos_library_dir)
+    photos_imageproxies_file = get_photos_imageproxies_file(photos_library_dir)
+    photos_library_file = get_photos_library_file(photos_library_dir)
+
+    try:
+        conn = sqlite3.connect('file::memory:', uri=True)
+        live_names = [_database_uri(photos_library_file),
+                      _database_uri(photos_imageproxies_file),
+                      _database_uri(photos_metaschema_file)]
+    except TypeError:
+        # No URI support, the live databases are only ever read below.
+        conn = sqlite3.connect(':memory:')
+        live_names = [photos_library_file, photos_imageproxies_file,
+                      photos_metaschema_file]
+    try:
+        # We issue the transaction statements ourselves, sqlite3 would commit
+        # before each "create table".
+        conn.isolation_level = None
+        conn.execute("attach database ':memory:' as proxies")
+        conn.execute("attach database ':memory:' as meta")
+        for live_name, schema in zip(live_names, ('main', 'proxies', 'meta')):
+            conn.execute('attach database ? as live_%s' % schema, (live_name,))
+
+        conn.execute('begin')
+        for schema, table in _COPIED_TABLES:
+            c = conn.cursor()
+            c.execute('select sql from live_%s.sqlite_master '
+                      'where type = ? and name = ?' % schema, ('table', table))
+            # Re-create the table with its declaration, to keep its primary key.
+            create_table = _CREATE_TABLE_PATTERN.sub('create table %s.' % schema,
+                                                     c.fetchone()[0], 1)
+            conn.execute(create_table)
+            conn.execute('insert into %s.%s select * from live_%s.%s' %
+                         (schema, table, schema, table))
+        conn.execute('commit')
+
+        for schema in ('main', 'proxies', 'meta'):
+            conn.execute('detach database live_%s' % schema)
+        for create_index in _COPY_INDEXES:
+            conn.execute(create_index)
+        conn.execute('pragma query_only = 1')
+    except:
+        conn.close()
+        raise
+    return conn
+
+
+def open_photos_library(photos_library_dir, in_memory=False):
+    """Returns a connection to the Photos databases: to a private in-memory
+    copy of them if in_memory is set (see copy_photos_library), or to the live
+    databases otherwise."""
+    if in_memory:
+        return copy_photos_library(photos_library_dir)
+    return connect_photos_library(photos_library_dir)
+
+
+def _iter_rows(cursor):
+    """Yields the rows of an executed cursor, fetching them in batches."""
+    while True:
+        rows = cursor.fetchmany(_FETCH_SIZE)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def _id_clause(column, ids):
+    """Returns an "and column in (...)" clause for a list of ids."""
+    return 'and %s in (%s)' % (column, ','.join(str(int(i)) for i in ids))
+
+
+def _chunks(ids):
+    """Splits a list of ids into lists of at most _MAX_IDS ids."""
+    for i in xrange(0, len(ids), _MAX_IDS):
+        yield ids[i:i + _MAX_IDS]
+
+
+def read_library_version(conn, schema='meta'):
+    """Returns the compatibility version of the Photos library, read from
+    metaSchema.db under the given schema name of conn."""
+    library_version = None
+    c = conn.cursor()
+    c.execute(_VERSION_QUERY % schema, ("libraryCompatibleBackToVersion",))
+    for result in c.fetchall():
+        library_version = int(result[0])
+    return library_version
+
+
+def _read_folder_rows(conn):
+    """Returns the rows of the folders of the library."""
+    c = conn.cursor()
+    c.execute(_FOLDER_QUERY)
+    return [tuple(result) for result in c.fetchall()]
+
+
+def _index_folders(folder_rows):
+    """Returns folder rows as folder dictionaries mapped by model id and by uuid.
+
+    The "ParentId" of a folder is the id of the closest folder above it in its
+    folderPath ("1/5/23/"), skipping the ones we did not read (the top level
+    folder, or folders in the trash), or None.
+    """
+    folders_by_id = {}
+    folders_by_uuid = {}
+    for result in folder_rows:
+        folder_dict = {}
+        folder_dict['FolderUuid'] = result[0]
+        folder_dict['FolderId'] = int(result[1])
+        folder_dict['FolderName'] = result[2]
+        folders_by_uuid[result[0]] = folder_dict
+        folders_by_id[folder_dict['FolderId']] = folder_dict
+    for result in folder_rows:
+        folder_dict = folders_by_uuid[result[0]]
+        folder_dict['ParentId'] = None
+        for folder_id in result[3].split('/'):
+            if not folder_id:
+                continue
+            folder_id = int(folder_id)
+            if folder_id == folder_dict['FolderId']:
+                break
+            if folder_id in folders_by_id:
+                folder_dict['ParentId'] = folder_id
+    return folders_by_id, folders_by_uuid
+
+
+def _folder_names(folder_dict, folders_by_id):
+    """Returns the names of the folders down to a folder, like ["a", "b", "c"]."""
+    folder_names = []
+    while folder_dict is not None:
+        folder_names.append(folder_dict['FolderName'])
+        folder_dict = folders_by_id.get(folder_dict['ParentId'])
+    folder_names.reverse()
+    return folder_names
+
+
+def _read_keywords(conn):
+    """Reads the keywords of the library in two scans.
+
+    Returns:
+      (keyword names mapped by keyword id, lists of keyword ids mapped by
+      image id).
+    """
+    keywords = {}
+    c = conn.cursor()
+    c.execute(_KEYWORD_QUERY)
+    for result in _iter_rows(c):
+        if result[1]:
+            keywords[int(result[0])] = su.nfc(result[1])
+
+    image_keywords = {}
+    c = conn.cursor()
+    c.execute(_IMAGE_KEYWORD_QUERY)
+    for result in _iter_rows(c):
+        if result[0] is not None and result[1]:
+            image_keywords[int(result[0])] = [int(keyword_id) for keyword_id
+                                              in str(result[1]).split(',')]
+    return keywords, image_keywords
+
+
+def _read_faces(conn):
+    """Reads the named persons of the library, and the images they are in, in
+    one scan.
+
+    Returns:
+      (person names mapped by person id, sets of image ids mapped by person id).
+    """
+    faces = {}
+    face_images = {}
+    c = conn.cursor()
+    c.execute(_FACE_QUERY)
+    image_ids = None
+    for result in _iter_rows(c):
+        person_id = int(result[0])
+        if person_id not in faces:
+            faces[person_id] = su.nfc(result[1])
+            image_ids = set()
+            face_images[person_id] = image_ids
+        if result[2] is not None:
+            image_ids.add(int(result[2]))
+    return faces, face_images
+
+
+def _regexp(pattern, value):
+    """Implements the SQLite REGEXP operator like the Python album filters:
+    re.match() ignoring case, on the NFC normalized value."""
+    if value is None:
+        return False
+    regex = _REGEXP_CACHE.get(pattern)
+    if regex is None:
+        regex = re.compile(pattern, re.IGNORECASE)
+        _REGEXP_CACHE[pattern] = regex
+    return regex.match(su.nfc(value)) is not None
+
+
+def _album_filter_clause(conn, album_filter, folder_filter, folders_by_id,
+                         folders_by_uuid):
+    """Prepares conn to filter albums in SQL.
+
+    Args:
+      conn: connection to the library.
+      folders_by_id, folders_by_uuid: the folders of the library (see
+          _index_folders).
+      album_filter: regular expression album names must match, or None.
+      folder_filter: regular expression one of the parent folders of an album
+          must match, or None. Albums outside of any folder always match.
+
+    Returns:
+      (clause, parameters) to add to a query on RKAlbum a.
+    """
+    clause = ''
+    params = []
+    if album_filter:
+        album_filter = su.unicode_string(album_filter)
+        re.compile(album_filter)  # Fail here on bad patterns, not within SQLite.
+        conn.create_function('regexp', 2, _regexp)
+        clause += ' and a.name regexp ?'
+        params.append(album_filter)
+    if folder_filter:
+        # There are few folders, so match their paths here once.
+        folder_pattern = re.compile(su.unicode_string(folder_filter), re.IGNORECASE)
+        matching_uuids = set()
+        for uuid, folder_dict in folders_by_uuid.iteritems():
+            for parent_folder in _folder_names(folder_dict, folders_by_id):
+                if folder_pattern.match(parent_folder):
+                    matching_uuids.add(uuid)
+                    break
+
+        def folder_match(uuid):
+            """Tests if an album in the folder with this uuid passes the filter."""
+            return uuid not in folders_by_uuid or uuid in matching_uuids
+        conn.create_function('phoshare_folder_match', 1, folder_match)
+        clause += ' and phoshare_folder_match(a.folderUuid)'
+    return clause, params
+
+
+def _iter_album_rows(conn, clause='', params=()):
+    """Yields (album row, list of version ids) pairs for the albums."""
+    # Rows come sorted by album, so an album is complete as soon as the next
+    # one starts.
+    c = conn.cursor()
+    c.execute(_ALBUM_QUERY % clause, params)
+    album_row = None
+    key_list = None
+    for result in _iter_rows(c):
+        if album_row is None or result[0] != album_row[0]:
+            if album_row is not None:
+                yield album_row, key_list
+            album_row = tuple(result[:5])
+            key_list = []
+        if result[5] is not None:
+            key_list.append(int(result[5]))
+    if album_row is not None:
+        yield album_row, key_list
+
+
+def _album_record(album_row, key_list, folders_by_uuid):
+    """Converts an album row and its version ids into an album dictionary.
+
+    "FolderUuid" is the uuid of the folder of the album, or None if the album is
+    not in any folder we read.
+    """
+    album_data = {}
+    album_data['AlbumId'] = int(album_row[0])
+    album_data['AlbumName'] = su.nfc(album_row[1])
+    # Dates are converted on demand, see getappletime().
+    album_data['AlbumTime'] = album_row[3]
+    album_data['KeyList'] = key_list
+
+    album_data['FolderUuid'] = None
+    if album_row[2] in folders_by_uuid:
+        album_data['FolderUuid'] = album_row[2]
+    if album_row[4] == _SMART_ALBUM_TYPE:
+        album_data['Album Type'] = 'Smart'
+    return album_data
+
+
+def _read_smart_album_rows(conn, clause='', params=()):
+    """Evaluates the smart albums in SQL (see smartalbums.compile_filter).
+
+    Returns (album row, list of version ids) pairs like _iter_album_rows(), in
+    model id order. Smart albums with conditions we cannot evaluate are
+    skipped. clause and params optionally filter the albums.
+    """
+    c = conn.cursor()
+    c.execute(_SMART_ALBUM_QUERY % clause, params)
+    smart_album_rows = []
+    for result in c.fetchall():
+        try:
+            condition, condition_params = smartalbums.compile_filter(result[5])
+        except ValueError as e:
+            su.pout(u'Skipping smart album %s: %s.' % (su.nfc(result[1]), e))
+            continue
+        c.execute(_SMART_ALBUM_IMAGE_QUERY % condition, condition_params)
+        key_list = [int(row[0]) for row in _iter_rows(c)]
+        smart_album_rows.append((tuple(result[:5]), key_list))
+    return smart_album_rows
+
+
+def iter_albums(conn, folders_by_uuid, clause='', params=(), smart_album_rows=()):
+    """Yields the album dictionaries of the library, each one with its complete
+    KeyList of version ids, merged in model id order with the smart albums
+    already evaluated in smart_album_rows. clause and params optionally filter
+    the albums."""
+    for album_row, key_list in heapq.merge(_iter_album_rows(conn, clause, params),
+                                           smart_album_rows):
+        yield _album_record(album_row, key_list, folders_by_uuid)
+
+
+def _image_record(paths, result, image_keywords):
+    """Converts an image row into a (master id, image dictionary) pair.
+
+    The image paths are added to paths (a pathtable.PathTable), and the
+    dictionary holds their path ids. image_keywords maps image ids to their
+    keyword ids (see _read_keywords).
+    """
+    master_id = int(result[0])
+    image_data = {}
+
+    original_path = paths.add(os.path.join('Masters', su.nfc(result[1])))
+    resource_uuid = result[5]
+    if resource_uuid:
+        folder1 = str(ord(resource_uuid[0]))
+        folder2 = str(ord(resource_uuid[1]))
+        filename = su.nfc(result[6])
+        image_data['ImagePath'] = paths.add(os.path.join(
+            'resources', 'modelresources', folder1, folder2, resource_uuid, filename))
+        image_data['OriginalPath'] = original_path
+    else:
+        image_data['ImagePath'] = original_path
+
+    version_name = None
+    if result[2]:
+        version_name = su.nfc(result[2])
+    image_data['Caption'] = version_name
+    # Dates are converted on demand, see getappletime().
+    image_data['ImageTime'] = result[3] or result[4]
+    # The version changes when the image is edited, the master when its file
+    # does.
+    changes = [stamp for stamp in result[7:9] if stamp is not None]
+    image_data['ModDateAsTimerInterval'] = max(changes) if changes else None
+    image_data['Keywords'] = image_keywords.get(master_id, [])
+    return master_id, image_data
+
+
+def iter_images(conn, paths, image_keywords, album_clause=None, params=()):
+    """Yields (master id, image dictionary) pairs for the images of the library:
+    masters joined with their version and edited resource, if any, and their
+    keyword ids from image_keywords. The image paths are added to paths (see
+    _image_record). If album_clause is set, only the images in the albums it
+    selects are read."""
+    c = conn.cursor()
+    if album_clause is None:
+        c.execute(_IMAGE_QUERY % '')
+    else:
+        c.execute(_IMAGE_QUERY % (_IMAGE_ALBUM_CLAUSE % album_clause), params)
+    for result in _iter_rows(c):
+        yield _image_record(paths, result, image_keywords)
+
+
+class _ClosingIterator(object):
+    """Iterates over an iterable, and closes a database connection once it is
+    exhausted, fails, or is closed, even if it was never started."""
+
+    def __init__(self, iterable, conn):
+        self._iterator = iter(iterable)
+        self._conn = conn
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Returns the next item of the iterable."""
+        try:
+            return next(self._iterator)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        """Stops the iteration, and closes the connection."""
+        if self._conn is None:
+            return
+        close = getattr(self._iterator, 'close', None)
+        if close is not None:
+            close()
+        self._conn.close()
+        self._conn = None
+
+
+def stream_apple_library(photos_library_dir, album_filter=None, folder_filter=None,
+                         in_memory=False):
+    """Reads the Photos library without materializing it.
+
+    Returns a dictionary like read_apple_library(), except that "Master Image
+    List" is an iterator of (master id, image dictionary) pairs and "List of
+    Albums" an iterator of album dictionaries, both reading from the database
+    as they are consumed. The images must be consumed before the albums; the
+    database connection is closed once the albums are exhausted, or the album
+    iterator is closed (see iphotodata.IPhotoData.close). In both,
+    image paths are ids in the "Path Table" (see pathtable.PathTable).
+
+    If album_filter or folder_filter are set, only the albums matching them
+    (see _album_filter_clause), and the images in these albums, are read.
+    If in_memory is set, the queries run against a private copy of the
+    databases (see copy_photos_library).
+    """
+    photos_dict = {}
+
+    conn = open_photos_library(photos_library_dir, in_memory)
+    try:
+        photos_dict['Application Version'] = read_library_version(conn)
+        folders_by_id, folders_by_uuid = _index_folders(_read_folder_rows(conn))
+        keywords, image_keywords = _read_keywords(conn)
+        faces, face_images = _read_faces(conn)
+        if album_filter or folder_filter:
+            album_clause, params = _album_filter_clause(conn, album_filter, folder_filter,
+                                                        folders_by_id, folders_by_uuid)
+        else:
+            album_clause, params = None, ()
+        smart_album_rows = _read_smart_album_rows(conn, album_clause or '', params)
+        # The images of the selected smart albums are read too.
+        smart_album_images = set()
+        for _album_row, key_list in smart_album_rows:
+            smart_album_images.update(key_list)
+
+        def smart_album_image(image_id):
+            """Tests if an image is in one of the selected smart albums."""
+            return image_id in smart_album_images
+        conn.create_function('phoshare_smart_album_image', 1, smart_album_image)
+    except:
+        conn.close()
+        raise
+    photos_dict['List of Folders'] = folders_by_uuid.values()
+    photos_dict['List of Keywords'] = keywords
+    photos_dict['List of Faces'] = faces
+    photos_dict['Face Images'] = face_images
+    paths = pathtable.PathTable(photos_library_dir)
+    photos_dict['Path Table'] = paths
+    photos_dict['Master Image List'] = iter_images(conn, paths, image_keywords,
+                                                   album_clause, params)
+    photos_dict['List of Albums'] = _ClosingIterator(
+        iter_albums(conn, folders_by_uuid, album_clause or '', params, smart_album_rows),
+        conn)
+
+    return photos_dict
+
+
+def _read_changed_rows(conn, snapshot):
+    """Reads the image and album rows that changed since a snapshot was taken.
+
+    Returns (image rows, album rows), mapped by model id, in the format of the
+    snapshot. Unchanged rows are taken from the snapshot, deleted ones are
+    dropped.
+    """
+    old_images = snapshot.get('images', {})
+    old_albums = snapshot.get('albums', {})
+
+    image_rows = {}
+    changed_ids = []
+    c = conn.cursor()
+    c.execute(_IMAGE_STAMP_QUERY)
+    for result in _iter_rows(c):
+        master_id = int(result[0])
+        old_row = old_images.get(master_id)
+        if old_row is not None and tuple(old_row[7:]) == tuple(result[1:]):
+            image_rows[master_id] = old_row
+        else:
+            changed_ids.append(master_id)
+    # Without a previous snapshot, one scan beats looking up every id.
+    if old_images:
+        clauses = [_id_clause('m.modelId', ids) for ids in _chunks(changed_ids)]
+    else:
+        clauses = ['']
+    for clause in clauses:
+        c = conn.cursor()
+        c.execute(_IMAGE_QUERY % clause)
+        for result in _iter_rows(c):
+            image_rows[int(result[0])] = tuple(result)
+
+    album_rows = {}
+    changed_ids = []
+    c = conn.cursor()
+    c.execute(_ALBUM_STAMP_QUERY)
+    for result in _iter_rows(c):
+        album_id = int(result[0])
+        old_album = old_albums.get(album_id)
+        if old_album is not None and old_album[0][3] == result[1]:
+            album_rows[album_id] = old_album
+        else:
+            changed_ids.append(album_id)
+    if old_albums:
+        clauses = [_id_clause('a.modelId', ids) for ids in _chunks(changed_ids)]
+    else:
+        clauses = ['']
+    for clause in clauses:
+        for album_row, key_list in _iter_album_rows(conn, clause):
+            album_rows[int(album_row[0])] = (album_row, key_list)
+    # Smart albums change with the images they select, so they are always
+    # evaluated again.
+    for album_row, key_list in _read_smart_album_rows(conn):
+        album_rows[int(album_row[0])] = (album_row, key_list)
+
+    return image_rows, album_rows
+
+
+def _start_thread(function, *args):
+    """Calls function(*args) on a new thread. Returns a function that waits for
+    the thread, and returns the result of the call or raises its exception."""
+    outcome = {}
+    def run():
+        """Runs the call, keeping its result or exception."""
+        try:
+            outcome['result'] = function(*args)
+        except:
+            outcome['error'] = sys.exc_info()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+    def wait():
+        """Waits for the call to finish, and returns its result."""
+        thread.join()
+        if 'error' in outcome:
+            error = outcome['error']
+            raise error[0], error[1], error[2]
+        return outcome['result']
+    return wait
+
+
+def _read_version_file(photos_library_dir):
+    """Returns the library version, read from metaSchema.db on its own connection."""
+    conn = _connect_database(get_photos_metaschema_file(photos_library_dir))
+    try:
+        return read_library_version(conn, 'main')
+    finally:
+        conn.close()
+
+
+def _read_resource_rows(photos_library_dir):
+    """Returns the (resource uuid, file name) of the edited version of images,
+    mapped by master id, read from ImageProxies.apdb on its own connection."""
+    conn = _connect_database(get_photos_imageproxies_file(photos_library_dir))
+    try:
+        resources = {}
+        c = conn.cursor()
+        c.execute(_RESOURCE_QUERY)
+        for result in _iter_rows(c):
+            resources[int(result[0])] = (result[1], result[2])
+        return resources
+    finally:
+        conn.close()
+
+
+def _read_master_rows(photos_library_dir):
+    """Returns the master and version rows of the images, read from Library.apdb
+    on its own connection."""
+    conn = _connect_database(get_photos_library_file(photos_library_dir))
+    try:
+        c = conn.cursor()
+        c.execute(_MASTER_QUERY)
+        return c.fetchall()
+    finally:
+        conn.close()
+
+
+def _read_album_rows(photos_library_dir):
+    """Returns the folder rows, the album rows mapped by model id, the keywords
+    (see _read_keywords) and the faces (see _read_faces), read from
+    Library.apdb on its own connection."""
+    conn = _connect_database(get_photos_library_file(photos_library_dir))
+    try:
+        folder_rows = _read_folder_rows(conn)
+        album_rows = {}
+        for album_row, key_list in _iter_album_rows(conn):
+            album_rows[int(album_row[0])] = (album_row, key_list)
+        for album_row, key_list in _read_smart_album_rows(conn):
+            album_rows[int(album_row[0])] = (album_row, key_list)
+        return folder_rows, album_rows, _read_keywords(conn), _read_faces(conn)
+    finally:
+        conn.close()
+
+
+def _read_rows_concurrently(photos_library_dir):
+    """Reads the library version, folder, image and album rows, the keywords and
+    the faces, in the format of the snapshot, with the databases read on separate threads.
+
+    sqlite3 releases the interpreter lock while queries run, so the reads
+    overlap, which pays off when the library is on a slow disk.
+    """
+    wait_version = _start_thread(_read_version_file, photos_library_dir)
+    wait_resources = _start_thread(_read_resource_rows, photos_library_dir)
+    wait_masters = _start_thread(_read_master_rows, photos_library_dir)
+    wait_albums = _start_thread(_read_album_rows, photos_library_dir)
+
+    library_version = wait_version()
+    resources = wait_resources()
+    image_rows = {}
+    for result in wait_masters():
+        master_id = int(result[0])
+        resource_uuid, filename = resources.get(master_id, (None, None))
+        # Same columns as _IMAGE_QUERY.
+        image_rows[master_id] = (tuple(result[:5]) + (resource_uuid, filename) +
+                                 tuple(result[5:]) + (resource_uuid,))
+    folder_rows, album_rows, keywords, faces = wait_albums()
+    return library_version, folder_rows, image_rows, album_rows, keywords, faces
+
+
+def _get_database_files(photos_library_dir):
+    """Returns the paths of the Photos database files, including their
+    write-ahead logs, which hold the latest changes while Photos runs."""
+    database_files = []
+    for database_file in (get_photos_library_file(photos_library_dir),
+                          get_photos_imageproxies_file(photos_library_dir),
+                          get_photos_metaschema_file(photos_library_dir)):
+        database_files.append(database_file)
+        database_files.append(database_file + '-wal')
+    return database_files
+
+
+def read_apple_library(photos_library_dir, snapshot_file=None, in_memory=False,
+                       concurrent=False):
+    """Reads the complete Photos library into a dictionary.
+
+    Args:
+      photos_library_dir: path to the Photos library.
+      snapshot_file: if set, the rows read are saved to this file. The next
+          load with the same file does not query the database at all if the
+          database files did not change (same size, modification time and
+          inode), and otherwise only reads the images and albums that changed.
+      in_memory: if set, the database is copied to memory before it is queried
+          (see copy_photos_library).
+      concurrent: if set, and the whole library has to be read, the three
+          databases are read on separate threads and connections (see
+          _read_rows_concurrently). Ignored with in_memory.
+    """
+    concurrent = concurrent and not in_memory
+    if not snapshot_file and not concurrent:
+        photos_dict = stream_apple_library(photos_library_dir, in_memory=in_memory)
+        photos_dict['Master Image List'] = dict(photos_dict['Master Image List'])
+        photos_dict['List of Albums'] = list(photos_dict['List of Albums'])
+        return photos_dict
+
+    snapshot = None
+    if snapshot_file:
+        snapshot = librarysnapshot.load_snapshot(snapshot_file, photos_library_dir)
+        # Taken before reading, so that changes made while we read are picked
+        # up by the next load.
+        identity = librarysnapshot.get_files_identity(
+            _get_database_files(photos_library_dir))
+    if snapshot is None:
+        snapshot = {}
+
+    photos_dict = {}
+    if snapshot_file and snapshot.get('identity') == identity:
+        photos_dict['Application Version'] = snapshot['version']
+        folder_rows = snapshot['folders']
+        image_rows = snapshot['images']
+        album_rows = snapshot['albums']
+        keywords, image_keywords = snapshot['keywords']
+        faces, face_images = snapshot['faces']
+    elif concurrent and not snapshot.get('images'):
+        (photos_dict['Application Version'], folder_rows, image_rows,
+         album_rows, (keywords, image_keywords),
+         (faces, face_images)) = _read_rows_concurrently(photos_library_dir)
+    else:
+        conn = open_photos_library(photos_library_dir, in_memory)
+        try:
+            photos_dict['Application Version'] = read_library_version(conn)
+            folder_rows = _read_folder_rows(conn)
+            image_rows, album_rows = _read_changed_rows(conn, snapshot)
+            # Keywords and faces change without touching the versions, so
+            # they are always read in full.
+            keywords, image_keywords = _read_keywords(conn)
+            faces, face_images = _read_faces(conn)
+        finally:
+            conn.close()
+
+    if snapshot_file and snapshot.get('identity') != identity:
+        librarysnapshot.save_snapshot(snapshot_file, photos_library_dir,
+                                      {'identity': identity,
+                                       'version': photos_dict['Application Version'],
+                                       'folders': folder_rows,
+                                       'images': image_rows,
+                                       'albums': album_rows,
+                                       'keywords': (keywords, image_keywords),
+                                       'faces': (faces, face_images)})
+
+    folders_by_id, folders_by_uuid = _index_folders(folder_rows)
+    photos_dict['List of Folders'] = folders_by_uuid.values()
+    photos_dict['List of Keywords'] = keywords
+    photos_dict['List of Faces'] = faces
+    photos_dict['Face Images'] = face_images
+    paths = pathtable.PathTable(photos_library_dir)
+    photos_dict['Path Table'] = paths
+    photos_dict['Master Image List'] = dict(
+        _image_record(paths, row, image_keywords)
+        for row in image_rows.itervalues())
+    photos_dict['List of Albums'] = [
+        _album_record(album_row, list(key_list), folders_by_uuid)
+        for album_row, key_list in
+        [album_rows[album_id] for album_id in sorted(album_rows)]]
 
     return photos_dict
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""This module tests applexml.py."""
+
+# Copyright 2017 Benjamín Valero
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+
+import appledata.applexml as applexml
+
+
+class Connection(object):
+    """A database connection that only tells if it was closed."""
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class AppleXmlTest(unittest.TestCase):
+    """Unit tests for applexml.py code."""
+
+    def test_appletimestamps(self):
+        """Tests that converted columns compare like the converted dates."""
+        values = [500000000.0, 100000000.5, 0, 300000000.0]
+        stamps = applexml.appletimestamps(values + [None, 'bad'])
+        for value, stamp in zip(values, stamps):
+            date = applexml.getappletime(value)
+            self.assertAlmostEquals(applexml.getposixstamp(date), stamp, 3)
+            self.assertAlmostEquals(applexml.getapplestamp(date), value, 3)
+        self.assertEquals(sorted(values, key=applexml.getappletime),
+                          [values[i] for i in sorted(range(len(values)),
+                                                     key=stamps.__getitem__)])
+        # Bad time stamps are NaN.
+        self.assertTrue(stamps[4] != stamps[4])
+        self.assertTrue(stamps[5] != stamps[5])
+
+    def test_closing_iterator(self):
+        """Tests that the connection of a streamed list is closed when the list
+        is exhausted, or closed before."""
+        conn = Connection()
+        self.assertEquals([1, 2], list(applexml._ClosingIterator([1, 2], conn)))
+        self.assertTrue(conn.closed)
+        conn = Connection()
+        applexml._ClosingIterator(iter([1, 2]), conn).close()
+        self.assertTrue(conn.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
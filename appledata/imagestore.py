@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+'''Keeps the images of a Photos library in compact form.
+
+An image store maps image ids to images like a dictionary, but holds the image
+data either in a temporary SQLite database on disk (SqliteImageStore) or in
+parallel arrays in memory (ColumnarImageStore). Images are created from their
+data each time they are looked up, so only the images in use take memory.
+LazyImageStore keeps the data as read, and creates each image once, the first
+time it is looked up.
+'''
+
+# Copyright 2017 Benjamín Valero
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import array
+import bisect
+import functools
+import itertools
+import marshal
+import operator
+import os
+import sqlite3
+import tempfile
+
+import appledata.applexml as applexml
+import tilutil.imageutils as imageutils
+
+# Number of images inserted at once.
+_BATCH_SIZE = 1000
+
+# Number of parameters of a query, below the SQLite limit of 999.
+_MAX_PARAMETERS = 500
+
+
+class LazyImageStore(object):
+    """A map of image ids to images, which creates each image from its data the
+    first time it is looked up and keeps it from then on.
+
+    Images that are never looked up (because none of the selected albums has
+    them) are never created.
+    """
+
+    def __init__(self, make_image):
+        """Creates an empty store. make_image is called with (image id, image
+        data) to create the image returned by a lookup."""
+        self._make_image = make_image
+        self._data = {}
+        self._images = {}
+
+    def add(self, image_id, data):
+        """Adds the data of an image, as read by applexml."""
+        self._data[image_id] = data
+        self._images.pop(image_id, None)
+
+    def get(self, image_id, default=None):
+        """Returns the image with this id, or default."""
+        image = self._images.get(image_id)
+        if image is None:
+            data = self._data.pop(image_id, None)
+            if data is None:
+                return default
+            image = self._make_image(image_id, data)
+            self._images[image_id] = image
+        return image
+
+    def __getitem__(self, image_id):
+        image = self.get(image_id)
+        if image is None:
+            raise KeyError(image_id)
+        return image
+
+    def __contains__(self, image_id):
+        return image_id in self._images or image_id in self._data
+
+    def __len__(self):
+        return len(self._images) + len(self._data)
+
+    def iterkeys(self):
+        """Yields the image ids, in order."""
+        return iter(sorted(self._images.keys() + self._data.keys()))
+
+    def iteritems(self):
+        """Yields (image id, image) pairs, in id order, creating the images
+        that were not looked up yet."""
+        for image_id in self.iterkeys():
+            yield image_id, self.get(image_id)
+
+    def itervalues(self):
+        """Yields the images, in id order."""
+        for _image_id, image in self.iteritems():
+            yield image
+
+    def values(self):
+        """Returns a list of all images, creating them all."""
+        return list(self.itervalues())
+
+    def itertimes(self):
+        """Yields (image id, Apple time stamp of the image date or None) pairs,
+        in no particular order, without creating any image."""
+        for image_id, data in self._data.iteritems():
+            yield image_id, data.get("ImageTime")
+        for image_id, image in self._images.iteritems():
+            yield image_id, image.time_stamp
+
+    def itercreated(self):
+        """Yields the images created so far, in no particular order."""
+        return self._images.itervalues()
+
+    def getcreatedcount(self):
+        """Returns the number of images created so far."""
+        return len(self._images)
+
+    def close(self):
+        """Does nothing, the images are released with the store. Exists for
+        compatibility with SqliteImageStore."""
+        pass
+
+
+class SqliteImageStore(object):
+    """A map of image ids to images, backed by a temporary SQLite database."""
+
+    def __init__(self, make_image, temp_dir=None):
+        """Creates an empty store.
+
+        Args:
+          make_image: function called with (image id, image data) to create
+              the image returned by a lookup.
+          temp_dir: directory for the database, the system default if None.
+        """
+        self._make_image = make_image
+        fd, path = tempfile.mkstemp(prefix='phoshare', suffix='.sqlite', dir=temp_dir)
+        os.close(fd)
+        self._conn = sqlite3.connect(path)
+        # The file is removed right away, and goes away with the connection
+        # even if we crash. It needs no journal for the same reason.
+        os.remove(path)
+        self._conn.execute('pragma journal_mode = off')
+        self._conn.execute('pragma synchronous = off')
+        self._conn.execute('create table images (id integer primary key, data blob)')
+        self._pending = []
+        self._size = 0
+
+    def add(self, image_id, data):
+        """Adds the data of an image (a dictionary of simple values)."""
+        self._pending.append((image_id, sqlite3.Binary(marshal.dumps(data))))
+        if len(self._pending) >= _BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        """Writes the pending images to the database."""
+        if self._pending:
+            # Keep the size up to date without counting the whole table: the
+            # new ids are those of the batch that are not stored yet (an id
+            # added again replaces its data).
+            new_ids = set(row[0] for row in self._pending)
+            ids = list(new_ids)
+            for i in xrange(0, len(ids), _MAX_PARAMETERS):
+                chunk = ids[i:i + _MAX_PARAMETERS]
+                c = self._conn.execute('select id from images where id in (%s)' %
+                                       ', '.join('?' * len(chunk)), chunk)
+                new_ids.difference_update(row[0] for row in c)
+            self._conn.executemany('insert or replace into images values (?, ?)',
+                                   self._pending)
+            self._conn.commit()
+            self._pending = []
+            self._size += len(new_ids)
+
+    def _query(self, query, params=()):
+        """Yields the rows of a query, after writing the pending images."""
+        self._flush()
+        c = self._conn.cursor()
+        c.execute(query, params)
+        while True:
+            rows = c.fetchmany(_BATCH_SIZE)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def get(self, image_id, default=None):
+        """Returns the image with this id, or default."""
+        for row in self._query('select data from images where id = ?', (image_id,)):
+            return self._make_image(image_id, marshal.loads(str(row[0])))
+        return default
+
+    def __getitem__(self, image_id):
+        image = self.get(image_id)
+        if image is None:
+            raise KeyError(image_id)
+        return image
+
+    def __contains__(self, image_id):
+        for _row in self._query('select 1 from images where id = ?', (image_id,)):
+            return True
+        return False
+
+    def __len__(self):
+        self._flush()
+        return self._size
+
+    def iterkeys(self):
+        """Yields the image ids, in order."""
+        for row in self._query('select id from images order by id'):
+            yield row[0]
+
+    def iteritems(self):
+        """Yields (image id, image) pairs, in id order, reading the database as
+        they are consumed."""
+        for row in self._query('select id, data from images order by id'):
+            yield row[0], self._make_image(row[0], marshal.loads(str(row[1])))
+
+    def itervalues(self):
+        """Yields the images, in id order."""
+        for _image_id, image in self.iteritems():
+            yield image
+
+    def values(self):
+        """Returns a list of all images. Avoid it for large libraries."""
+        return list(self.itervalues())
+
+    def itertimes(self):
+        """Yields (image id, Apple time stamp of the image date or None) pairs,
+        in no particular order, without creating any image."""
+        for row in self._query('select id, data from images'):
+            yield row[0], marshal.loads(str(row[1])).get("ImageTime")
+
+    def close(self):
+        """Releases the database. The store must not be used afterwards."""
+        self._conn.close()
+
+
+class ColumnarImageStore(object):
+    """A map of image ids to images, kept in parallel arrays.
+
+    Each image takes a row of the id, time stamps, path id and flag columns. Its
+    strings are slices of one shared string, and its keyword ids a slice of
+    one array.
+    Selections by date or kind of image scan the columns without creating any
+    image (see select_ids).
+    """
+
+    # Strings kept for each image, in order.
+    _STRING_FIELDS = ('Caption',)
+
+    # Bits of the flag column.
+    _HAS_ORIGINAL = 1
+    _IS_MOVIE = 2
+
+    def __init__(self, make_image, paths):
+        """Creates an empty store.
+
+        Args:
+          make_image: function called with (image id, image data) to create
+              the image returned by a lookup.
+          paths: the pathtable.PathTable of the image paths.
+        """
+        self._make_image = make_image
+        self._paths = paths
+        self._ids = array.array('l')
+        self._times = array.array('d')  # Apple time stamps, NaN if unknown.
+        self._mod_times = array.array('d')  # Same, of the last changes.
+        # Path ids, -1 for images without an original.
+        self._image_paths = array.array('l')
+        self._original_paths = array.array('l')
+        self._flags = array.array('B')
+        # Start and length in the shared string of each image string, length
+        # -1 for missing strings.
+        self._string_starts = array.array('l')
+        self._string_lengths = array.array('l')
+        self._strings = u''
+        self._new_strings = []
+        self._strings_size = 0
+        self._keyword_starts = array.array('l')
+        self._keyword_ids = array.array('l')
+        # Rows sorted by image id, for lookups. Built on demand.
+        self._sorted_ids = None
+        self._sorted_rows = None
+
+    def add(self, image_id, data):
+        """Adds the data of an image, as read by applexml."""
+        self._ids.append(image_id)
+        try:
+            self._times.append(float(data.get("ImageTime")))
+        except (TypeError, ValueError) as _e:
+            self._times.append(float('nan'))
+        try:
+            self._mod_times.append(float(data.get("ModDateAsTimerInterval")))
+        except (TypeError, ValueError) as _e:
+            self._mod_times.append(float('nan'))
+
+        image_path = data.get("ImagePath")
+        original_path = data.get("OriginalPath")
+        self._image_paths.append(image_path)
+        flags = 0
+        if original_path is not None:
+            flags |= self._HAS_ORIGINAL
+            self._original_paths.append(original_path)
+        else:
+            self._original_paths.append(-1)
+        if imageutils.is_movie_file(self._paths.getname(image_path)):
+            flags |= self._IS_MOVIE
+        self._flags.append(flags)
+
+        for field in self._STRING_FIELDS:
+            value = data.get(field)
+            self._string_starts.append(self._strings_size)
+            if value is None:
+                self._string_lengths.append(-1)
+                continue
+            if isinstance(value, str):
+                value = value.decode('utf-8')
+            self._new_strings.append(value)
+            self._strings_size += len(value)
+            self._string_lengths.append(len(value))
+
+        self._keyword_starts.append(len(self._keyword_ids))
+        self._keyword_ids.extend(data.get("Keywords") or [])
+        self._sorted_ids = None
+
+    def _getstrings(self):
+        """Returns the shared string, with the strings added so far."""
+        if self._new_strings:
+            self._strings += u''.join(self._new_strings)
+            self._new_strings = []
+        return self._strings
+
+    def _sort(self):
+        """Sorts the rows by image id, if images were added since the last sort."""
+        if self._sorted_ids is None:
+            rows = sorted(xrange(len(self._ids)), key=self._ids.__getitem__)
+            self._sorted_rows = array.array('l', rows)
+            self._sorted_ids = array.array('l', [self._ids[row] for row in rows])
+
+    def _find(self, image_id):
+        """Returns the row of an image id, or None."""
+        self._sort()
+        i = bisect.bisect_left(self._sorted_ids, image_id)
+        if i < len(self._sorted_ids) and self._sorted_ids[i] == image_id:
+            return self._sorted_rows[i]
+        return None
+
+    def _getdata(self, row):
+        """Rebuilds the image data of a row."""
+        data = {}
+        strings = self._getstrings()
+        fields = len(self._STRING_FIELDS)
+        for i, field in enumerate(self._STRING_FIELDS):
+            length = self._string_lengths[row * fields + i]
+            data[field] = None
+            if length >= 0:
+                start = self._string_starts[row * fields + i]
+                data[field] = strings[start:start + length]
+        data["ImagePath"] = self._image_paths[row]
+        if self._original_paths[row] >= 0:
+            data["OriginalPath"] = self._original_paths[row]
+        stamp = self._times[row]
+        data["ImageTime"] = stamp if stamp == stamp else None
+        stamp = self._mod_times[row]
+        data["ModDateAsTimerInterval"] = stamp if stamp == stamp else None
+        end = (self._keyword_starts[row + 1] if row + 1 < len(self._keyword_starts)
+               else len(self._keyword_ids))
+        data["Keywords"] = self._keyword_ids[self._keyword_starts[row]:end].tolist()
+        return data
+
+    def get(self, image_id, default=None):
+        """Returns the image with this id, or default."""
+        row = self._find(image_id)
+        if row is None:
+            return default
+        return self._make_image(image_id, self._getdata(row))
+
+    def __getitem__(self, image_id):
+        image = self.get(image_id)
+        if image is None:
+            raise KeyError(image_id)
+        return image
+
+    def __contains__(self, image_id):
+        return self._find(image_id) is not None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def iterkeys(self):
+        """Yields the image ids, in order."""
+        self._sort()
+        return iter(self._sorted_ids)
+
+    def iteritems(self):
+        """Yields (image id, image) pairs, in id order."""
+        self._sort()
+        for i, row in enumerate(self._sorted_rows):
+            image_id = self._sorted_ids[i]
+            yield image_id, self._make_image(image_id, self._getdata(row))
+
+    def itervalues(self):
+        """Yields the images, in id order."""
+        for _image_id, image in self.iteritems():
+            yield image
+
+    def values(self):
+        """Returns a list of all images. Avoid it for large libraries."""
+        return list(self.itervalues())
+
+    def itertimes(self):
+        """Yields (image id, Apple time stamp of the image date or None) pairs,
+        in the order they were added, without creating any image."""
+        for image_id, stamp in itertools.izip(self._ids, self._times):
+            # NaN marks unknown time stamps.
+            yield image_id, stamp if stamp == stamp else None
+
+    def close(self):
+        """Does nothing, the columns are released with the store. Exists for
+        compatibility with SqliteImageStore."""
+        pass
+
+    def select_ids(self, date_from=None, date_to=None, has_original=None,
+                   is_movie=None):
+        """Returns the ids of the images that pass all the given conditions, in
+        the order they were added.
+
+        Args:
+          date_from, date_to: the image date must be at or after date_from, and
+              before date_to. Images without a date do not pass.
+          has_original: whether the image must (or must not) have an original.
+          is_movie: whether the image must (or must not) be a movie.
+        """
+        stamp_from = applexml.getapplestamp(date_from) if date_from is not None else None
+        stamp_to = applexml.getapplestamp(date_to) if date_to is not None else None
+        flag_mask = 0
+        flag_value = 0
+        if has_original is not None:
+            flag_mask |= self._HAS_ORIGINAL
+            if has_original:
+                flag_value |= self._HAS_ORIGINAL
+        if is_movie is not None:
+            flag_mask |= self._IS_MOVIE
+            if is_movie:
+                flag_value |= self._IS_MOVIE
+
+        # One iterator of booleans per condition, over whole columns, so that
+        # the rows are tested in C rather than one at a time in Python.
+        conditions = []
+        if flag_mask:
+            conditions.append(itertools.imap(
+                functools.partial(operator.eq, flag_value),
+                itertools.imap(functools.partial(operator.and_, flag_mask), self._flags)))
+        # NaN fails both comparisons.
+        if stamp_from is not None:
+            conditions.append(itertools.imap(functools.partial(operator.le, stamp_from),
+                                             self._times))
+        if stamp_to is not None:
+            conditions.append(itertools.imap(functools.partial(operator.gt, stamp_to),
+                                             self._times))
+        if not conditions:
+            return array.array('l', self._ids)
+        selectors = conditions[0]
+        for condition in conditions[1:]:
+            selectors = itertools.imap(operator.and_, selectors, condition)
+        return array.array('l', itertools.compress(self._ids, selectors))
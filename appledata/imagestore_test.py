@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""This module tests imagestore.py."""
+
+# Copyright 2017 Benjamín Valero
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+
+import appledata.applexml as applexml
+import appledata.imagestore as imagestore
+import appledata.pathtable as pathtable
+
+class LazyImageStoreTest(unittest.TestCase):
+    """Unit tests for LazyImageStore."""
+
+    def test_store(self):
+        """Tests that images are created once, on first lookup."""
+        created = []
+        def make_image(key, data):
+            created.append(key)
+            return (key, data['ImagePath'])
+        store = imagestore.LazyImageStore(make_image)
+        store.add(2, {'ImagePath': u'/b.jpg'})
+        store.add(1, {'ImagePath': u'/a.jpg'})
+        self.assertEquals(2, len(store))
+        self.assertTrue(1 in store)
+        self.assertFalse(3 in store)
+        self.assertEquals([], created)
+        self.assertEquals((2, u'/b.jpg'), store[2])
+        self.assertTrue(store.get(2) is store.get(2))
+        self.assertEquals(None, store.get(3))
+        self.assertEquals([2], created)
+        self.assertEquals(1, store.getcreatedcount())
+        self.assertEquals([1, 2], list(store.iterkeys()))
+        self.assertEquals([(1, u'/a.jpg'), (2, u'/b.jpg')], store.values())
+        self.assertEquals([2, 1], created)
+
+
+class SqliteImageStoreTest(unittest.TestCase):
+    """Unit tests for imagestore.py code."""
+
+    def test_store(self):
+        """Tests the dictionary interface of SqliteImageStore."""
+        store = imagestore.SqliteImageStore(lambda key, data: (key, data))
+        try:
+            store.add(2, {'ImagePath': u'/b.jpg', 'Keywords': [1, 2]})
+            store.add(1, {'ImagePath': u'/a.jpg', 'Keywords': []})
+            self.assertEquals(2, len(store))
+            self.assertTrue(1 in store)
+            self.assertFalse(3 in store)
+            self.assertEquals((2, {'ImagePath': u'/b.jpg', 'Keywords': [1, 2]}),
+                              store[2])
+            self.assertEquals(None, store.get(3))
+            self.assertRaises(KeyError, lambda: store[3])
+            self.assertEquals([1, 2], list(store.iterkeys()))
+            self.assertEquals([u'/a.jpg', u'/b.jpg'],
+                              [data['ImagePath'] for _key, data in store.itervalues()])
+        finally:
+            store.close()
+
+    def test_size(self):
+        """Tests that the size counts ids added again once, in or across
+        batches."""
+        store = imagestore.SqliteImageStore(lambda key, data: data)
+        try:
+            for image_id in xrange(imagestore._BATCH_SIZE * 2 + 10):
+                store.add(image_id % (imagestore._BATCH_SIZE + 5), {'Id': image_id})
+            self.assertEquals(imagestore._BATCH_SIZE + 5, len(store))
+            self.assertEquals({'Id': imagestore._BATCH_SIZE * 2 + 9},
+                              store[imagestore._BATCH_SIZE + 4])
+            store.add(10 ** 6, {})
+            self.assertEquals(imagestore._BATCH_SIZE + 6, len(store))
+        finally:
+            store.close()
+
+
+class ColumnarImageStoreTest(unittest.TestCase):
+    """Unit tests for ColumnarImageStore."""
+
+    def setUp(self):
+        paths = pathtable.PathTable(u'/lib')
+        self.store = imagestore.ColumnarImageStore(lambda key, data: data, paths)
+        self.store.add(3, {'ImagePath': paths.add(u'c.mov'), 'Caption': u'caf\xe9',
+                           'ImageTime': 500000000.0, 'Keywords': [2]})
+        self.store.add(1, {'ImagePath': paths.add(u'a.jpg'),
+                           'OriginalPath': paths.add(u'o/a.jpg'),
+                           'Caption': None, 'ImageTime': 400000000.0,
+                           'ModDateAsTimerInterval': 410000000.0,
+                           'Keywords': [1, 2]})
+        self.store.add(2, {'ImagePath': paths.add(u'b.jpg'), 'Caption': u'',
+                           'ImageTime': None})
+
+    def test_lookup(self):
+        """Tests that the image data comes back as it was added."""
+        self.assertEquals(3, len(self.store))
+        self.assertEquals([1, 2, 3], list(self.store.iterkeys()))
+        self.assertEquals({'ImagePath': 1, 'OriginalPath': 2,
+                           'Caption': None, 'ImageTime': 400000000.0,
+                           'ModDateAsTimerInterval': 410000000.0,
+                           'Keywords': [1, 2]}, self.store[1])
+        self.assertEquals({'ImagePath': 3, 'Caption': u'', 'ImageTime': None,
+                           'ModDateAsTimerInterval': None,
+                           'Keywords': []}, self.store[2])
+        self.assertEquals(u'caf\xe9', self.store.get(3)['Caption'])
+        self.assertFalse(4 in self.store)
+        self.assertEquals(None, self.store.get(4))
+
+    def test_select_ids(self):
+        """Tests ColumnarImageStore.select_ids()."""
+        self.assertEquals([3, 1, 2], list(self.store.select_ids()))
+        self.assertEquals([1], list(self.store.select_ids(has_original=True)))
+        self.assertEquals([3], list(self.store.select_ids(is_movie=True)))
+        middle = applexml.getappletime(450000000.0)
+        self.assertEquals([3], list(self.store.select_ids(date_from=middle)))
+        self.assertEquals([1], list(self.store.select_ids(date_to=middle)))
+        self.assertEquals([], list(self.store.select_ids(date_from=middle,
+                                                         is_movie=False)))
+
+
+if __name__ == '__main__':
+    unittest.main()
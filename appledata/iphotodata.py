@@ -48,12 +48,15 @@ None - should not really happen
 #   2017-01-14: retrieve all necessary data entirely from Photos SQLite database
 #
 
+import array
+import bisect
 import datetime
 import os
 import re
 import sys
 
 import appledata.applexml as applexml
+import appledata.imagestore as imagestore
 import tilutil.imageutils as imageutils
 import tilutil.systemutils as su
 
@@ -104,48 +107,98 @@ def parse_face_rectangle(string_data):
 '''
 
 
+def _is_kind(image, has_original, is_movie):
+    """Tests if an image has (or does not have) an original, and is (or is not)
+    a movie, for the conditions that are set."""
+    if has_original is not None and bool(image.originalpath) != has_original:
+        return False
+    return is_movie is None or imageutils.is_movie_file(image.image_path) == is_movie
+
+
 class IPhotoData(object):
     """top level Photos data node."""
 
-    def __init__(self, photos_dict):
-        """# call with results of readAppleXML."""
-        self.data = photos_dict
+    def __init__(self, photos_dict, out_of_core=False, columnar=False):
+        """# call with results of readAppleXML.
 
-        self.albums = {}
+        Images are created the first time an album looks them up, so the
+        images of albums that are filtered out are never created (see
+        imagestore.LazyImageStore). If out_of_core is set, the image data is
+        kept in a temporary database on disk instead of in memory (see
+        imagestore.SqliteImageStore). Otherwise, if columnar is set, it is
+        kept in compact columns (see imagestore.ColumnarImageStore). In both
+        cases, images are created each time they are looked up.
 
+        photos_dict is not kept, so that the raw data can be released as soon
+        as the objects are built.
         """
-        self.face_albums = None
-        """
+        self._application_version = photos_dict.get("Application Version")
+        # Table of the image paths, see pathtable.PathTable.
+        self.paths = photos_dict.get("Path Table")
 
-        # Master map of keywords
-        self.keywords = self.data.get("List of Keywords")
+        self.albums = {}
+        # Reverse album index: ids of the albums that have an image, mapped by
+        # image id. Complete once the whole album list has been read.
+        self.album_ids_by_image = {}
 
-        self.face_names = {}  # Master map of faces
-        """
-        face_list = self.data.get("List of Faces")
-        if face_list:
-            for face_entry in face_list.values():
-                face_key = face_entry.get("key")
-                face_name = face_entry.get("name")
-                self.face_names[face_key] = face_name
-                # Other keys in face_entry: image, key image face index,
-                # PhotoCount, Order
-        """
+        self.face_albums = None
 
-        self.images_by_id = {}
-        image_data = self.data.get("Master Image List")
+        # Master map of keywords
+        self.keywords = photos_dict.get("List of Keywords") or {}
+        # Inverted keyword index: ids of the images with a keyword, mapped by
+        # keyword name.
+        self.image_ids_by_keyword = {}
+
+        # Master map of faces (named persons), and ids of the images with a
+        # face, mapped by face name. Several persons can share a name.
+        self.face_names = photos_dict.get("List of Faces") or {}
+        self.image_ids_by_face = {}
+        for face_key, image_ids in (photos_dict.get("Face Images") or {}).iteritems():
+            face_name = self.face_names.get(face_key)
+            if face_name in self.image_ids_by_face:
+                self.image_ids_by_face[face_name] = (
+                    self.image_ids_by_face[face_name] | image_ids)
+            elif face_name:
+                self.image_ids_by_face[face_name] = image_ids
+
+        # The album list is either materialized or an iterator streaming from
+        # the database. Images are only created when an album (or a keyword
+        # or face lookup) asks for them, see imagestore.
+        if out_of_core:
+            self.images_by_id = imagestore.SqliteImageStore(self._make_image)
+        elif columnar:
+            self.images_by_id = imagestore.ColumnarImageStore(self._make_image, self.paths)
+        else:
+            self.images_by_id = imagestore.LazyImageStore(self._make_image)
+        # Date index: POSIX time stamps of the images with a date, in
+        # ascending order, and the ids of these images in the same order.
+        # Built by the first select() with a date, see _build_date_index().
+        self._date_stamps = None
+        self._date_ids = None
+        image_data = photos_dict.get("Master Image List")
         if image_data:
-            for key in image_data:
-                image = IPhotoImage(key, image_data.get(key), self.keywords,
-                                    self.face_names)
-                self.images_by_id[key] = image
-
-        album_data = self.data.get("List of Albums")
+            if isinstance(image_data, dict):
+                image_data = image_data.iteritems()
+            for key, data in image_data:
+                self.images_by_id.add(key, data)
+                for keyword_id in data.get("Keywords") or ():
+                    keyword = self.keywords.get(keyword_id)
+                    if not keyword:
+                        continue
+                    image_ids = self.image_ids_by_keyword.get(keyword)
+                    if image_ids is None:
+                        image_ids = set()
+                        self.image_ids_by_keyword[keyword] = image_ids
+                    image_ids.add(key)
+
+        # Folder tree, mapped by folder uuid.
+        self.folders = _build_folder_tree(photos_dict.get("List of Folders") or [])
 
         self.root_album = IPhotoContainer("", "Root", None, None)
-        for data in album_data:
-            album = IPhotoAlbum(data, self.images_by_id, self.albums, self.root_album)
-            self.albums[album.albumid] = album
+        self._album_stream = iter(photos_dict.get("List of Albums"))
+        if isinstance(photos_dict.get("List of Albums"), list):
+            while self._load_next_album():
+                pass
 
         """
         self.images_by_base_name = None
@@ -174,14 +227,183 @@ class IPhotoData(object):
             other_image_list.append(image)
     '''
 
+    def _make_image(self, key, data):
+        """Creates the image for an entry of the image list."""
+        return IPhotoImage(key, data, self.keywords, self.face_names, self.paths)
+
+    def _load_next_album(self):
+        """Loads the next album from the album list. Returns False if there are
+        no more albums to load."""
+        if self._album_stream is None:
+            return False
+        try:
+            data = next(self._album_stream)
+        except StopIteration:
+            self._album_stream = None
+            return False
+        album = IPhotoAlbum(data, self.images_by_id, self.albums, self.root_album,
+                            self.folders)
+        self.albums[album.albumid] = album
+        self._index_album(album)
+        return True
+
+    def _index_album(self, album):
+        """Adds the images of an album to the reverse album index."""
+        for image_id in album.image_ids:
+            album_ids = self.album_ids_by_image.get(image_id)
+            if album_ids is None:
+                album_ids = set()
+                self.album_ids_by_image[image_id] = album_ids
+            album_ids.add(album.albumid)
+
+    def streamalbums(self):
+        """Yields the albums of a streamed album list without keeping them, so
+        that only one album is in memory at a time. Albums read this way are
+        not part of the album tree, nor of the reverse album index."""
+        while self._album_stream is not None:
+            try:
+                data = next(self._album_stream)
+            except StopIteration:
+                self._album_stream = None
+                return
+            album = IPhotoAlbum(data, self.images_by_id, self.albums, None, self.folders)
+            yield album
+
+    def close(self):
+        """Releases the database of a streamed library, and the image store.
+        Albums not read yet are not read any more."""
+        if self._album_stream is not None:
+            # Closing the generator closes its database connection, see
+            # applexml.stream_apple_library.
+            close = getattr(self._album_stream, 'close', None)
+            if close is not None:
+                close()
+            self._album_stream = None
+        self.images_by_id.close()
+
+    def iteralbums(self):
+        """Yields the top level albums, loading them as they are read from a
+        streamed album list."""
+        i = 0
+        while i < len(self.root_album.albums) or self._load_next_album():
+            yield self.root_album.albums[i]
+            i += 1
+
     def _getapplicationversion(self):
-        return self.data.get("Application Version")
+        return self._application_version
     applicationVersion = property(_getapplicationversion, doc='Photos library version')
 
     def _getimages(self):
         return self.images_by_id.values()
     images = property(_getimages, doc="List of images")
 
+    def select(self, date_from=None, date_to=None, albums=None, folders=None,
+               has_original=None, is_movie=None):
+        """Returns the ids of the images that were taken at or after date_from
+        and before date_to, in date order, using the date index. Images without
+        a date are only selected if neither date is set.
+
+        If albums or folders are set, only the images in these albums, or in
+        the albums of these folders and their subfolders, are selected. If
+        has_original or is_movie are set, only the images that have (or do not
+        have) an original, or that are (or are not) movies, are selected. A
+        columnar store tests these on its columns, other stores create the
+        images to test them.
+        """
+        if date_from is None and date_to is None:
+            image_ids = list(self.images_by_id.iterkeys())
+        else:
+            self._build_date_index()
+            start = 0
+            if date_from is not None:
+                start = bisect.bisect_left(self._date_stamps,
+                                           applexml.getposixstamp(date_from))
+            end = len(self._date_stamps)
+            if date_to is not None:
+                end = bisect.bisect_left(self._date_stamps,
+                                         applexml.getposixstamp(date_to))
+            image_ids = self._date_ids[start:end].tolist()
+        if albums is not None or folders is not None:
+            contained_ids = self._getcontainedimageids(albums or (), folders or ())
+            image_ids = [image_id for image_id in image_ids if image_id in contained_ids]
+        if has_original is not None or is_movie is not None:
+            if hasattr(self.images_by_id, 'select_ids'):
+                kind_ids = set(self.images_by_id.select_ids(has_original=has_original,
+                                                            is_movie=is_movie))
+                image_ids = [image_id for image_id in image_ids if image_id in kind_ids]
+            else:
+                image_ids = [image_id for image_id in image_ids
+                             if _is_kind(self.images_by_id[image_id], has_original,
+                                         is_movie)]
+        return image_ids
+
+    def _build_date_index(self):
+        """Builds the date index from the time stamps of the image store, if
+        not built yet. Most exports select no dates, and never need it."""
+        if self._date_stamps is not None:
+            return
+        image_ids = array.array('l')
+        def get_dated_stamps():
+            """Yields the time stamps of the images with a date, noting their
+            ids."""
+            for image_id, stamp in self.images_by_id.itertimes():
+                if stamp is not None:
+                    image_ids.append(image_id)
+                    yield stamp
+        # The whole column is converted at once.
+        stamps = applexml.appletimestamps(get_dated_stamps())
+        # Bad time stamps (NaN) cannot be sorted, and are in no date range.
+        rows = sorted((row for row in xrange(len(stamps)) if stamps[row] == stamps[row]),
+                      key=stamps.__getitem__)
+        self._date_stamps = array.array('d', (stamps[row] for row in rows))
+        self._date_ids = array.array('l', (image_ids[row] for row in rows))
+
+    def _getcontainedimageids(self, albums, folders):
+        """Returns the set of ids of the images in albums, or in the albums of
+        folders and their subfolders."""
+        image_ids = set()
+        for album in albums:
+            image_ids.update(album.image_ids)
+        if folders:
+            folders = set(folders)
+            while self._load_next_album():
+                pass
+            for album in self.albums.itervalues():
+                folder = album.folder
+                while folder is not None and folder not in folders:
+                    folder = folder.parent
+                if folder is not None:
+                    image_ids.update(album.image_ids)
+        return image_ids
+
+    def getimagealbumids(self, image_id):
+        """Returns the set of ids of the albums loaded so far that have an
+        image. Albums from streamalbums() are not counted."""
+        return self.album_ids_by_image.get(image_id, frozenset())
+
+    def getimagealbums(self, image_id):
+        """Returns the albums that have an image, reading the rest of a
+        streamed album list first."""
+        while self._load_next_album():
+            pass
+        return [self.albums[album_id] for album_id in
+                sorted(self.getimagealbumids(image_id)) if album_id in self.albums]
+
+    def getkeywordimages(self, keyword):
+        """Returns the images with a keyword."""
+        return [self.images_by_id[image_id]
+                for image_id in self.image_ids_by_keyword.get(keyword, ())]
+
+    def getfacealbums(self):
+        """Returns the albums for faces, one per face name."""
+        if self.face_albums is None:
+            # Build the albums on first call
+            self.face_albums = {}
+            for face_name, image_ids in self.image_ids_by_face.iteritems():
+                self.face_albums[face_name] = IPhotoFace(face_name, image_ids,
+                                                         self.images_by_id)
+        return self.face_albums.values()
+
     '''
     def _getrolls(self):
         return self._rolls.values()
@@ -278,23 +500,6 @@ class IPhotoData(object):
         for message in messages:
             print message
 
-    def getfacealbums(self):
-        """Returns a map of albums for faces."""
-        if self.face_albums:
-            return self.face_albums.values()
-
-        # Build the albums on first call
-        self.face_albums = {}
-
-        for image in self.images:
-            for face in image.getfaces():
-                face_album = self.face_albums.get(face)
-                if not face_album:
-                    face_album = IPhotoFace(face)
-                    self.face_albums[face] = face_album
-                face_album.addimage(image)
-        return self.face_albums.values()
-
 
     def print_summary(self):
         named_rolls = {}
@@ -317,9 +522,14 @@ _CAPTION_PATTERN = re.compile(
 class IPhotoImage(object):
     """Describes an image in the Photos database."""
 
-    def __init__(self, key, data, keyword_map, face_map):
-        '''
+    # There is one image object per image of the library, keep them small.
+    __slots__ = ('id', '_caption', '_time', '_date', 'mod_time', '_paths',
+                 '_image_path', 'keywords', '_original_path', 'event_name',
+                 'event_index', 'event_index0')
+
+    def __init__(self, key, data, keyword_map, face_map, paths):
         self.id = key
+        '''
         self.data = data
         '''
         self._caption = su.nn_string(data.get("Caption")).strip()
@@ -327,9 +537,12 @@ class IPhotoImage(object):
         self.comment = su.nn_string(data.get("Comment")).strip()
         '''
 
-        self.date = None
-        if "ImageDate" in data:
-            self.date = data.get("ImageDate")
+        # Apple time stamp of the image, converted into self.date on demand.
+        self._time = data.get("ImageTime")
+        self._date = None
+        # Apple time stamp of the last change of the image or its files, or
+        # None if unknown.
+        self.mod_time = data.get("ModDateAsTimerInterval")
         '''
         else:
             # Try to get the date from a the caption in "YYYYMMDD ..." format
@@ -354,7 +567,10 @@ class IPhotoImage(object):
                 self.mod_Date = None
         '''
 
-        self.image_path = data.get("ImagePath")
+        # Paths are ids in the path table of the library, and are only turned
+        # into full paths when asked for.
+        self._paths = paths
+        self._image_path = data.get("ImagePath")
 
         '''
         if data.has_key("Rating"):
@@ -367,15 +583,17 @@ class IPhotoImage(object):
             self.gps = imageutils.GpsLocation(latitude, longitude)
         else:
             self.gps = None
+        '''
 
         self.keywords = []
         keyword_list = data.get("Keywords")
         if keyword_list is not None:
             for i in keyword_list:
-                self.keywords.append(keyword_map.get(i))
-        '''
+                keyword = keyword_map.get(i)
+                if keyword:
+                    self.keywords.append(keyword)
 
-        self.originalpath = data.get("OriginalPath")
+        self._original_path = data.get("OriginalPath")
 
         '''
         self.roll = data.get("Roll") 
@@ -427,10 +645,20 @@ class IPhotoImage(object):
         return self.image_path
     '''
 
+    def _getimagepath(self):
+        return self._paths.getpath(self._image_path)
+    image_path = property(_getimagepath, doc="Full path of the image file")
+
+    def _getoriginalpath(self):
+        if self._original_path is None:
+            return None
+        return self._paths.getpath(self._original_path)
+    originalpath = property(_getoriginalpath,
+                            doc="Full path of the original file, or None if not edited")
+
     def getimagename(self):
         """Returns the file name of this image.."""
-        name = os.path.split(self.image_path)[1]
-        return name
+        return self._paths.getname(self._image_path)
 
     '''
     def getbasename(self):
@@ -438,6 +666,17 @@ class IPhotoImage(object):
         return su.getfilebasename(self.image_path)
     '''
 
+    def _getdate(self):
+        if self._date is None:
+            self._date = applexml.getappletime(self._time)
+        return self._date
+    date = property(_getdate, doc="Date of the image")
+
+    def _gettimestamp(self):
+        return self._time
+    time_stamp = property(_gettimestamp,
+                          doc="Apple time stamp of the date of the image, or None")
+
     def _getcaption(self):
         if not self._caption:
             return self.getimagename()
@@ -485,9 +724,71 @@ class IPhotoImage(object):
     '''
 
 
+# Time stamp of containers without a date.
+_NO_TIME = object()
+
+# Number of missing image ids listed in the message of an album.
+_MAX_REPORTED_IDS = 10
+
+
+def _build_folder_tree(folder_list):
+    """Builds the IPhotoFolder tree of a list of folder dictionaries, and
+    returns its folders mapped by uuid."""
+    folder_data_by_id = {}
+    for folder_data in folder_list:
+        folder_data_by_id[folder_data.get("FolderId")] = folder_data
+
+    folders_by_id = {}
+    def get_folder(folder_id):
+        """Returns the folder with this id, creating it and its parents."""
+        folder = folders_by_id.get(folder_id)
+        if folder is None:
+            folder_data = folder_data_by_id[folder_id]
+            parent_id = folder_data.get("ParentId")
+            parent = get_folder(parent_id) if parent_id is not None else None
+            folder = IPhotoFolder(folder_data, parent)
+            folders_by_id[folder_id] = folder
+        return folder
+
+    folders = {}
+    for folder_data in folder_list:
+        folders[folder_data.get("FolderUuid")] = get_folder(folder_data.get("FolderId"))
+    return folders
+
+
+class IPhotoFolder(object):
+    """A Photos folder, a node of the tree of folders albums are kept in."""
+
+    __slots__ = ('name', 'folderid', 'parent', '_names', '_path')
+
+    def __init__(self, data, parent):
+        self.name = data.get("FolderName")
+        self.folderid = data.get("FolderId")
+        self.parent = parent
+        self._names = None
+        self._path = None
+
+    def _getnames(self):
+        if self._names is None:
+            parent_names = self.parent.names if self.parent else ()
+            self._names = parent_names + (self.name,)
+        return self._names
+    names = property(_getnames, doc='Names of the folders down to this folder.')
+
+    def _getpath(self):
+        if self._path is None:
+            parent_path = self.parent.path if self.parent else ''
+            self._path = os.path.join(parent_path, self.name)
+        return self._path
+    path = property(_getpath, doc='Path of folder names down to this folder, like "a/b/c".')
+
+
 class IPhotoContainer(object):
     """Base class for IPhotoAlbum and IPhotoRoll."""
 
+    __slots__ = ('name', 'albumtype', 'folder', 'albums', '_time', 'image_ids',
+                 '_keylist', '_images_by_id', '_images')
+
     def __init__(self, name, albumtype, data, images):
         self.name = name
 
@@ -508,34 +809,32 @@ class IPhotoContainer(object):
         if not albumtype:
             su.pout(u'No album type for %s.' % name)
         self.albumtype = albumtype
-        self.data = data
+        self.folder = None
+        # Apple time stamp of the container, converted into self.date on
+        # demand. The data itself is not kept.
+        self._time = _NO_TIME
+        if data and "AlbumTime" in data:
+            self._time = data.get("AlbumTime")
 
         '''
         self.albumid = -1
         '''
 
-        self.images = []
         self.albums = []
 
         '''
         self.master = False
         '''
 
-        hidden = 0
+        # The images are looked up on first use (see _getimages), so that the
+        # images of albums that are never exported are never created. The set
+        # of their ids answers membership tests without any lookup.
+        self._keylist = None
         if data and ("KeyList" in data):
-            keylist = data.get("KeyList")
-            for key in keylist:
-                if not key:
-                    continue
-                image = images.get(key)
-                if image:
-                    self.images.append(image)
-                else:
-                    hidden += 1
-                    su.pout(u"%s: image with id %s does not exist - could be hidden." % (name, key))
-        
-        if hidden:
-            su.pout(u"%s: %d images not exported (probably hidden)." % (name, hidden))
+            self._keylist = [key for key in data.get("KeyList") if key]
+        self.image_ids = frozenset(self._keylist or ())
+        self._images_by_id = images
+        self._images = None
 
         '''
         self._assign_names()
@@ -564,8 +863,36 @@ class IPhotoContainer(object):
     size = property(_getsize, "Gets the size (# of images) of this album.")
     '''
 
+    def _getimages(self):
+        if self._images is None:
+            self._images = []
+            hidden = []
+            for key in self._keylist or ():
+                image = self._images_by_id.get(key)
+                if image:
+                    self._images.append(image)
+                else:
+                    hidden.append(key)
+            if hidden:
+                # One line per album, however many images are missing.
+                ids = u', '.join(unicode(key) for key in hidden[:_MAX_REPORTED_IDS])
+                if len(hidden) > _MAX_REPORTED_IDS:
+                    ids += u', ...'
+                su.pout(u"%s: %d images not exported (probably hidden): ids %s." % (
+                    self.name, len(hidden), ids))
+            self._keylist = None
+            self._images_by_id = None
+        return self._images
+    images = property(_getimages, doc="Images of this container, looked up on first use.")
+
+    def hasimage(self, image):
+        """Tests if an image is in this container."""
+        return image.id in self.image_ids
+
     def getfolderhint(self):
-        return self.data['FolderPath']
+        if self.folder is None:
+            return None
+        return self.folder.path
 
     '''
     def getcommentwithouthints(self):
@@ -583,7 +910,9 @@ class IPhotoContainer(object):
         self.albums.append(album)
 
     def _getdate(self):
-        return self.data.get("AlbumDate")
+        if self._time is _NO_TIME:
+            return None
+        return applexml.getappletime(self._time)
     date = property(_getdate, doc='date of container (based on oldest image)')
 
     '''
@@ -619,36 +948,55 @@ class IPhotoContainer(object):
 class IPhotoAlbum(IPhotoContainer):
     """Describes an Photos Album."""
 
-    def __init__(self, data, images, album_map, root_album):
+    __slots__ = ('albumid', 'master', 'parent')
+
+    def __init__(self, data, images, album_map, root_album, folders):
         IPhotoContainer.__init__(self, data.get("AlbumName"),
                                  data.get("Album Type") if ("Album Type" in data) else "Regular",
                                  data, images)
         self.albumid = data.get("AlbumId")
+        self.folder = folders.get(data.get("FolderUuid"))
 
         # TODO NO SE QUE SIGNIFICA ESTA PROPIEDAD "MASTER"
         if data.has_key("Master"):
             self.master = True
 
         self.parent = root_album
-        self.parent.addalbum(self)
+        if root_album is not None:
+            self.parent.addalbum(self)
 
 
-'''
 class IPhotoFace(object):
     """An IPhotoContainer compatible class for a face."""
 
-    def __init__(self, face):
+    __slots__ = ('name', 'albumtype', 'albumid', 'folder', 'image_ids',
+                 '_images_by_id', 'albums', 'comment', '_date')
+
+    def __init__(self, face, image_ids, images_by_id):
         self.name = face
         self.albumtype = "Face"
         self.albumid = -1
-        self.images = []
+        self.folder = None
+        # Set of the ids of the images with this face.
+        self.image_ids = image_ids
+        self._images_by_id = images_by_id
         self.albums = []
         self.comment = ""
-        self.date = datetime.datetime.now()
+        self._date = None
+
+    def _getimages(self):
+        # Not kept, so that face albums take no memory until they are exported.
+        images = []
+        for image_id in sorted(self.image_ids):
+            image = self._images_by_id.get(image_id)
+            if image is not None:
+                images.append(image)
+        return images
+    images = property(_getimages, doc="Images with this face.")
 
     def _getsize(self):
         return len(self.images)
-    size = property(_getsize, "Gets the size (# of images) of this album.")
+    size = property(_getsize, doc="Gets the size (# of images) of this album.")
 
     def getfolderhint(self):
         """Gets a suggested folder name from comments."""
@@ -658,28 +1006,57 @@ class IPhotoFace(object):
         """Gets the image comments, with any folder hint lines removed"""
         return ""
 
-    def addimage(self, image):
-        """Adds an image to this container."""
-        self.images.append(image)
-        # Set the face date based on the earlierst image.
-        if image.date and image.date < self.date:
-            self.date = image.date
+    def hasimage(self, image):
+        """Tests if an image has this face."""
+        return image.id in self.image_ids
+
+    def _getdate(self):
+        # The face date is the date of the earliest image.
+        if self._date is None:
+            self._date = datetime.datetime.now()
+            for image in self.images:
+                if image.date and image.date < self._date:
+                    self._date = image.date
+        return self._date
+    date = property(_getdate, doc='date of face (based on oldest image)')
 
     def tostring(self):
         """Gets a string that describes this album or event."""
         return "%s (%s)" % (self.name, self.albumtype)
-'''
 
-def get_iphoto_data(photos_library_dir, verbose=False):
-    """reads the Photos database and converts it into an iPhotoData object."""
+
+def get_iphoto_data(photos_library_dir, verbose=False, snapshot_file=None,
+                    album_filter=None, folder_filter=None, in_memory=False,
+                    concurrent=False, out_of_core=False, columnar=False):
+    """reads the Photos database and converts it into an iPhotoData object.
+
+    If snapshot_file is set, only the images and albums that changed since the
+    snapshot was saved are read from the database, and if concurrent is set,
+    the databases are read on separate threads (see
+    applexml.read_apple_library). Otherwise, album_filter and folder_filter
+    restrict the load to the matching albums and their images (see
+    applexml.stream_apple_library). If in_memory is set, the database is
+    copied to memory before it is queried (see applexml.copy_photos_library).
+
+    If out_of_core is set, the images are kept on disk (see IPhotoData), and
+    the library is always streamed, since snapshots and concurrent reads
+    load it into memory first. If columnar is set, the images are kept in
+    compact columns (see IPhotoData).
+    """
     if verbose:
         print "Reading %s database from %s..." % ('Photos', photos_library_dir)
 
-    photos_dict = applexml.read_apple_library(photos_library_dir)
+    if (snapshot_file or concurrent) and not out_of_core:
+        photos_dict = applexml.read_apple_library(photos_library_dir, snapshot_file,
+                                                  in_memory, concurrent)
+    else:
+        photos_dict = applexml.stream_apple_library(photos_library_dir, album_filter,
+                                                    folder_filter, in_memory)
 
-    data = IPhotoData(photos_dict)
+    data = IPhotoData(photos_dict, out_of_core, columnar)
 
     if data.applicationVersion != 477:
+        data.close()
         # Library version for El Capitan is 1021
         raise ValueError("Photos library version %s has not been tested and it's not supported" % (
             data.applicationVersion))
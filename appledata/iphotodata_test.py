@@ -17,6 +17,7 @@
 import unittest
 
 import appledata.iphotodata as iphotodata
+import appledata.pathtable as pathtable
 
 class IPhotoDataTest(unittest.TestCase):
     """Unit tests for iphotodata.py code."""
@@ -32,6 +33,181 @@ class IPhotoDataTest(unittest.TestCase):
         self.assertEquals([0.4, 0.4, 0.2, 0.2],
                           iphotodata.parse_face_rectangle('xxyy'))
 
+    def test_build_folder_tree(self):
+        """Tests iphotodata._build_folder_tree()."""
+        folders = iphotodata._build_folder_tree([
+            {'FolderUuid': 'c', 'FolderId': 23, 'FolderName': 'Europe', 'ParentId': 5},
+            {'FolderUuid': 'b', 'FolderId': 5, 'FolderName': 'Trips', 'ParentId': None},
+            {'FolderUuid': 'd', 'FolderId': 24, 'FolderName': 'Asia', 'ParentId': 5}])
+        self.assertEquals('Trips/Europe', folders['c'].path)
+        self.assertEquals(('Trips', 'Asia'), folders['d'].names)
+        self.assertTrue(folders['c'].parent is folders['b'])
+        self.assertTrue(folders['d'].parent is folders['b'])
+        self.assertEquals(None, folders['b'].parent)
+
+    def test_keyword_index(self):
+        """Tests the keyword index of IPhotoData."""
+        data = iphotodata.IPhotoData({
+            'List of Keywords': {1: u'Travel', 2: u'Food'},
+            'Master Image List': {
+                10: {'ImagePath': '/a.jpg', 'Keywords': [1]},
+                11: {'ImagePath': '/b.jpg', 'Keywords': [1, 2, 3]},
+                12: {'ImagePath': '/c.jpg', 'Keywords': []}},
+            'List of Albums': []})
+        self.assertEquals([u'Travel', u'Food'], data.images_by_id[11].keywords)
+        self.assertEquals([10, 11], sorted(image.id for image in
+                                           data.getkeywordimages(u'Travel')))
+        self.assertEquals([11], [image.id for image in data.getkeywordimages(u'Food')])
+        self.assertEquals([], data.getkeywordimages(u'None'))
+
+    def test_lazy_images(self):
+        """Tests that only the images of the albums in use are created."""
+        data = iphotodata.IPhotoData({
+            'Master Image List': {
+                10: {'ImagePath': '/a.jpg'},
+                11: {'ImagePath': '/b.jpg'}},
+            'List of Albums': [
+                {'AlbumName': u'One', 'KeyList': [10, 12]},
+                {'AlbumName': u'Two', 'KeyList': [11]}]})
+        self.assertEquals(0, data.images_by_id.getcreatedcount())
+        albums = dict((album.name, album) for album in data.root_album.albums)
+        self.assertEquals([10], [image.id for image in albums[u'One'].images])
+        self.assertEquals(1, data.images_by_id.getcreatedcount())
+        self.assertTrue(albums[u'One'].images[0] is data.images_by_id[10])
+
+    def test_album_index(self):
+        """Tests the reverse album index and album membership."""
+        data = iphotodata.IPhotoData({
+            'Master Image List': {
+                10: {'ImagePath': '/a.jpg'},
+                11: {'ImagePath': '/b.jpg'}},
+            'List of Albums': [
+                {'AlbumId': 1, 'AlbumName': u'One', 'KeyList': [10, 11, 12]},
+                {'AlbumId': 2, 'AlbumName': u'Two', 'KeyList': [11]}]})
+        self.assertEquals(set([1, 2]), data.getimagealbumids(11))
+        self.assertEquals(set([1]), data.getimagealbumids(12))
+        self.assertEquals(set(), data.getimagealbumids(13))
+        self.assertEquals([u'One', u'Two'],
+                          [album.name for album in data.getimagealbums(11)])
+        self.assertTrue(data.albums[2].hasimage(data.images_by_id[11]))
+        self.assertFalse(data.albums[2].hasimage(data.images_by_id[10]))
+        self.assertEquals(frozenset([11]), data.albums[1].image_ids & data.albums[2].image_ids)
+
+    def test_stream_albums(self):
+        """Tests that streamed albums are not kept, nor indexed."""
+        data = iphotodata.IPhotoData({
+            'Master Image List': {
+                10: {'ImagePath': '/a.jpg'},
+                11: {'ImagePath': '/b.jpg'}},
+            'List of Albums': iter([
+                {'AlbumId': 1, 'AlbumName': u'One', 'KeyList': [10, 11]},
+                {'AlbumId': 2, 'AlbumName': u'Two', 'KeyList': [11]}])})
+        self.assertEquals([u'One', u'Two'], [album.name for album in data.streamalbums()])
+        self.assertEquals({}, data.albums)
+        self.assertEquals({}, data.album_ids_by_image)
+        self.assertEquals(set(), data.getimagealbumids(11))
+
+    def test_close(self):
+        """Tests that closing the data closes a streamed album list that was
+        not read."""
+        conn = iphotodata.applexml.sqlite3.connect(':memory:')
+        data = iphotodata.IPhotoData({
+            'Master Image List': {10: {'ImagePath': '/a.jpg'}},
+            'List of Albums': iphotodata.applexml._ClosingIterator(
+                iter([{'AlbumId': 1, 'AlbumName': u'One', 'KeyList': [10]}]), conn)})
+        data.close()
+        self.assertRaises(iphotodata.applexml.sqlite3.ProgrammingError, conn.execute,
+                          'select 1')
+        self.assertEquals([], list(data.streamalbums()))
+
+    def test_select(self):
+        """Tests IPhotoData.select()."""
+        data = iphotodata.IPhotoData({
+            'List of Folders': [
+                {'FolderUuid': 'b', 'FolderId': 5, 'FolderName': 'Trips', 'ParentId': None},
+                {'FolderUuid': 'c', 'FolderId': 23, 'FolderName': 'Europe', 'ParentId': 5}],
+            'Master Image List': {
+                10: {'ImageTime': 300000000.0},
+                11: {'ImageTime': 100000000.0},
+                12: {'ImageTime': 200000000.0},
+                13: {'ImageTime': None}},
+            'List of Albums': [
+                {'AlbumId': 1, 'AlbumName': u'One', 'KeyList': [10, 11], 'FolderUuid': 'c'},
+                {'AlbumId': 2, 'AlbumName': u'Two', 'KeyList': [12, 13]}]})
+        date = iphotodata.applexml.getappletime
+        self.assertEquals([10, 11, 12, 13], data.select())
+        self.assertEquals([11, 12, 10], data.select(date_from=date(0.0)))
+        self.assertEquals([12, 10], data.select(date_from=date(200000000.0)))
+        self.assertEquals([11], data.select(date_to=date(200000000.0)))
+        self.assertEquals([], data.select(date(300000001.0), date(400000000.0)))
+        self.assertEquals([12, 13], data.select(albums=[data.albums[2]]))
+        self.assertEquals([11, 10], data.select(date(0.0), folders=[data.folders['b']]))
+
+    def test_date_index(self):
+        """Tests that the date index is only built for selections by date, from
+        each kind of image store."""
+        for kind in ('lazy', 'out_of_core', 'columnar'):
+            paths = pathtable.PathTable(u'/lib')
+            data = iphotodata.IPhotoData({
+                'Path Table': paths,
+                'Master Image List': {
+                    10: {'ImagePath': paths.add(u'a.jpg'), 'ImageTime': 300000000.0},
+                    11: {'ImagePath': paths.add(u'b.jpg'), 'ImageTime': 100000000.0},
+                    12: {'ImagePath': paths.add(u'c.jpg'), 'ImageTime': None}},
+                'List of Albums': []},
+                                          out_of_core=kind == 'out_of_core',
+                                          columnar=kind == 'columnar')
+            self.assertEquals([10, 11, 12], data.select())
+            self.assertEquals(None, data._date_stamps)
+            # Images created before the index is built still count.
+            self.assertEquals(10, data.images_by_id[10].id)
+            date = iphotodata.applexml.getappletime
+            self.assertEquals([11, 10], data.select(date_from=date(0.0)))
+            self.assertEquals([11, 10], data._date_ids.tolist())
+            data.images_by_id.close()
+
+    def test_select_kinds(self):
+        """Tests selecting images with an original, or movies, in both kinds of
+        image stores."""
+        for columnar in (False, True):
+            paths = pathtable.PathTable(u'/lib')
+            data = iphotodata.IPhotoData({
+                'Path Table': paths,
+                'Master Image List': {
+                    10: {'ImagePath': paths.add(u'a.jpg'), 'ImageTime': 300000000.0,
+                         'OriginalPath': paths.add(u'o/a.jpg')},
+                    11: {'ImagePath': paths.add(u'b.mov'), 'ImageTime': 100000000.0},
+                    12: {'ImagePath': paths.add(u'c.jpg'), 'ImageTime': 200000000.0},
+                    13: {'ImagePath': paths.add(u'd.jpg'), 'ImageTime': None}},
+                'List of Albums': [
+                    {'AlbumId': 1, 'AlbumName': u'One', 'KeyList': [10, 11, 13]}]},
+                                          columnar=columnar)
+            date = iphotodata.applexml.getappletime
+            self.assertEquals([10], data.select(has_original=True))
+            self.assertEquals([11, 12, 13], data.select(has_original=False))
+            self.assertEquals([11], data.select(is_movie=True))
+            self.assertEquals([12, 10], data.select(date(150000000.0), is_movie=False))
+            self.assertEquals([12], data.select(date(150000000.0), date(300000000.0),
+                                                has_original=False))
+            self.assertEquals([13], data.select(albums=[data.albums[1]], has_original=False,
+                                                is_movie=False))
+
+    def test_getfacealbums(self):
+        """Tests IPhotoData.getfacealbums()."""
+        data = iphotodata.IPhotoData({
+            'List of Faces': {1: u'Alice', 2: u'Bob', 3: u'Alice'},
+            'Face Images': {1: set([10]), 2: set([11, 99]), 3: set([11])},
+            'Master Image List': {
+                10: {'ImagePath': '/a.jpg'},
+                11: {'ImagePath': '/b.jpg'}},
+            'List of Albums': []})
+        face_albums = dict((face.name, face) for face in data.getfacealbums())
+        self.assertEquals([u'Alice', u'Bob'], sorted(face_albums))
+        self.assertEquals([10, 11], [image.id for image in face_albums[u'Alice'].images])
+        self.assertEquals([11], [image.id for image in face_albums[u'Bob'].images])
+        self.assertTrue(face_albums[u'Bob'].hasimage(data.images_by_id[11]))
+        self.assertFalse(face_albums[u'Bob'].hasimage(data.images_by_id[10]))
+
 
 if __name__ == '__main__':
     unittest.main()
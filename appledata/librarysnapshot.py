@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+'''Persists the rows read from a Photos library between runs.
+
+A snapshot holds the folder, image and album rows of the last load, including
+the columns that tell when they were last changed, so that the next load only
+needs to read what changed since then. It also records the identity of the
+database files, so that a load from unchanged files needs no query at all.
+'''
+
+# Copyright 2017 Benjamín Valero
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import marshal
+import os
+
+import tilutil.systemutils as su
+
+# Bump when the layout of the stored rows changes, to discard old snapshots.
+_SNAPSHOT_FORMAT = 5
+
+
+def get_files_identity(file_paths):
+    """Returns a value that changes whenever one of the files changes: their
+    sizes, modification times and inodes. Missing files count as None."""
+    identity = []
+    for file_path in file_paths:
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            identity.append(None)
+            continue
+        identity.append((file_stat.st_size, file_stat.st_mtime, file_stat.st_ino))
+    return identity
+
+
+def load_snapshot(snapshot_file, photos_library_dir):
+    """Loads the snapshot stored for a library.
+
+    Returns:
+      The snapshot dictionary, or None if there is no usable snapshot for
+      this library.
+    """
+    if not os.path.exists(snapshot_file):
+        return None
+    try:
+        with open(snapshot_file, 'rb') as f:
+            snapshot = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError) as ex:
+        su.pout(u'Ignoring library snapshot %s: %s' % (snapshot_file, ex))
+        return None
+    if (not isinstance(snapshot, dict) or
+            snapshot.get('format') != _SNAPSHOT_FORMAT or
+            snapshot.get('library') != su.unicode_string(photos_library_dir)):
+        return None
+    return snapshot
+
+
+def save_snapshot(snapshot_file, photos_library_dir, snapshot):
+    """Saves the snapshot of a library, replacing any previous one."""
+    snapshot['format'] = _SNAPSHOT_FORMAT
+    snapshot['library'] = su.unicode_string(photos_library_dir)
+    snapshot_folder = os.path.split(snapshot_file)[0]
+    temp_file = snapshot_file + '.tmp'
+    try:
+        if snapshot_folder and not os.path.exists(snapshot_folder):
+            os.makedirs(snapshot_folder)
+        with open(temp_file, 'wb') as f:
+            marshal.dump(snapshot, f)
+        os.rename(temp_file, snapshot_file)
+    except (IOError, OSError, ValueError) as ex:
+        su.pout(u'Could not save library snapshot %s: %s' % (snapshot_file, ex))
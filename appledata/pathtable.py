@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+'''Keeps the file paths of a Photos library in compact form.
+
+The library root is stored once, and each directory below it once, as a name
+and the id of its parent directory. A file path is then a directory id and a
+file name, and is only turned into a full path when asked for.
+'''
+
+# Copyright 2017 Benjamín Valero
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import array
+import os
+
+# Directory id of the root.
+_ROOT = -1
+
+
+class PathTable(object):
+    """A table of file paths below a root directory, each one known by an id."""
+
+    def __init__(self, root):
+        """Creates an empty table for the paths below root."""
+        self.root = root
+        # Name and parent directory id of each directory.
+        self._dir_names = []
+        self._dir_parents = array.array('l')
+        # Directory ids, mapped by (parent directory id, name).
+        self._dir_ids = {}
+        # Directory id and file name of each path.
+        self._path_dirs = array.array('l')
+        self._path_names = []
+
+    def _get_dir_id(self, parent_id, name):
+        """Returns the id of a directory, adding it if needed."""
+        key = (parent_id, name)
+        dir_id = self._dir_ids.get(key)
+        if dir_id is None:
+            dir_id = len(self._dir_names)
+            self._dir_names.append(name)
+            self._dir_parents.append(parent_id)
+            self._dir_ids[key] = dir_id
+        return dir_id
+
+    def add(self, path):
+        """Adds a path and returns its id.
+
+        Args:
+          path: path relative to the root, or an absolute path (which, like with
+              os.path.join(), does not get the root).
+        """
+        directory, name = os.path.split(path)
+        dir_id = _ROOT
+        if os.path.isabs(directory):
+            dir_id = self._get_dir_id(dir_id, os.sep)
+        for part in directory.split(os.sep):
+            if part:
+                dir_id = self._get_dir_id(dir_id, part)
+        self._path_dirs.append(dir_id)
+        self._path_names.append(name)
+        return len(self._path_names) - 1
+
+    def _getdirparts(self, dir_id):
+        """Returns the names of a directory and its parents, root first."""
+        parts = []
+        while dir_id != _ROOT:
+            parts.append(self._dir_names[dir_id])
+            dir_id = self._dir_parents[dir_id]
+        parts.reverse()
+        return parts
+
+    def getrelpath(self, path_id):
+        """Returns a path relative to the root (or absolute if it was added as
+        an absolute path)."""
+        parts = self._getdirparts(self._path_dirs[path_id])
+        parts.append(self._path_names[path_id])
+        return os.path.join(*parts)
+
+    def getpath(self, path_id):
+        """Returns the full path of a path id."""
+        return os.path.join(self.root, self.getrelpath(path_id))
+
+    def getname(self, path_id):
+        """Returns the file name of a path id."""
+        return self._path_names[path_id]
+
+    def __len__(self):
+        return len(self._path_names)
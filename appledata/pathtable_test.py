@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""This module tests pathtable.py."""
+
+# Copyright 2017 Benjamín Valero
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+
+import appledata.pathtable as pathtable
+
+class PathTableTest(unittest.TestCase):
+    """Unit tests for pathtable.py code."""
+
+    def test_paths(self):
+        """Tests that paths come back as they were added."""
+        paths = pathtable.PathTable(u'/lib')
+        a = paths.add(u'Masters/2016/a.jpg')
+        b = paths.add(u'Masters/2016/b.jpg')
+        c = paths.add(u'c.jpg')
+        d = paths.add(u'/Volumes/Disk/d.jpg')
+        self.assertEquals(4, len(paths))
+        self.assertEquals(u'/lib/Masters/2016/a.jpg', paths.getpath(a))
+        self.assertEquals(u'Masters/2016/b.jpg', paths.getrelpath(b))
+        self.assertEquals(u'/lib/c.jpg', paths.getpath(c))
+        self.assertEquals(u'/Volumes/Disk/d.jpg', paths.getpath(d))
+        self.assertEquals(u'b.jpg', paths.getname(b))
+
+    def test_shared_directories(self):
+        """Tests that each directory is stored once."""
+        paths = pathtable.PathTable(u'/lib')
+        paths.add(u'resources/1/2/x.jpg')
+        paths.add(u'resources/1/3/y.jpg')
+        self.assertEquals([u'resources', u'1', u'2', u'3'], paths._dir_names)
+
+
+if __name__ == '__main__':
+    unittest.main()
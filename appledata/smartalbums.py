@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+'''Evaluates Photos smart albums in SQL.
+
+A smart album keeps its conditions in RKAlbum.filterData, a property list
+holding an NSPredicate archived by NSKeyedArchiver. compile_filter() decodes
+it and turns it into a condition on the masters (m) and versions (v) of the
+library, so that SQLite selects the images of the album with the indexes of
+the database, and no image is looked at in Python.
+
+These key paths are understood:
+  imageDate   date the image was taken, compared with dates.
+  mainRating  rating of the image (0 to 5), compared with numbers.
+  isFavorite  whether the image is flagged as favorite.
+  keywords    keyword names; "contains" a name, or "in" a list of names.
+  mediaType   "Movie" or "Image", tested with == or !=.
+Comparisons may be combined with and, or and not. Albums with any other
+condition raise ValueError, and are skipped by the callers.
+'''
+
+# Copyright 2017 Benjamín Valero
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import plistlib
+import subprocess
+import tempfile
+
+import tilutil.imageutils as imageutils
+
+# NSCompoundPredicateType values.
+_NOT = 0
+_AND = 1
+_OR = 2
+
+# NSPredicateOperatorType values, and the SQL operators they map to.
+_COMPARISONS = {
+    0: '<',
+    1: '<=',
+    2: '>',
+    3: '>=',
+    4: '=',
+    5: '!=',
+}
+_IN = 10
+_CONTAINS = 99
+_BETWEEN = 100
+
+# Images with a keyword, by keyword name. Version ids are image ids, see
+# applexml._IMAGE_KEYWORD_QUERY.
+_KEYWORD_CONDITION = ('m.modelId in (select kv.versionId from RKKeywordForVersion kv '
+                      'join RKKeyword k on k.modelId = kv.keywordId '
+                      'where k.name in (%s))')
+
+
+def _read_plist(data):
+    """Parses a property list, binary or XML."""
+    if data.startswith('bplist'):
+        # plistlib only reads XML, so let plutil convert it.
+        fd, path = tempfile.mkstemp(prefix='phoshare', suffix='.plist')
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            try:
+                process = subprocess.Popen(['plutil', '-convert', 'xml1', '-o', '-', path],
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                data, _errors = process.communicate()
+            except OSError as e:
+                raise ValueError(u'cannot run plutil: %s' % e)
+            if process.returncode:
+                raise ValueError(u'plutil cannot read the filter')
+        finally:
+            os.remove(path)
+    try:
+        return plistlib.readPlistFromString(data)
+    except Exception as e:
+        raise ValueError(u'bad filter data: %s' % e)
+
+
+def _unarchive(archive):
+    """Resolves the objects of an NSKeyedArchiver archive. Arrays and
+    dictionaries become lists and dicts, other objects dicts of their fields
+    with their class name under '$classname'. Raises ValueError if the archive
+    is malformed."""
+    objects = archive.get('$objects') if isinstance(archive, dict) else None
+    top = archive.get('$top') if isinstance(archive, dict) else None
+    if not isinstance(objects, list) or not isinstance(top, dict):
+        raise ValueError(u'filter data is not a keyed archive')
+
+    def lookup(reference):
+        """Returns the object a reference (UID) refers to."""
+        index = reference.get('CF$UID') if isinstance(reference, dict) else None
+        if not isinstance(index, int) or not 0 <= index < len(objects):
+            raise ValueError(u'bad object reference in filter data')
+        return index, objects[index]
+
+    def resolve(value, resolving):
+        """Replaces references (UIDs) by the objects they refer to. resolving
+        holds the references being resolved, to detect cycles."""
+        if isinstance(value, dict) and 'CF$UID' in value:
+            index, value = lookup(value)
+            if value == '$null':
+                return None
+            if index in resolving:
+                raise ValueError(u'filter data refers to itself')
+            resolving = resolving | set([index])
+        if isinstance(value, list):
+            return [resolve(item, resolving) for item in value]
+        if not isinstance(value, dict):
+            return value
+        fields = dict((key, resolve(item, resolving)) for key, item in value.iteritems()
+                      if key != '$class')
+        if '$class' in value:
+            _index, class_info = lookup(value['$class'])
+            if not isinstance(class_info, dict):
+                raise ValueError(u'bad class in filter data')
+            if 'NS.keys' in fields:
+                keys = fields['NS.keys']
+                items = fields.get('NS.objects')
+                if (not isinstance(keys, list) or not isinstance(items, list) or
+                        len(keys) != len(items) or
+                        not all(isinstance(key, basestring) for key in keys)):
+                    raise ValueError(u'bad dictionary in filter data')
+                return dict(zip(keys, items))
+            if 'NS.objects' in fields:
+                return fields['NS.objects']
+            if 'NS.string' in fields:
+                return fields['NS.string']
+            fields['$classname'] = class_info.get('$classname')
+        return fields
+
+    return resolve(top.get('root'), frozenset())
+
+
+def decode_filter_data(filter_data):
+    """Decodes the filterData of a smart album into the archived predicate."""
+    return _unarchive(_read_plist(str(filter_data)))
+
+
+def _value(value):
+    """Returns the value of a constant, or of an item of a constant list,
+    which may be a constant expression itself. Only numbers and strings are
+    values; anything else raises ValueError."""
+    if isinstance(value, dict) and 'NSConstantValue' in value:
+        value = value['NSConstantValue']
+    if isinstance(value, dict) and 'NS.time' in value:
+        # NSDate, already an Apple time stamp.
+        value = value['NS.time']
+        if not isinstance(value, (int, long, float)) or isinstance(value, bool):
+            raise ValueError(u'bad date in filter')
+        return float(value)
+    if isinstance(value, bool):
+        return int(value)
+    if not isinstance(value, (int, long, float, basestring)):
+        raise ValueError(u'unsupported value in filter')
+    return value
+
+
+def _constant(expression):
+    """Returns the value of a constant expression, which may be a list."""
+    if not isinstance(expression, dict) or 'NSConstantValue' not in expression:
+        raise ValueError(u'unsupported expression')
+    return expression['NSConstantValue']
+
+
+def _compile_comparison(predicate):
+    """Compiles an NSComparisonPredicate into (condition, parameters)."""
+    left = predicate.get('NSLeftExpression')
+    operator = predicate.get('NSPredicateOperator')
+    if not isinstance(left, dict) or not isinstance(operator, dict):
+        raise ValueError(u'bad comparison in filter')
+    key_path = left.get('NSKeyPath')
+    operator = operator.get('NSOperatorType')
+    value = _constant(predicate.get('NSRightExpression'))
+
+    if key_path in ('imageDate', 'mainRating', 'isFavorite'):
+        column = 'v.' + key_path
+        if operator in _COMPARISONS:
+            return '%s %s ?' % (column, _COMPARISONS[operator]), [_value(value)]
+        if operator == _BETWEEN and isinstance(value, list) and len(value) == 2:
+            return '%s between ? and ?' % column, [_value(value[0]), _value(value[1])]
+    elif key_path == 'keywords':
+        names = None
+        if operator == _CONTAINS and isinstance(value, basestring):
+            names = [value]
+        elif operator == _IN and isinstance(value, list):
+            names = [_value(name) for name in value]
+        if names:
+            return _KEYWORD_CONDITION % ', '.join('?' * len(names)), names
+    elif key_path == 'mediaType' and value in ('Movie', 'Image') and operator in (4, 5):
+        condition = '(%s)' % ' or '.join(
+            "lower(m.imagePath) like '%%.%s'" % extension
+            for extension in imageutils.MOVIE_EXTENSIONS)
+        if (value == 'Movie') != (operator == 4):
+            condition = 'not ' + condition
+        return condition, []
+    raise ValueError(u'unsupported condition on %s' % key_path)
+
+
+def _compile_predicate(predicate):
+    """Compiles an archived predicate into (condition, parameters)."""
+    classname = predicate.get('$classname') if isinstance(predicate, dict) else None
+    if classname == 'NSComparisonPredicate':
+        return _compile_comparison(predicate)
+    if classname == 'NSTruePredicate':
+        return '1', []
+    if classname == 'NSFalsePredicate':
+        return '0', []
+    if classname == 'NSCompoundPredicate':
+        kind = predicate.get('NSCompoundPredicateType')
+        conditions = []
+        params = []
+        subpredicates = predicate.get('NSSubpredicates') or []
+        if not isinstance(subpredicates, list):
+            raise ValueError(u'bad compound predicate in filter')
+        for subpredicate in subpredicates:
+            condition, subparams = _compile_predicate(subpredicate)
+            conditions.append('(%s)' % condition)
+            params.extend(subparams)
+        if kind == _NOT and len(conditions) == 1:
+            return 'not %s' % conditions[0], params
+        if kind == _AND:
+            return ' and '.join(conditions) or '1', params
+        if kind == _OR:
+            return ' or '.join(conditions) or '0', params
+    raise ValueError(u'unsupported predicate %s' % classname)
+
+
+def compile_filter(filter_data):
+    """Compiles the filterData of a smart album into an SQL condition on the
+    masters (m) and versions (v) of the library.
+
+    Returns:
+      (condition, parameters).
+
+    Raises:
+      ValueError: if the filter cannot be read, or has conditions that are not
+          supported.
+    """
+    if not filter_data:
+        raise ValueError(u'no filter')
+    return _compile_predicate(decode_filter_data(filter_data))
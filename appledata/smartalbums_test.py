@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""This module tests smartalbums.py."""
+
+# Copyright 2017 Benjamín Valero
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import plistlib
+import sqlite3
+import unittest
+
+import appledata.applexml as applexml
+import appledata.smartalbums as smartalbums
+
+
+def archive(root):
+    """Archives nested objects like NSKeyedArchiver, into an XML property list.
+    Dictionaries with a '$classname' become archived objects."""
+    objects = ['$null']
+    def uid(index):
+        return {'CF$UID': index}
+    def add_class(name):
+        objects.append({'$classname': name, '$classes': [name, 'NSObject']})
+        return uid(len(objects) - 1)
+    def add(value):
+        if isinstance(value, list):
+            entry = {'NS.objects': [add(item) for item in value]}
+            entry['$class'] = add_class('NSArray')
+        elif isinstance(value, dict):
+            entry = dict((key, add(item)) for key, item in value.iteritems()
+                         if key != '$classname')
+            entry['$class'] = add_class(value['$classname'])
+        elif isinstance(value, basestring):
+            entry = value
+        else:
+            return value
+        objects.append(entry)
+        return uid(len(objects) - 1)
+    top = add(root)
+    return plistlib.writePlistToString({'$archiver': 'NSKeyedArchiver', '$version': 100000,
+                                        '$objects': objects, '$top': {'root': top}})
+
+
+def comparison(key_path, operator, value):
+    """Returns an archived NSComparisonPredicate."""
+    return {'$classname': 'NSComparisonPredicate',
+            'NSLeftExpression': {'$classname': 'NSKeyPathExpression', 'NSKeyPath': key_path},
+            'NSPredicateOperator': {'$classname': 'NSPredicateOperator',
+                                    'NSOperatorType': operator},
+            'NSRightExpression': {'$classname': 'NSConstantValueExpression',
+                                  'NSConstantValue': value}}
+
+
+def compound(kind, *subpredicates):
+    """Returns an archived NSCompoundPredicate."""
+    return {'$classname': 'NSCompoundPredicate', 'NSCompoundPredicateType': kind,
+            'NSSubpredicates': list(subpredicates)}
+
+
+class SmartAlbumsTest(unittest.TestCase):
+    """Unit tests for smartalbums.py code."""
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.executescript('''
+            create table RKMaster (modelId, imagePath, importComplete, isInTrash);
+            create table RKVersion (modelId, imageDate, mainRating, isFavorite, isInTrash);
+            create table RKKeyword (modelId, name);
+            create table RKKeywordForVersion (versionId, keywordId);
+            insert into RKMaster values (1, 'a.jpg', 1, 0);
+            insert into RKMaster values (2, 'b.MOV', 1, 0);
+            insert into RKMaster values (3, 'c.jpg', 1, 0);
+            insert into RKVersion values (1, 100.0, 5, 1, 0);
+            insert into RKVersion values (2, 200.0, 3, 0, 0);
+            insert into RKVersion values (3, 300.0, 0, 0, 0);
+            insert into RKKeyword values (1, 'Travel');
+            insert into RKKeyword values (2, 'Food');
+            insert into RKKeywordForVersion values (1, 1);
+            insert into RKKeywordForVersion values (3, 2);
+        ''')
+
+    def tearDown(self):
+        self.conn.close()
+
+    def select(self, predicate):
+        """Returns the ids of the images selected by a predicate."""
+        condition, params = smartalbums.compile_filter(archive(predicate))
+        c = self.conn.cursor()
+        c.execute(applexml._SMART_ALBUM_IMAGE_QUERY % condition, params)
+        return [row[0] for row in c.fetchall()]
+
+    def test_comparisons(self):
+        """Tests the supported conditions, one by one."""
+        self.assertEquals([2, 3], self.select(
+            comparison('imageDate', 3, {'$classname': 'NSDate', 'NS.time': 200.0})))
+        self.assertEquals([2], self.select(
+            comparison('imageDate', 100, [{'$classname': 'NSDate', 'NS.time': 150.0},
+                                          {'$classname': 'NSDate', 'NS.time': 250.0}])))
+        self.assertEquals([1, 2], self.select(comparison('mainRating', 3, 3)))
+        self.assertEquals([1], self.select(comparison('isFavorite', 4, True)))
+        self.assertEquals([1], self.select(comparison('keywords', 99, u'Travel')))
+        self.assertEquals([1, 3], self.select(comparison('keywords', 10, [u'Travel', u'Food'])))
+        self.assertEquals([2], self.select(comparison('mediaType', 4, u'Movie')))
+        self.assertEquals([1, 3], self.select(comparison('mediaType', 5, u'Movie')))
+
+    def test_compound(self):
+        """Tests and, or and not."""
+        rated = comparison('mainRating', 2, 0)
+        travel = comparison('keywords', 99, u'Travel')
+        self.assertEquals([1], self.select(compound(1, rated, travel)))
+        self.assertEquals([1, 2], self.select(compound(2, rated, travel)))
+        self.assertEquals([3], self.select(compound(0, rated)))
+
+    def test_unsupported(self):
+        """Tests that filters we cannot evaluate are rejected."""
+        self.assertRaises(ValueError, smartalbums.compile_filter, None)
+        self.assertRaises(ValueError, smartalbums.compile_filter, 'not a plist')
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          archive(comparison('faces', 4, u'Alice')))
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          archive(compound(1, comparison('mainRating', 3, 3),
+                                           {'$classname': 'RKUnknownQuery'})))
+
+    def test_malformed(self):
+        """Tests that malformed archives are rejected with ValueError."""
+        def keyed_archive(objects, top=None):
+            if top is None:
+                top = {'root': {'CF$UID': 1}}
+            return plistlib.writePlistToString({'$archiver': 'NSKeyedArchiver',
+                                                '$objects': objects, '$top': top})
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          plistlib.writePlistToString(['$null']))
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          keyed_archive(['$null'], top=['root']))
+        # References out of range, or that are not references.
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          keyed_archive(['$null', {'NSLeftExpression': {'CF$UID': 7}}]))
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          keyed_archive(['$null', {'$class': {'CF$UID': -1}}]))
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          keyed_archive(['$null', {'$class': 'NSCompoundPredicate'}]))
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          keyed_archive(['$null', {'$class': {'CF$UID': 0}}]))
+        # An object that contains itself.
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          keyed_archive(['$null', {'NSSubpredicates': {'CF$UID': 1}}]))
+        # Comparisons with parts that are not what they should be.
+        predicate = comparison('mainRating', 3, 3)
+        predicate['NSLeftExpression'] = u'mainRating'
+        self.assertRaises(ValueError, smartalbums.compile_filter, archive(predicate))
+        predicate = comparison('mainRating', 3, 3)
+        predicate['NSPredicateOperator'] = 3
+        self.assertRaises(ValueError, smartalbums.compile_filter, archive(predicate))
+        predicate = compound(1, comparison('mainRating', 3, 3))
+        predicate['NSSubpredicates'] = 5
+        self.assertRaises(ValueError, smartalbums.compile_filter, archive(predicate))
+        # Constants that cannot be bound as SQL parameters.
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          archive(comparison('mainRating', 3, [1, 2])))
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          archive(comparison('mainRating', 3, {'$classname': 'NSNumber'})))
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          archive(comparison('keywords', 10, [[u'Travel']])))
+        self.assertRaises(ValueError, smartalbums.compile_filter,
+                          archive(comparison('imageDate', 3, {'$classname': 'NSDate',
+                                                              'NS.time': u'today'})))
+
+
+if __name__ == '__main__':
+    unittest.main()
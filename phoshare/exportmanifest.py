@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""The manifest of an export folder: what was exported into it, and from where.
+
+The manifest is a small SQLite database in the export folder. For each file
+exported, it records the image it came from, the path, inode, modification
+time and size of the source file, the modification stamp of the image in the
+library, and the modification time and size of the exported file once
+written. When the library says an image did not change since, its exported
+files are known to be up to date without looking at the source or the
+exported file at all.
+"""
+
+# Copyright 2017 Benjamín Valero
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sqlite3
+import sys
+
+import phoshare.exportplan as exportplan
+import tilutil.systemutils as su
+
+# Name of the manifest in the export folder. Files starting with it are never
+# obsolete.
+MANIFEST_NAME = u'.phoshare-manifest.sqlite'
+
+# Bump when the table changes; older manifests are then started over.
+_MANIFEST_VERSION = 1
+
+# Export paths are relative to the export folder. linked is 1 for files
+# exported as links.
+_CREATE_TABLE = ('create table files (export_path text primary key, image_id integer, '
+                 'source_path text, source_inode integer, source_mtime real, '
+                 'source_size integer, library_time real, linked integer, '
+                 'export_mtime real, export_size integer)')
+
+_LOOKUP_QUERY = ('select image_id, source_path, library_time, linked from files '
+                 'where export_path = ?')
+
+_INSERT = 'insert or replace into files values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+# Deletes a file, or a folder with everything in it ('0' follows '/').
+_DELETE = ('delete from files where export_path = ? or '
+           '(export_path > ? and export_path < ?)')
+
+# Modification times of copies may be off by this much (see _MTIME_FUDGE in
+# phoshare_main).
+_MTIME_FUDGE = 3
+
+
+def _matches(export_stat, source_stat, linked):
+    """Tests if an exported file is a fresh copy or link of its source."""
+    if linked:
+        return export_stat.st_ino == source_stat.st_ino
+    return (export_stat.st_size == source_stat.st_size and
+            abs(export_stat.st_mtime - source_stat.st_mtime) <= _MTIME_FUDGE)
+
+
+class ExportManifest(object):
+    """The manifest of an export folder."""
+
+    def __init__(self, root, read_only=False):
+        """Opens the manifest of the export folder root, if there is one.
+
+        Args:
+          root: the export folder.
+          read_only: if set, the manifest is only used to look files up, and
+              never written (for dry runs).
+        """
+        self.root = root
+        self.path = os.path.join(root, MANIFEST_NAME)
+        self._read_only = read_only
+        self._conn = None
+        # Entries of files that are up to date, to be written by commit().
+        self._rows = []
+        # Entries of files to be written, by export path, with the os.stat()
+        # result of their source.
+        self._pending = {}
+        if os.path.exists(self.path):
+            self._open()
+
+    def _open(self):
+        """Opens the manifest, creating it if needed. A manifest that cannot
+        be read is started over."""
+        conn = None
+        try:
+            try:
+                conn = sqlite3.connect(self.path)
+                version = conn.execute('pragma user_version').fetchone()[0]
+            except sqlite3.DatabaseError as ex:
+                print >> sys.stderr, 'Cannot read export manifest %s: %s' % (
+                    su.fsenc(self.path), ex)
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                if self._read_only:
+                    return
+                os.remove(self.path)
+                conn = sqlite3.connect(self.path)
+                version = 0
+            if version != _MANIFEST_VERSION:
+                if self._read_only:
+                    return
+                conn.execute('drop table if exists files')
+                conn.execute(_CREATE_TABLE)
+                conn.execute('pragma user_version = %d' % _MANIFEST_VERSION)
+                conn.commit()
+            self._conn, conn = conn, None
+        finally:
+            # Set only if the connection is not kept.
+            if conn is not None:
+                conn.close()
+
+    def _key(self, export_file):
+        """Returns the path of an exported file, relative to the export
+        folder."""
+        return os.path.relpath(export_file, self.root)
+
+    def is_current(self, export_file, image, source_path, link):
+        """Tests if an exported file was last exported from source_path of the
+        image, in the same way (link or copy), and the image did not change
+        since.
+
+        Args:
+          export_file: path of the exported file.
+          image: the IPhotoImage exported.
+          source_path: path of the file of the image exported, before aliases
+              are resolved.
+          link: whether the file is to be exported as a link.
+        """
+        if self._conn is None or image.mod_time is None:
+            return False
+        row = self._conn.execute(_LOOKUP_QUERY, (self._key(export_file),)).fetchone()
+        return (row is not None and row[0] == image.id and row[1] == source_path and
+                row[2] == image.mod_time and bool(row[3]) == bool(link))
+
+    def record(self, export_file, image, source_path, source_stat, link, export_stat=None):
+        """Records an exported file.
+
+        Args:
+          export_file: path of the exported file.
+          image: the IPhotoImage exported.
+          source_path: path of the file of the image exported, before aliases
+              are resolved.
+          source_stat: os.stat() result of the source file.
+          link: whether the file is exported as a link.
+          export_stat: os.stat() result of the exported file if it is up to
+              date. If not set, the file is still to be written, and is
+              recorded by commit() once it is.
+        """
+        if self._read_only or image.mod_time is None:
+            return
+        entry = (self._key(export_file), image.id, source_path, source_stat.st_ino,
+                 source_stat.st_mtime, source_stat.st_size, image.mod_time, int(bool(link)))
+        if export_stat is None:
+            self._pending[export_file] = (entry, source_stat)
+        else:
+            self._rows.append(entry + (export_stat.st_mtime, export_stat.st_size))
+
+    def commit(self, plan):
+        """Writes the recorded entries once the operations of plan have been
+        applied. Files still to be written are only recorded if they were, and
+        match their source. Entries of deleted files are dropped."""
+        if self._read_only:
+            return
+        rows, self._rows = self._rows, []
+        pending, self._pending = self._pending, {}
+        for export_file, (entry, source_stat) in pending.iteritems():
+            try:
+                export_stat = os.stat(export_file)
+            except OSError:
+                continue
+            if _matches(export_stat, source_stat, entry[7]):
+                rows.append(entry + (export_stat.st_mtime, export_stat.st_size))
+        deleted = [self._key(operation.path) for operation in plan
+                   if operation.action == exportplan.DELETE and
+                   not os.path.exists(operation.path)]
+        if not rows and not deleted:
+            return
+
+        if self._conn is None:
+            if not os.path.isdir(self.root):
+                return
+            self._open()
+        with self._conn:
+            self._conn.executemany(_INSERT, rows)
+            self._conn.executemany(_DELETE, [(path, path + u'/', path + u'0')
+                                             for path in deleted])
+
+    def close(self):
+        """Closes the manifest."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
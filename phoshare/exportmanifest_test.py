@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""This module tests exportmanifest.py."""
+
+# Copyright 2017 Benjamín Valero
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import phoshare.exportmanifest as exportmanifest
+import phoshare.exportplan as exportplan
+
+
+class Image(object):
+    """The image attributes used by the manifest."""
+
+    def __init__(self, image_id, mod_time):
+        self.id = image_id
+        self.mod_time = mod_time
+
+
+class ExportManifestTest(unittest.TestCase):
+    """Unit tests for exportmanifest.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, 'source.jpg')
+        with open(self.source, 'w') as f:
+            f.write('x' * 10)
+        self.root = os.path.join(self.folder, 'export')
+        os.makedirs(os.path.join(self.root, 'album'))
+        self.export_file = os.path.join(self.root, 'album', 'a.jpg')
+        shutil.copy2(self.source, self.export_file)
+        self.image = Image(1, 500000000.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_current(self):
+        """Tests that recorded files are current until their image changes."""
+        manifest = exportmanifest.ExportManifest(self.root)
+        manifest.record(self.export_file, self.image, self.source, os.stat(self.source), False,
+                        os.stat(self.export_file))
+        manifest.commit(exportplan.ExportPlan(self.root))
+        manifest.close()
+
+        manifest = exportmanifest.ExportManifest(self.root)
+        self.assertTrue(manifest.is_current(self.export_file, self.image, self.source, False))
+        self.assertFalse(manifest.is_current(self.export_file, self.image, self.source, True))
+        self.assertFalse(manifest.is_current(self.export_file, self.image, u'/other.jpg',
+                                             False))
+        self.assertFalse(manifest.is_current(self.export_file, Image(2, 500000000.0),
+                                             self.source, False))
+        self.assertFalse(manifest.is_current(self.export_file, Image(1, 500000001.0),
+                                             self.source, False))
+        self.assertFalse(manifest.is_current(self.export_file, Image(1, None),
+                                             self.source, False))
+        manifest.close()
+
+    def test_pending(self):
+        """Tests that files to be written are recorded only once they are."""
+        manifest = exportmanifest.ExportManifest(self.root)
+        written = os.path.join(self.root, 'album', 'b.jpg')
+        not_written = os.path.join(self.root, 'album', 'c.jpg')
+        for export_file in (written, not_written, self.export_file):
+            manifest.record(export_file, self.image, self.source, os.stat(self.source), False)
+        shutil.copy2(self.source, written)
+        with open(self.export_file, 'w') as f:
+            f.write('old')
+        manifest.commit(exportplan.ExportPlan(self.root))
+        self.assertTrue(manifest.is_current(written, self.image, self.source, False))
+        self.assertFalse(manifest.is_current(not_written, self.image, self.source, False))
+        self.assertFalse(manifest.is_current(self.export_file, self.image, self.source, False))
+        manifest.close()
+
+    def test_delete(self):
+        """Tests that deleted files are dropped from the manifest."""
+        manifest = exportmanifest.ExportManifest(self.root)
+        manifest.record(self.export_file, self.image, self.source, os.stat(self.source), False,
+                        os.stat(self.export_file))
+        manifest.commit(exportplan.ExportPlan(self.root))
+        album = os.path.join(self.root, 'album')
+        plan = exportplan.ExportPlan(self.root)
+        plan.delete(album, u'Obsolete')
+        shutil.rmtree(album)
+        manifest.commit(plan)
+        self.assertFalse(manifest.is_current(self.export_file, self.image, self.source, False))
+        manifest.close()
+
+    def test_read_only(self):
+        """Tests that a read-only manifest is never written."""
+        manifest = exportmanifest.ExportManifest(self.root, read_only=True)
+        manifest.record(self.export_file, self.image, self.source, os.stat(self.source), False,
+                        os.stat(self.export_file))
+        manifest.commit(exportplan.ExportPlan(self.root))
+        self.assertFalse(os.path.exists(manifest.path))
+        self.assertFalse(manifest.is_current(self.export_file, self.image, self.source, False))
+        manifest.close()
+
+
+    def test_unreadable(self):
+        """Tests that a manifest that is not a database is started over, and
+        left alone by dry runs."""
+        path = os.path.join(self.root, exportmanifest.MANIFEST_NAME)
+        with open(path, 'w') as f:
+            f.write('not a database' * 100)
+        manifest = exportmanifest.ExportManifest(self.root, read_only=True)
+        self.assertFalse(manifest.is_current(self.export_file, self.image, self.source, False))
+        manifest.close()
+        self.assertTrue(open(path).read().startswith('not a database'))
+
+        manifest = exportmanifest.ExportManifest(self.root)
+        manifest.record(self.export_file, self.image, self.source, os.stat(self.source), False,
+                        os.stat(self.export_file))
+        manifest.commit(exportplan.ExportPlan(self.root))
+        self.assertTrue(manifest.is_current(self.export_file, self.image, self.source, False))
+        manifest.close()
+
+if __name__ == '__main__':
+    unittest.main()
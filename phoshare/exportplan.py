@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""Export plans: the file operations of an export, decided before any is done.
+
+Scanning the library and the export folder only adds operations to an
+ExportPlan. execute_plan() then applies them, in order. A plan can be saved
+to a file, and applied later.
+"""
+
+# Copyright 2017 Benjamín Valero
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import errno
+import json
+import logging
+import os
+import Queue
+import stat
+import sys
+import threading
+
+import tilutil.imageutils as imageutils
+import tilutil.systemutils as su
+
+_logger = logging.getLogger('google')
+
+# Bump when the layout of saved plans changes.
+_PLAN_FORMAT = 1
+
+# Kinds of operations.
+MKDIR = 'mkdir'    # Create a folder.
+CREATE = 'create'  # Copy a new file.
+UPDATE = 'update'  # Replace a file by a new copy.
+LINK = 'link'      # Link a new file, or replace a file by a link.
+DELETE = 'delete'  # Delete a file or folder.
+ACTIONS = (MKDIR, CREATE, UPDATE, LINK, DELETE)
+
+
+def delete_album_file(album_file, albumdirectory, msg, options):
+    """sanity check - only delete from album directory."""
+    if not album_file.startswith(albumdirectory):
+        print >> sys.stderr, (
+            "Internal error - attempting to delete file "
+            "that is not in album directory:\n    %s") % (su.fsenc(album_file))
+        return False
+    if msg:
+        print "%s: %s" % (msg, su.fsenc(album_file))
+
+    if not imageutils.should_delete(options):
+        return False
+    if options.dryrun:
+        return True
+
+    try:
+        if os.path.isdir(album_file):
+            file_list = os.listdir(album_file)
+            for subfile in file_list:
+                delete_album_file(os.path.join(album_file, subfile),
+                                  albumdirectory, msg, options)
+            os.rmdir(album_file)
+        else:
+            os.remove(album_file)
+        return True
+    except OSError as ex:
+        print >> sys.stderr, "Could not delete %s: %s" % (su.fsenc(album_file),
+                                                          ex)
+    return False
+
+
+class StatCache(object):
+    """The os.stat() results of the files looked at while planning, so that
+    each file is stat'ed only once, however often it is looked at. Folders
+    are listed only once too."""
+
+    def __init__(self):
+        self._stats = {}  # path -> stat_result, or None if missing
+        self._listings = {}  # folder -> sorted names
+        self._folders = {}  # path -> True if a folder, from listings
+
+    def lookup(self, path):
+        """Returns the os.stat() result of path, or None if it does not
+        exist."""
+        try:
+            return self._stats[path]
+        except KeyError:
+            pass
+        try:
+            result = os.stat(path)
+        except OSError:
+            result = None
+        self._stats[path] = result
+        return result
+
+    def stat(self, path):
+        """Returns the os.stat() result of path. Raises OSError if it does not
+        exist."""
+        result = self.lookup(path)
+        if result is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return result
+
+    def exists(self, path):
+        """Tests if path exists. Entries of listed folders are known without
+        a stat()."""
+        if path in self._folders:
+            return True
+        return self.lookup(path) is not None
+
+    def isdir(self, path):
+        """Tests if path is a folder. Entries of listed folders are known
+        without a stat()."""
+        is_folder = self._folders.get(path)
+        if is_folder is not None:
+            return is_folder
+        result = self.lookup(path)
+        return result is not None and stat.S_ISDIR(result.st_mode)
+
+    def listdir(self, folder):
+        """Returns the names in a folder, sorted and in Unicode Normalization
+        Form C, like su.os_listdir_unicode()."""
+        names = self._listings.get(folder)
+        if names is None:
+            names = []
+            for name, is_folder in su.scan_folder(folder):
+                self._folders[os.path.join(folder, name)] = is_folder
+                names.append(name)
+            self._listings[folder] = names
+        return names
+
+    def clear(self):
+        """Forgets all results, once files have been changed."""
+        self._stats.clear()
+        self._listings.clear()
+        self._folders.clear()
+
+
+class ExportOperation(object):
+    """One file operation of an export."""
+
+    __slots__ = ('action', 'path', 'source', 'reason', 'size')
+
+    def __init__(self, action, path, source=None, reason=u'', size=0):
+        """Creates an operation.
+
+        Args:
+          action: one of ACTIONS.
+          path: the file or folder created, replaced or deleted.
+          source: the file copied or linked, for CREATE, UPDATE and LINK,
+              with aliases resolved.
+          reason: why the operation is needed, shown when it is applied.
+          size: number of bytes copied or deleted.
+        """
+        self.action = action
+        self.path = path
+        self.source = source
+        self.reason = reason
+        self.size = size
+
+    def tolist(self):
+        """Returns the operation as a list, for saving."""
+        return [self.action, self.path, self.source, self.reason, self.size]
+
+
+class ExportPlan(object):
+    """The operations of an export into a folder, in the order to apply them."""
+
+    def __init__(self, root):
+        """Creates an empty plan for exporting into the folder root. Deletions
+        are only applied within root."""
+        self.root = root
+        self.operations = []
+        # Folders created, and paths deleted, by the planned operations.
+        self._planned_folders = set()
+        self._planned_deletes = set()
+        # The files as they are before the plan is applied.
+        self.stats = StatCache()
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def add(self, action, path, source=None, reason=u'', size=0):
+        """Adds an operation at the end of the plan."""
+        self.operations.append(ExportOperation(action, path, source, reason, size))
+
+    def _get_size(self, path):
+        """Returns the size of a file, or 0 if it cannot be stat'ed (a broken
+        link, or a file that vanished since it was listed)."""
+        result = self.stats.lookup(path)
+        if result is None:
+            return 0
+        return result.st_size
+
+    def exists(self, path):
+        """Tests if a file or folder exists once the planned operations are
+        applied."""
+        if path in self._planned_folders:
+            return True
+        if path in self._planned_deletes or os.path.dirname(path) in self._planned_deletes:
+            return False
+        return self.stats.exists(path)
+
+    def mkdir(self, folder):
+        """Adds the creation of a folder, unless it exists or is planned
+        already."""
+        if self.exists(folder):
+            return
+        self._planned_folders.add(folder)
+        self._planned_deletes.discard(folder)
+        self.add(MKDIR, folder)
+
+    def copy(self, source, target, link, reason):
+        """Adds the copy or link of a file, replacing any existing one."""
+        if link:
+            action = LINK
+        elif self.exists(target):
+            action = UPDATE
+        else:
+            action = CREATE
+        self._planned_deletes.discard(target)
+        self.add(action, target, source, reason, self._get_size(source))
+
+    def delete(self, path, reason):
+        """Adds the deletion of a file or folder, or of a broken link."""
+        size = 0
+        if not self.stats.isdir(path):
+            size = self._get_size(path)
+        self._planned_deletes.add(path)
+        self.add(DELETE, path, reason=reason, size=size)
+
+    def clear(self):
+        """Removes all operations, once they have been applied."""
+        self.operations = []
+        self.stats.clear()
+
+    def get_summary(self):
+        """Returns {action: (count, bytes)} for the actions in the plan."""
+        summary = {}
+        for operation in self.operations:
+            count, size = summary.get(operation.action, (0, 0))
+            summary[operation.action] = (count + 1, size + operation.size)
+        return summary
+
+    def save(self, plan_file):
+        """Writes the plan to a file, as JSON."""
+        with open(plan_file, 'w') as f:
+            json.dump({'format': _PLAN_FORMAT,
+                       'root': self.root,
+                       'operations': [operation.tolist() for operation in self.operations]},
+                      f, indent=0)
+
+
+def load_plan(plan_file):
+    """Reads a plan saved by ExportPlan.save(). Raises ValueError if the file is
+    not a plan."""
+    with open(plan_file) as f:
+        try:
+            saved = json.load(f)
+        except ValueError as ex:
+            raise ValueError(u'%s is not an export plan: %s' % (plan_file, ex))
+    if not isinstance(saved, dict) or saved.get('format') != _PLAN_FORMAT:
+        raise ValueError(u'%s is not an export plan of this version.' % plan_file)
+    plan = ExportPlan(saved['root'])
+    for action, path, source, reason, size in saved['operations']:
+        if action not in ACTIONS:
+            raise ValueError(u'%s has an unknown operation %s.' % (plan_file, action))
+        plan.add(action, path, source, reason, size)
+    return plan
+
+
+def execute_operation(operation, root, options):
+    """Applies one operation. Honors options.dryrun and the create, update and
+    delete limits of options."""
+    action = operation.action
+    if action == MKDIR:
+        su.pout(u"Creating folder " + operation.path)
+        if not options.dryrun and not os.path.exists(operation.path):
+            os.makedirs(operation.path)
+    elif action == DELETE:
+        delete_album_file(operation.path, root, operation.reason, options)
+    else:
+        if operation.reason:
+            su.pout(u'Changed:  %s: %s' % (operation.path, operation.reason))
+        imageutils.copy_or_link_file(operation.source, operation.path,
+                                     options.dryrun, action == LINK, options)
+
+
+class _CopyPool(object):
+    """Copies and links files on worker threads.
+
+    The create and update limits are checked, and messages logged, on the
+    calling thread before a file is handed to the workers, so only the copy
+    itself runs in parallel. Errors are logged on the calling thread too, by
+    wait().
+    """
+
+    def __init__(self, jobs, jobs_per_device):
+        """Starts jobs workers. If jobs_per_device is set, at most that many
+        files are written to the same device at a time."""
+        self._jobs_per_device = jobs_per_device
+        self._device_limits = {}  # st_dev -> Semaphore
+        self._folder_devices = {}  # folder -> st_dev
+        self._tasks = Queue.Queue()
+        self._errors = []  # (operation, exception)
+        # Targets handed to the workers since the last wait().
+        self._targets = set()
+        self._threads = []
+        for _ in xrange(jobs):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _get_device_limit(self, target):
+        """Returns the semaphore limiting the writes to the device of target,
+        or None."""
+        if not self._jobs_per_device:
+            return None
+        folder = os.path.dirname(target)
+        device = self._folder_devices.get(folder)
+        if device is None:
+            device = os.stat(folder).st_dev
+            self._folder_devices[folder] = device
+        limit = self._device_limits.get(device)
+        if limit is None:
+            limit = threading.Semaphore(self._jobs_per_device)
+            self._device_limits[device] = limit
+        return limit
+
+    def _work(self):
+        """Copies files until the pool is closed."""
+        while True:
+            task = self._tasks.get()
+            try:
+                if task is None:
+                    return
+                operation, limit = task
+                if limit is not None:
+                    limit.acquire()
+                try:
+                    imageutils.do_copy_or_link(operation.source, operation.path,
+                                               operation.action == LINK)
+                finally:
+                    if limit is not None:
+                        limit.release()
+            except EnvironmentError as ex:
+                self._errors.append((operation, ex))
+            finally:
+                self._tasks.task_done()
+
+    def submit(self, operation):
+        """Hands a copy or link to the workers."""
+        if operation.path in self._targets:
+            # The same file twice; let the first copy finish.
+            self.wait()
+        self._targets.add(operation.path)
+        self._tasks.put((operation, self._get_device_limit(operation.path)))
+
+    def wait(self):
+        """Waits for the files handed to the workers, and logs the errors."""
+        self._tasks.join()
+        self._targets.clear()
+        errors, self._errors = self._errors, []
+        for operation, ex in errors:
+            _logger.error(u'%s: %s' % (operation.source, str(ex)))
+
+    def close(self):
+        """Waits for the files handed to the workers, and stops them."""
+        self.wait()
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def execute_plan(plan, options):
+    """Applies the operations of a plan, in order. With options.jobs above 1,
+    files are copied on that many threads, at most options.jobs_per_device at a
+    time to the same device if set. Folders are created, and files deleted,
+    only once the copies before them are done."""
+    if options.jobs <= 1:
+        for operation in plan:
+            try:
+                execute_operation(operation, plan.root, options)
+            except OSError as ex:
+                print >> sys.stderr, "Failed to %s %s: %s" % (
+                    operation.action, su.fsenc(operation.path), ex)
+        return
+
+    pool = _CopyPool(options.jobs, options.jobs_per_device)
+    try:
+        for operation in plan:
+            try:
+                if operation.action in (MKDIR, DELETE):
+                    pool.wait()
+                    execute_operation(operation, plan.root, options)
+                    continue
+                if operation.reason:
+                    su.pout(u'Changed:  %s: %s' % (operation.path, operation.reason))
+                if imageutils.check_copy_or_link(operation.source, operation.path,
+                                                 options.dryrun, operation.action == LINK,
+                                                 options):
+                    pool.submit(operation)
+            except OSError as ex:
+                print >> sys.stderr, "Failed to %s %s: %s" % (
+                    operation.action, su.fsenc(operation.path), ex)
+    finally:
+        pool.close()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""This module tests exportplan.py."""
+
+# Copyright 2017 Benjamín Valero
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import phoshare.exportplan as exportplan
+
+
+class Options(object):
+    """The options used by the executor."""
+
+    def __init__(self):
+        self.dryrun = False
+        self.delete = True
+        self.update = True
+        self.max_create = -1
+        self.max_delete = -1
+        self.max_update = -1
+        self.jobs = 1
+        self.jobs_per_device = 0
+
+
+class ExportPlanTest(unittest.TestCase):
+    """Unit tests for exportplan.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, 'source.jpg')
+        self.root = os.path.join(self.folder, 'export')
+        with open(self.source, 'w') as f:
+            f.write('x' * 10)
+        os.mkdir(self.root)
+        self.obsolete = os.path.join(self.root, 'obsolete.jpg')
+        with open(self.obsolete, 'w') as f:
+            f.write('y' * 5)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def make_plan(self):
+        """Returns a plan that replaces obsolete.jpg by album/new.jpg."""
+        plan = exportplan.ExportPlan(self.root)
+        album = os.path.join(self.root, 'album')
+        plan.mkdir(self.root)
+        plan.mkdir(album)
+        plan.mkdir(album)
+        plan.copy(self.source, os.path.join(album, 'new.jpg'), False, u'')
+        plan.delete(self.obsolete, u'Obsolete')
+        return plan
+
+    def test_plan(self):
+        """Tests that planning does not touch any file."""
+        plan = self.make_plan()
+        self.assertEquals([exportplan.MKDIR, exportplan.CREATE, exportplan.DELETE],
+                          [operation.action for operation in plan])
+        self.assertEquals({exportplan.MKDIR: (1, 0), exportplan.CREATE: (1, 10),
+                           exportplan.DELETE: (1, 5)}, plan.get_summary())
+        self.assertTrue(plan.exists(os.path.join(self.root, 'album')))
+        self.assertFalse(plan.exists(self.obsolete))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'album')))
+        self.assertTrue(os.path.exists(self.obsolete))
+
+    def test_stat_cache(self):
+        """Tests that files are stat'ed once, until the cache is cleared."""
+        stats = exportplan.StatCache()
+        self.assertEquals(10, stats.stat(self.source).st_size)
+        self.assertTrue(stats.isdir(self.root))
+        self.assertFalse(stats.isdir(self.source))
+        missing = os.path.join(self.root, 'missing.jpg')
+        self.assertEquals(None, stats.lookup(missing))
+        self.assertRaises(OSError, stats.stat, missing)
+
+        os.remove(self.source)
+        self.assertEquals(10, stats.stat(self.source).st_size)
+        stats.clear()
+        self.assertEquals(None, stats.lookup(self.source))
+
+    def test_execute(self):
+        """Tests applying a plan, and a saved plan."""
+        plan_file = os.path.join(self.folder, 'plan.json')
+        self.make_plan().save(plan_file)
+        plan = exportplan.load_plan(plan_file)
+        self.assertEquals(3, len(plan))
+
+        options = Options()
+        options.dryrun = True
+        exportplan.execute_plan(plan, options)
+        self.assertTrue(os.path.exists(self.obsolete))
+
+        exportplan.execute_plan(plan, Options())
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'album', 'new.jpg')))
+        self.assertFalse(os.path.exists(self.obsolete))
+
+    def test_execute_jobs(self):
+        """Tests copying files on several threads."""
+        album = os.path.join(self.root, 'album')
+        os.mkdir(album)
+        targets = [os.path.join(album, '%d.jpg' % i) for i in xrange(20)]
+        with open(targets[0], 'w') as f:
+            f.write('old')
+        plan = exportplan.ExportPlan(self.root)
+        # An existing file, deleted and then copied again.
+        plan.delete(targets[0], u'Obsolete')
+        for target in targets:
+            plan.copy(self.source, target, False, u'')
+
+        options = Options()
+        options.jobs = 4
+        options.jobs_per_device = 2
+        exportplan.execute_plan(plan, options)
+        for target in targets:
+            self.assertEquals(10, os.path.getsize(target))
+
+        # The create limit is kept.
+        plan = exportplan.ExportPlan(self.root)
+        for i in xrange(5):
+            plan.copy(self.source, os.path.join(album, 'new%d.jpg' % i), False, u'')
+        options.max_create = 3
+        exportplan.execute_plan(plan, options)
+        self.assertEquals(23, len(os.listdir(album)))
+        self.assertEquals(0, options.max_create)
+
+    def test_delete_outside_root(self):
+        """Tests that a plan does not delete files outside of its folder."""
+        plan = exportplan.ExportPlan(self.root)
+        plan.delete(self.source, u'Obsolete')
+        exportplan.execute_plan(plan, Options())
+        self.assertTrue(os.path.exists(self.source))
+
+    def test_delete_broken_link(self):
+        """Tests deleting links to files that are gone."""
+        album = os.path.join(self.root, 'album')
+        os.mkdir(album)
+        link = os.path.join(album, 'link.jpg')
+        os.symlink(os.path.join(self.folder, 'missing.jpg'), link)
+        plan = exportplan.ExportPlan(self.root)
+        self.assertEquals([(u'link.jpg', False)], [
+            (name, plan.stats.isdir(os.path.join(album, name)))
+            for name in plan.stats.listdir(album)])
+        plan.delete(link, u'Obsolete')
+        self.assertEquals({exportplan.DELETE: (1, 0)}, plan.get_summary())
+        exportplan.execute_plan(plan, Options())
+        self.assertFalse(os.path.lexists(link))
+
+    def test_load_bad_plan(self):
+        """Tests that files that are not plans are rejected."""
+        self.assertRaises(ValueError, exportplan.load_plan, self.source)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,18 +24,20 @@
 #   2017-01-14: retrieve all necessary data entirely from Photos SQLite database
 #
 
+import datetime
 import getpass
 import logging
 import os
 import re
 import sys
 import time
-import unicodedata
 
 from optparse import OptionParser
 import MacOS
 
 import appledata.iphotodata as iphotodata
+import phoshare.exportmanifest as exportmanifest
+import phoshare.exportplan as exportplan
 import tilutil.exiftool as exiftool
 import tilutil.systemutils as su
 import tilutil.imageutils as imageutils
@@ -48,6 +50,10 @@ _MAX_FILE_DIFF = 60000
 # Fudge factor for file modification times
 _MTIME_FUDGE = 3
 
+# Snapshot of the last library load, used by --incremental.
+SNAPSHOT_PATH = su.expand_home_folder('~/Library/Application Support/Google/'
+                                       'Phoshare/library.snapshot')
+
 '''
 # List of extensions for image formats that support EXIF data. Sources:
 # - iPhoto help topic: About digital cameras that support RAW files
@@ -73,40 +79,12 @@ def region_matches(region1, region2):
     return True
 '''
 
-def delete_album_file(album_file, albumdirectory, msg, options):
-    """sanity check - only delete from album directory."""
-    if not album_file.startswith(albumdirectory):
-        print >> sys.stderr, (
-            "Internal error - attempting to delete file "
-            "that is not in album directory:\n    %s") % (su.fsenc(album_file))
-        return False
-    if msg:
-        print "%s: %s" % (msg, su.fsenc(album_file))
-
-    if not imageutils.should_delete(options):
-        return False
-    if options.dryrun:
-        return True
-
-    try:
-        if os.path.isdir(album_file):
-            file_list = os.listdir(album_file)
-            for subfile in file_list:
-                delete_album_file(os.path.join(album_file, subfile),
-                                  albumdirectory, msg, options)
-            os.rmdir(album_file)
-        else:
-            os.remove(album_file)
-        return True
-    except OSError as ex:
-        print >> sys.stderr, "Could not delete %s: %s" % (su.fsenc(album_file),
-                                                          ex)
-    return False
-
-
 class ExportFile(object):
     """Describes an exported image."""
 
+    # There is one export file per image and album, keep them small.
+    __slots__ = ('photo', 'export_file', 'original_export_file')
+
     def __init__(self, photo, container, export_directory, base_name, options):
         """Creates a new ExportFile object."""
         self.photo = photo
@@ -133,134 +111,85 @@ class ExportFile(object):
         return self.photo
     '''
 
-    def _check_need_to_export(self, source_file, options):
-        """Returns true if the image file needs to be exported.
+    @staticmethod
+    def _get_export_reason(plan, export_file, source_stat, options, check_size=True):
+        """Returns why an image file needs to be exported: u'' if export_file
+        does not exist yet, a description of the change if it is out of date,
+        or None if it is up to date.
 
         Args:
-          source_file: path to image file, with aliases resolved.
+          plan: the export plan, with the operations planned so far.
+          export_file: path to the exported file.
+          source_stat: os.stat() result of the image file.
           options: processing options.
+          check_size: whether a different file size counts as a change.
         """
-        if not os.path.exists(self.export_file):
-            return True
+        if not plan.exists(export_file):
+            return u''
+        export_stat = plan.stats.stat(export_file)
         # In link mode, check the inode.
-        if options.link:
-            export_stat = os.stat(self.export_file)
-            source_stat = os.stat(source_file)
-            if export_stat.st_ino != source_stat.st_ino:
-                su.pout('Changed:  %s: inodes don\'t match: %d vs. %d' %
-                        (self.export_file, export_stat.st_ino, source_stat.st_ino))
-                return True
-        if os.path.getmtime(self.export_file) + _MTIME_FUDGE < os.path.getmtime(source_file):
-            su.pout('Changed:  %s: newer version is available: %s vs. %s' %
-                    (self.export_file,
-                     time.ctime(os.path.getmtime(self.export_file)),
-                     time.ctime(os.path.getmtime(source_file))))
-            return True
+        if options.link and export_stat.st_ino != source_stat.st_ino:
+            return u'inodes don\'t match: %d vs. %d' % (export_stat.st_ino,
+                                                         source_stat.st_ino)
+        if export_stat.st_mtime + _MTIME_FUDGE < source_stat.st_mtime:
+            return u'newer version is available: %s vs. %s' % (
+                time.ctime(export_stat.st_mtime), time.ctime(source_stat.st_mtime))
+        if not check_size:
+            return None
 
         # With creative renaming in Photos it is possible to get
         # stale files if titles get swapped between images. Double
         # check the size, allowing for some difference for meta data
         # changes made in the exported copy
-        source_size = os.path.getsize(source_file)
-        export_size = os.path.getsize(self.export_file)
+        source_size = source_stat.st_size
+        export_size = export_stat.st_size
         diff = abs(source_size - export_size)
         if diff > _MAX_FILE_DIFF or (diff > 32 and options.link):
-            su.pout('Changed:  %s: file size: %d vs. %d' %
-                    (self.export_file, export_size, source_size))
-            return True
-
-        return False
-
-
-    def _generate_original(self, options):
-        """Exports the original file."""
-        do_original_export = False
-        export_dir = os.path.split(self.original_export_file)[0]
-        if not os.path.exists(export_dir):
-            su.pout("Creating folder " + export_dir)
-            if not options.dryrun:
-                os.mkdir(export_dir)
-        original_source_file = su.resolve_alias(self.photo.originalpath)
-        if os.path.exists(self.original_export_file):
-            # In link mode, check the inode.
-            if options.link:
-                export_stat = os.stat(self.original_export_file)
-                source_stat = os.stat(original_source_file)
-                if export_stat.st_ino != source_stat.st_ino:
-                    su.pout('Changed:  %s: inodes don\'t match: %d vs. %d' %
-                            (self.original_export_file, export_stat.st_ino, source_stat.st_ino))
-                    do_original_export = True
-            if (os.path.getmtime(self.original_export_file) + _MTIME_FUDGE <
-                os.path.getmtime(original_source_file)):
-                su.pout('Changed:  %s: newer version is available: %s vs. %s' %
-                        (self.original_export_file,
-                         time.ctime(os.path.getmtime(
-                             self.original_export_file)),
-                         time.ctime(os.path.getmtime(original_source_file))))
-                do_original_export = True
-        else:
-            do_original_export = True
-
-        '''
-        do_iptc = (options.iptc == 1 and
-                   do_original_export) or options.iptc == 2
-        if do_iptc and options.link:
-            if self.check_iptc_data(original_source_file, options,
-                                    is_original=True, file_updated=do_original_export):
-                do_original_export = True
-        '''
-
-        exists = True  # True if the file exists or was updated.
-        if do_original_export:
-            exists = imageutils.copy_or_link_file(original_source_file,
-                                                  self.original_export_file,
-                                                  options.dryrun,
-                                                  options.link,
-                                                  options)
+            return u'file size: %d vs. %d' % (export_size, source_size)
+
+        return None
+
+    def _plan_file(self, plan, manifest, source_path, export_file, options,
+                   check_size=True):
+        """Plans the export of a file of the image (the image, or its
+        original). Files the manifest knows to be up to date are not looked
+        at."""
+        if (manifest is not None and plan.exists(export_file) and
+                manifest.is_current(export_file, self.photo, source_path, options.link)):
+            _logger.debug(u'%s up to date.', export_file)
+            return
+        source_file = su.resolve_alias(source_path)
+        source_stat = plan.stats.lookup(source_file)
+        if source_stat is None:
+            # An offline referenced master, for example. Export the others.
+            print >> sys.stderr, "Failed to export %s to %s: file is missing." % (
+                su.fsenc(source_file), su.fsenc(export_file))
+            return
+        reason = self._get_export_reason(plan, export_file, source_stat, options, check_size)
+        export_stat = None
+        if reason is not None:
+            plan.copy(source_file, export_file, options.link, reason)
         else:
-            _logger.debug(u'%s up to date.', self.original_export_file)
-
-        '''
-        if exists and do_iptc and not options.link:
-            self.check_iptc_data(self.original_export_file, options,
-                                 is_original=True, file_updated=do_original_export)
-        '''
-
-    def generate(self, options):
-        """makes sure all files exist in other album, and generates if
-           necessary."""
+            _logger.debug(u'%s up to date.', export_file)
+            export_stat = plan.stats.stat(export_file)
+        if manifest is not None:
+            manifest.record(export_file, self.photo, source_path, source_stat, options.link,
+                            export_stat)
+
+    def plan(self, plan, manifest, options):
+        """Plans the operations that make sure the file exists in the album,
+        and is up to date. manifest is the exportmanifest.ExportManifest of the
+        export folder, or None."""
         try:
-            source_file = su.resolve_alias(self.photo.image_path)
-            do_export = self._check_need_to_export(source_file, options)
-            '''
-            # if we use links, we update the IPTC data in the original file
-            do_iptc = (options.iptc == 1 and do_export) or options.iptc == 2
-            if do_iptc and options.link:
-                if self.check_iptc_data(source_file, options, file_updated=do_export):
-                    do_export = True
-            '''
-            exists = True  # True if the file exists or was updated.
-            if do_export:
-                exists = imageutils.copy_or_link_file(source_file,
-                                                      self.export_file,
-                                                      options.dryrun,
-                                                      options.link,
-                                                      options)
-            else:
-                _logger.debug(u'%s up to date.', self.export_file)
-
-            '''
-            # if we copy, we update the IPTC data in the copied file
-            if exists and do_iptc and not options.link:
-                self.check_iptc_data(self.export_file, options, file_updated=do_export)
-            '''
-
+            self._plan_file(plan, manifest, self.photo.image_path, self.export_file, options)
             if options.originals and self.photo.originalpath:
-                self._generate_original(options)
+                plan.mkdir(os.path.split(self.original_export_file)[0])
+                self._plan_file(plan, manifest, self.photo.originalpath,
+                                self.original_export_file, options, check_size=False)
 
         except (OSError, MacOS.Error) as ose:
-            su.perr(u"Failed to export %s to %s: %s" % (self.photo.image_path, self.export_file,
-                                                        ose))
+            print >> sys.stderr, "Failed to export %s to %s: %s" % (
+                su.fsenc(self.photo.image_path), su.fsenc(self.export_file), ose)
 
     '''
     def get_export_keywords(self, do_face_keywords):
@@ -394,6 +323,8 @@ _YEAR_PATTERN_INDEX = re.compile(r'([0-9][0-9][0-9][0-9]) (.*)')
 class ExportDirectory(object):
     """Tracks an album folder in the export location."""
 
+    __slots__ = ('iphoto_container', 'albumdirectory', 'files')
+
     def __init__(self, name, iphoto_container, albumdirectory):
         '''
         self.name = name
@@ -440,19 +371,15 @@ class ExportDirectory(object):
             index += 1
         return base_name
 
-    def load_album(self, options):
-        """walks the album directory tree, and scans it for existing files."""
-        if not os.path.exists(self.albumdirectory):
-            su.pout("Creating folder " + self.albumdirectory)
-            if not options.dryrun:
-                os.makedirs(self.albumdirectory)
-            else:
-                return
-        file_list = os.listdir(self.albumdirectory)
-        if file_list is None:
+    def load_album(self, plan, options):
+        """walks the album directory tree, and scans it for existing files.
+        Obsolete files are added to plan for deletion."""
+        if not plan.exists(self.albumdirectory):
+            plan.mkdir(self.albumdirectory)
             return
 
-        for f in sorted(file_list):
+        albumdirectory = su.nfc(self.albumdirectory)
+        for f in plan.stats.listdir(albumdirectory):
             # TODO Check ignored files
             '''
             # we won't touch some files
@@ -460,65 +387,52 @@ class ExportDirectory(object):
                 continue
             '''
 
-            album_file = unicodedata.normalize("NFC",
-                                               os.path.join(self.albumdirectory,
-                                                            f))
-            if os.path.isdir(album_file):
+            album_file = os.path.join(albumdirectory, f)
+            if plan.stats.isdir(album_file):
                 if options.originals and f == "Originals":
-                    self.scan_originals(album_file, options)
+                    self.scan_originals(plan, album_file)
                     continue
                 else:
-                    delete_album_file(album_file, self.albumdirectory,
-                                      "Obsolete export directory", options)
+                    plan.delete(album_file, "Obsolete export directory")
                     continue
 
-            base_name = unicodedata.normalize("NFC",
-                                              su.getfilebasename(album_file))
+            base_name = su.getfilebasename(album_file)
             master_file = self.files.get(base_name.lower())
 
             # everything else must have a master, or will have to go
             if master_file is None or not master_file.is_part_of(album_file):
-                delete_album_file(album_file, self.albumdirectory,
-                                  "Obsolete exported file", options)
+                plan.delete(album_file, "Obsolete exported file")
 
 
-    def scan_originals(self, folder, options):
+    def scan_originals(self, plan, folder):
         """Scan a folder of Original images, and delete obsolete ones."""
-        file_list = os.listdir(folder)
-        if not file_list:
-            return
-
-        for f in file_list:
+        # Originals keep the file names of the library, not the names of the
+        # exported images.
+        original_files = set(export_file.original_export_file
+                             for export_file in self.files.itervalues())
+        for f in plan.stats.listdir(folder):
             '''
             # We won't touch some files.
             if imageutils.is_ignore(f):
                 continue
             '''
 
-            originalfile = unicodedata.normalize("NFC", os.path.join(folder, f))
-            if os.path.isdir(originalfile):
-                delete_album_file(originalfile, self.albumdirectory,
-                                  "Obsolete export Originals directory",
-                                  options)
+            originalfile = os.path.join(folder, f)
+            if plan.stats.isdir(originalfile):
+                plan.delete(originalfile, "Obsolete export Originals directory")
                 continue
 
-            base_name = unicodedata.normalize("NFC",
-                                              su.getfilebasename(originalfile))
-            master_file = self.files.get(base_name.lower())
+            # everything else must be the original of an exported image, or
+            # will have to go
+            if originalfile not in original_files:
+                plan.delete(originalfile, "Obsolete Original")
 
-            # everything else must have a master, or will have to go
-            if (not master_file or
-                originalfile != master_file.original_export_file):
-                delete_album_file(originalfile, originalfile,
-                                  "Obsolete Original", options)
 
-
-    def generate_files(self, options):
-        """Generates the files in the export location."""
-        if not os.path.exists(self.albumdirectory) and not options.dryrun:
-            os.makedirs(self.albumdirectory)
+    def plan_files(self, plan, manifest, options):
+        """Plans the files to generate in the export location."""
+        plan.mkdir(self.albumdirectory)
         for f in sorted(self.files):
-            self.files[f].generate(options)
+            self.files[f].plan(plan, manifest, options)
 
 '''
 class IPhotoFace(iphotodata.IPhotoContainer):
@@ -538,6 +452,17 @@ class ExportLibrary(object):
     def __init__(self, albumdirectory):
         self.albumdirectory = albumdirectory
         self.named_folders = {}
+        self._folder_prefixes = {}
+        # Ids of the images to export, or None to export all images.
+        self.selected_image_ids = None
+        # Operations planned, and not applied yet.
+        self.plan = exportplan.ExportPlan(albumdirectory)
+        # The exportmanifest.ExportManifest of the export folder, if used.
+        self.manifest = None
+        # {action: [count, bytes]} of the operations applied, and the time it
+        # took.
+        self.applied = {}
+        self.apply_seconds = 0.0
         self._abort = False
 
     '''
@@ -562,13 +487,31 @@ class ExportLibrary(object):
                 proposed = u'%s_(%d)' % (folder, i)
             else:
                 proposed = folder
-            if self.named_folders.get(proposed) is None:
+            if proposed not in self.named_folders:
                 return proposed
             i += 1
 
-    def process_albums(self, albums, album_types, folder_prefix, options):
+    def _get_folder_prefix(self, folder):
+        """Returns the export directory prefix of the albums in a folder, like
+        "a/b/". Many albums share their folders, so prefixes are kept."""
+        if folder is None:
+            return u''
+        prefix = self._folder_prefixes.get(folder)
+        if prefix is None:
+            prefix = (self._get_folder_prefix(folder.parent) +
+                      imageutils.make_foldername(folder.name) + "/")
+            self._folder_prefixes[folder] = prefix
+        return prefix
+
+    def process_albums(self, albums, album_types, folder_prefix, options,
+                       export=False):
         """Walks trough an Photos album tree, and discovers albums
-           (directories)."""
+           (directories).
+
+           If export is set, each album is also loaded and its files
+           generated right away, and then released, so that only one album
+           is in memory at a time. Only the folder names are kept, for
+           check_obsolete()."""
         album_includes = "."
         if options.albums:
             album_includes = options.albums
@@ -578,13 +521,14 @@ class ExportLibrary(object):
         if options.events:
             folder_includes = options.events
         folder_pattern = re.compile(su.unicode_string(folder_includes), re.IGNORECASE)
+        folder_matches = {}
 
         for sub_album in albums:
             if self._check_abort():
                 return
             sub_name = sub_album.name
             if not sub_name:
-                print "Found an album with no name: " + sub_album.albumid
+                print "Found an album with no name: %s" % sub_album.albumid
                 sub_name = "xxx"
             
             # TODO check the album type
@@ -600,70 +544,84 @@ class ExportLibrary(object):
 
             _logger.debug(u'Loading "%s".', sub_name)
 
-            folder_hint = sub_album.getfolderhint()
-            _logger.debug(u'Parent folders: %s', folder_hint)
-
-            if folder_hint is not None:
-                is_folder_match = False
-                for parent_folder in folder_hint.split('/'):
-                    if folder_pattern.match(parent_folder):
-                        is_folder_match = True
-                        break
+            folder = sub_album.folder
+            _logger.debug(u'Parent folders: %s', sub_album.getfolderhint())
+
+            if folder is not None:
+                is_folder_match = folder_matches.get(folder)
+                if is_folder_match is None:
+                    is_folder_match = False
+                    for parent_folder in folder.names:
+                        if folder_pattern.match(parent_folder):
+                            is_folder_match = True
+                            break
+                    folder_matches[folder] = is_folder_match
                 if not is_folder_match:
-                    _logger.debug(u'Skipping "%s" because it does not match folder pattern.', folder_hint)
+                    _logger.debug(u'Skipping "%s" because it does not match folder pattern.',
+                                  folder.path)
                     continue
 
-            prefix = folder_prefix  # TODO Normalmente vacio salvo "." para albumes de caras
-            if folder_hint is not None:
-                for parent_folder in folder_hint.split('/'):
-                    prefix = prefix + imageutils.make_foldername(parent_folder) + "/"
+            # TODO Normalmente vacio salvo "." para albumes de caras
+            prefix = folder_prefix + self._get_folder_prefix(folder)
             formatted_name = imageutils.format_album_name(
                 sub_album, sub_name, options.foldertemplate)
             sub_name = prefix + imageutils.make_foldername(formatted_name)
             sub_name = self._find_unused_folder(sub_name)
 
+            images = sub_album.images
+            if self.selected_image_ids is not None:
+                images = [image for image in images
+                          if image.id in self.selected_image_ids]
             picture_directory = ExportDirectory(
                 sub_name, sub_album,
                 os.path.join(self.albumdirectory, sub_name))
-            if picture_directory.add_iphoto_images(sub_album.images,
-                                                   options) > 0:
+            if picture_directory.add_iphoto_images(images, options) > 0:
+                if export:
+                    picture_directory.load_album(self.plan, options)
+                    picture_directory.plan_files(self.plan, self.manifest, options)
+                    self.apply_plan(options)
+                    picture_directory = None
                 self.named_folders[sub_name] = picture_directory
 
         return len(self.named_folders)
 
     def load_album(self, options):
         """Loads an existing album (export folder)."""
-        if not os.path.exists(self.albumdirectory) and not options.dryrun:
-            os.makedirs(self.albumdirectory)
-
-        album_directories = {}
         for folder in sorted(self.named_folders.values()):
             if self._check_abort():
                 return
-            album_directories[folder.albumdirectory] = True
-            folder.load_album(options)
+            folder.load_album(self.plan, options)
 
+        self.check_obsolete(options)
+
+    def check_obsolete(self, options):
+        """Plans the deletion of the files and directories of the export folder
+        that do not belong to any album."""
+        album_directories = {}
+        for sub_name in self.named_folders:
+            album_directories[os.path.join(self.albumdirectory, sub_name)] = True
         self.check_directories(self.albumdirectory, "", album_directories,
                                options)
 
     def check_directories(self, directory, rel_path, album_directories,
                           options):
         """Checks an export directory for obsolete files."""
-        if not os.path.exists(directory):
+        if self.plan.stats.lookup(directory) is None:
             return True
         contains_albums = False
-        for f in su.os_listdir_unicode(directory):
+        for f in self.plan.stats.listdir(directory):
             if self._check_abort():
                 return
+            if not rel_path and f.startswith(exportmanifest.MANIFEST_NAME):
+                continue
             album_file = os.path.join(directory, f)
-            if os.path.isdir(album_file):
+            if self.plan.stats.isdir(album_file):
                 rel_path_file = os.path.join(rel_path, f)
                 if album_file in album_directories:
                     contains_albums = True
                 elif not self.check_directories(album_file, rel_path_file,
                                                 album_directories, options):
-                    delete_album_file(album_file, directory,
-                                      "Obsolete directory", options)
+                    self.plan.delete(album_file, "Obsolete directory")
                 else:
                     contains_albums = True
             else:
@@ -672,37 +630,151 @@ class ExportLibrary(object):
                 if imageutils.is_ignore(f):
                     continue
                 '''
-                delete_album_file(album_file, directory, "Obsolete",
-                                  options)
+                self.plan.delete(album_file, "Obsolete")
 
         return contains_albums
 
     def generate_files(self, options):
-        """Walks through the export tree and sync the files."""
-        if not os.path.exists(self.albumdirectory) and not options.dryrun:
-            os.makedirs(self.albumdirectory)
+        """Walks through the export tree and plans the files to sync."""
         for ndir in sorted(self.named_folders):
             if self._check_abort():
                 break
-            self.named_folders[ndir].generate_files(options)
+            self.named_folders[ndir].plan_files(self.plan, self.manifest, options)
+
+    def apply_plan(self, options):
+        """Applies the planned operations, unless the plan is to be saved with
+        --plan_out."""
+        if options.plan_out:
+            return
+        start = time.time()
+        for action, (count, size) in self.plan.get_summary().iteritems():
+            applied = self.applied.setdefault(action, [0, 0])
+            applied[0] += count
+            applied[1] += size
+        exportplan.execute_plan(self.plan, options)
+        if self.manifest is not None:
+            self.manifest.commit(self.plan)
+        self.plan.clear()
+        self.apply_seconds += time.time() - start
+
+
+def log_memory_report(data, library):
+    """Logs how many model and export objects are held in memory, and their
+    size (without the strings and lists they refer to)."""
+    sizes = {}  # class name -> [count, bytes]
+    def add_object(obj):
+        """Counts an object."""
+        size = sizes.setdefault(obj.__class__.__name__, [0, 0])
+        size[0] += 1
+        size[1] += su.get_object_size(obj)
+
+    # Only the images looked up by exported albums are created and held. With
+    # --low_memory or --columnar, images are not held at all.
+    if hasattr(data.images_by_id, 'itercreated'):
+        for image in data.images_by_id.itercreated():
+            add_object(image)
+        _logger.debug(u'Memory: %d of %d images created.',
+                      data.images_by_id.getcreatedcount(), len(data.images_by_id))
+    for album in data.root_album.albums:
+        add_object(album)
+    for folder in library.named_folders.itervalues():
+        if folder is not None:
+            add_object(folder)
+            for export_file in folder.files.itervalues():
+                add_object(export_file)
+
+    for class_name in sorted(sizes):
+        count, size = sizes[class_name]
+        _logger.debug(u'Memory: %d %s objects, %d bytes (%d bytes each).',
+                      count, class_name, size, size / count)
+
+
+# Types of the albums exported with --albums and --folders.
+_ALBUM_TYPES = ["Regular", "Published", "Smart"]
+
+
+def log_plan_report(library, plan_seconds):
+    """Logs how many operations were applied, and how long planning and
+    applying them took."""
+    for action in exportplan.ACTIONS:
+        if action in library.applied:
+            count, size = library.applied[action]
+            _logger.debug(u'Plan: %d %s operations, %d bytes.', count, action, size)
+    _logger.debug(u'Planning took %.2f seconds, applying the plan %.2f seconds.',
+                  plan_seconds, library.apply_seconds)
 
 
 def export_iphoto(library, data, options):
     """Main routine for exporting Photos images."""
 
     print "Scanning Photos data for photos to export..."
+    start = time.time()
+
+    if options.since or options.until:
+        library.selected_image_ids = set(data.select(options.since, options.until))
+        _logger.debug(u'%d images in the date range.', len(library.selected_image_ids))
+
+    if not options.no_manifest:
+        library.manifest = exportmanifest.ExportManifest(
+            library.albumdirectory, read_only=bool(options.dryrun or options.plan_out))
+    try:
+        _export_albums(library, data, options)
+    finally:
+        # Also when the export is cancelled or fails part way.
+        if library.manifest is not None:
+            library.manifest.close()
+            library.manifest = None
+    log_plan_report(library, time.time() - start - library.apply_seconds)
+
+
+def _export_albums(library, data, options):
+    """Plans and applies the export of the selected albums, or saves the plan
+    with --plan_out."""
+    library.plan.mkdir(library.albumdirectory)
+    if options.low_memory:
+        # Each album is scanned and exported before the next one is read.
+        print "Exporting photos from Photos to export folder, album by album..."
+        if options.events or options.albums:
+            library.process_albums(data.streamalbums(), _ALBUM_TYPES, u'',
+                                   options, export=True)
+        if options.facealbums:
+            library.process_albums(data.getfacealbums(), ["Face"],
+                                   unicode(options.facealbum_prefix), options, export=True)
+        print "Checking export folder for obsolete files..."
+        library.check_obsolete(options)
+    else:
+        if options.events or options.albums:
+            library.process_albums(data.iteralbums(), _ALBUM_TYPES, u'', options)
+
+        if options.facealbums:
+            library.process_albums(data.getfacealbums(), ["Face"],
+                                   unicode(options.facealbum_prefix), options)
 
-    if options.events or options.albums:
-        library.process_albums(data.root_album.albums, ["Regular", "Published"], u'', options)
+        print "Scanning existing files in export folder..."
+        library.load_album(options)
+        library.generate_files(options)
+        print "Exporting photos from Photos to export folder..."
 
-    if options.facealbums:
-        library.process_albums(data.getfacealbums(), ["Face"], unicode(options.facealbum_prefix), options)
+    if options.plan_out:
+        library.plan.save(options.plan_out)
+        print "Saved export plan with %d operations to %s." % (len(library.plan),
+                                                              options.plan_out)
+        return
+    library.apply_plan(options)
 
-    print "Scanning existing files in export folder..."
-    library.load_album(options)
 
-    print "Exporting photos from Photos to export folder..."
-    library.generate_files(options)
+def apply_saved_plan(options):
+    """Applies an export plan saved with --plan_out."""
+    try:
+        plan = exportplan.load_plan(options.apply_plan)
+    except (IOError, ValueError) as ex:
+        print >> sys.stderr, "Cannot read export plan: %s" % ex
+        return 1
+    print "Applying export plan with %d operations to %s..." % (len(plan), su.fsenc(plan.root))
+    start = time.time()
+    exportplan.execute_plan(plan, options)
+    _logger.debug(u'Applying the plan took %.2f seconds.', time.time() - start)
+    return 0
 
 USAGE = """usage: %prog [options]
 Exports images and movies from an Photos library into a folder.
@@ -715,11 +787,22 @@ def get_option_parser():
     p = OptionParser(usage=USAGE)
     p.add_option(
         "-a", "--albums",
-        help="""Export matching regular albums. The argument
-        is a regular expression. Use -a . to export all regular albums.""")
+        help="""Export matching regular and smart albums. The argument
+        is a regular expression. Use -a . to export all albums.""")
+    p.add_option("--apply_plan", metavar="FILE",
+                 help="""Apply an export plan saved with --plan_out, without
+                 reading the Photos library. Use with -d and -u to allow
+                 deletes and updates, like when exporting.""")
     p.add_option(
         '--captiontemplate', default='{description}',
         help='Template for IPTC image captions. Default: "{description}".')
+    p.add_option("--columnar", action="store_true",
+                 help="""Keep the image data in compact columns instead of one
+                 object per image, which takes less memory for large
+                 libraries.""")
+    p.add_option("--concurrent_read", action="store_true",
+                 help="""Read the Photos databases on separate threads, which
+                 is faster for libraries on slow disks.""")
     p.add_option(
         "-d", "--delete", action="store_true",
         help="Delete obsolete files that are no longer in your Photos library.")
@@ -748,10 +831,20 @@ def get_option_parser():
                  help="""Template for naming folders. Default: "{name}".""")
     p.add_option("--gps", action="store_true",
                  help="Process GPS location information")
+    p.add_option("--incremental", action="store_true",
+                 help="""Remember the library between runs, and only read the
+                 images and albums that changed since the last run.""")
     p.add_option("--iphoto",
                  help="""Path to Photos library, e.g.
                  "%s/Pictures/iPhoto Library".""",
                  default="~/Pictures/iPhoto Library")   # TODO Adapt to Photos default
+    p.add_option("-j", "--jobs", type='int', default=1,
+                 help="""Number of files to copy at the same time. Default: 1.
+                 Exports to fast disks or network storage are faster with
+                 more.""")
+    p.add_option("--jobs_per_device", type='int', default=0,
+                 help="""Maximum number of files to copy to the same device
+                 at the same time (use with --jobs). Default: no limit.""")
     p.add_option(
         "-k", "--iptc", action="store_const", const=1, dest="iptc",
         help="""Check the IPTC data of all new or updated files. Checks for
@@ -767,16 +860,38 @@ def get_option_parser():
       help="""Use links instead of copying files. Use with care, as changes made
       to the exported files might affect the image that is stored in the Photos
       library.""")
+    p.add_option("--low_memory", action="store_true",
+                 help="""Keep the library on disk and export one album at a
+                 time, for large libraries on machines with little memory.
+                 Disables --incremental and --concurrent_read.""")
     p.add_option("--max_create", type='int', default=-1,
                  help='Maximum number of images to create.')
     p.add_option("--max_delete", type='int', default=-1,
                  help='Maximum number of images to delete.')
     p.add_option("--max_update", type='int', default=-1,
                  help='Maximum number of images to update.')
+    p.add_option("--memory_copy", action="store_true",
+                 help="""Copy the Photos database to memory in one short read
+                 before querying it, to get a consistent view of a library
+                 that Photos is changing.""")
     p.add_option("-n", "--nametemplate", default="{title}",
                  help="""Template for naming image files. Default: "{title}".""")
+    p.add_option("--no_manifest", action="store_true",
+                 help="""Do not keep a manifest of the exported files in the
+                 export folder. With the manifest, images that did not change
+                 in Photos since the last export are not looked at again.""")
     p.add_option("-o", "--originals", action="store_true",
                  help="Export original files into Originals.")
+    p.add_option("--plan_out", metavar="FILE",
+                 help="""Save the operations the export would do to FILE,
+                 without doing them. Use --apply_plan to do them later.""")
+    p.add_option("--since",
+                 help="""Only export images taken on or after this date, given
+                 as YYYY-MM-DD. Exported images outside the range count as
+                 obsolete.""")
+    p.add_option("--until",
+                 help="""Only export images taken on or before this date, given
+                 as YYYY-MM-DD.""")
     p.add_option("-u", "--update", action="store_true",
                  help="Update existing files.")
     p.add_option('--verbose', action='store_true', 
@@ -786,6 +901,13 @@ def get_option_parser():
     return p
 
 
+def _parse_date(value):
+    """Parses a YYYY-MM-DD date option. Returns None if value is not set."""
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
 def run_phoshare(cmd_args):
     """main routine for phoshare."""
     parser = get_option_parser()
@@ -804,7 +926,11 @@ def run_phoshare(cmd_args):
     if not options.iphoto:
         parser.error("Need to specify the Photos library with the --iphoto option.")
 
-    if options.export:
+    if options.apply_plan:
+        if options.export:
+            parser.error("--apply_plan exports the files of the plan, and cannot "
+                         "be used with --export.")
+    elif options.export:
         if not (options.albums or options.events or options.facealbums):
             parser.error("Need to specify at least one event or album "
                          "or exporting, using the -e or -a options.")
@@ -812,20 +938,50 @@ def run_phoshare(cmd_args):
         parser.error("No action specified. Use --export to export from your "
                      "Photos library.")
 
+    try:
+        options.since = _parse_date(options.since)
+        options.until = _parse_date(options.until)
+    except ValueError:
+        parser.error("Dates for --since and --until must be given as YYYY-MM-DD.")
+    if options.until:
+        # The whole day is included.
+        options.until += datetime.timedelta(days=1)
+
     logging_handler = logging.StreamHandler()
     logging_handler.setLevel(logging.DEBUG if options.verbose else logging.INFO)
     _logger.addHandler(logging_handler)
 
+    if options.apply_plan:
+        return apply_saved_plan(options)
+
     photos_library_dir = su.expand_home_folder(options.iphoto)
-    data = iphotodata.get_iphoto_data(photos_library_dir, verbose=options.verbose)
+    data = iphotodata.get_iphoto_data(
+        photos_library_dir, verbose=options.verbose,
+        snapshot_file=SNAPSHOT_PATH if options.incremental else None,
+        # Face albums need all images, not just the ones in the selected albums.
+        album_filter=None if options.facealbums else options.albums,
+        folder_filter=None if options.facealbums else options.events,
+        in_memory=options.memory_copy, concurrent=options.concurrent_read,
+        out_of_core=options.low_memory, columnar=options.columnar)
 
     options.foldertemplate = unicode(options.foldertemplate)
     options.nametemplate = unicode(options.nametemplate)
     options.captiontemplate = unicode(options.captiontemplate)
 
-    if options.export:
-        album = ExportLibrary(su.expand_home_folder(options.export))
-        export_iphoto(album, data, options)
+    try:
+        if options.export:
+            album = ExportLibrary(su.expand_home_folder(options.export))
+            export_iphoto(album, data, options)
+            if options.verbose:
+                log_memory_report(data, album)
+    finally:
+        # The albums of a streamed library may not all have been read, with
+        # --facealbums alone or when the export stops early.
+        data.close()
+
+    nfc_stats = su.get_nfc_stats()
+    _logger.debug(u'Unicode normalization: %d ASCII, %d cached, %d normalized strings.',
+                  nfc_stats['ascii'], nfc_stats['cached'], nfc_stats['normalized'])
 
 
 def main():
@@ -14,10 +14,33 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
 
+import phoshare.exportplan as exportplan
 import phoshare.phoshare_main as pm
 
+
+class Photo(object):
+    """The image attributes used when planning an export."""
+
+    def __init__(self, image_path, originalpath=None):
+        self.id = 1
+        self.mod_time = None
+        self.image_path = image_path
+        self.originalpath = originalpath
+
+
+class Options(object):
+    """The options used when planning an export."""
+
+    def __init__(self):
+        self.link = False
+        self.originals = True
+
+
 class PhoshareMainTest(unittest.TestCase):
     """Unit tests for phoshare_main.py code."""
 
@@ -39,5 +62,27 @@ class PhoshareMainTest(unittest.TestCase):
         self.assertFalse(pm.region_matches([1, 2, 3], []))
         self.assertFalse(pm.region_matches([], [1, 2, 3]))
 
+    def test_plan_missing_source(self):
+        """Tests that images whose file is missing are skipped."""
+        folder = tempfile.mkdtemp()
+        try:
+            source = os.path.join(folder, u'a.jpg')
+            with open(source, 'w') as f:
+                f.write('x' * 10)
+            root = os.path.join(folder, u'export')
+            plan = exportplan.ExportPlan(root)
+            missing = pm.ExportFile(Photo(os.path.join(folder, u'missing.jpg')), None,
+                                    root, u'missing', Options())
+            missing.plan(plan, None, Options())
+            self.assertEquals(0, len(plan))
+            present = pm.ExportFile(Photo(source, os.path.join(folder, u'gone.jpg')), None,
+                                    root, u'present', Options())
+            present.plan(plan, None, Options())
+            self.assertEquals([(exportplan.CREATE, os.path.join(root, u'present.jpg')),
+                               (exportplan.MKDIR, os.path.join(root, u'Originals'))],
+                              [(operation.action, operation.path) for operation in plan])
+        finally:
+            shutil.rmtree(folder)
+
 if __name__ == '__main__':
     unittest.main()
@@ -743,6 +743,13 @@ Metadata options will be disabled if exiftool is not available.""")
             self.facealbums = False
             self.facealbum_prefix = ''
             self.face_keywords = False
+            self.low_memory = False
+            self.jobs = 1
+            self.jobs_per_device = 0
+            self.since = None
+            self.until = None
+            self.plan_out = None
+            self.no_manifest = False
             self.verbose = False
 
         def load(self):
@@ -867,13 +874,15 @@ Metadata options will be disabled if exiftool is not available.""")
             library_path = su.expand_home_folder(self.iphoto_library.get())
             data = None
             try:
-                data = iphotodata.get_iphoto_data(library_path)
+                # Re-use the last load while the library is unchanged.
+                data = iphotodata.get_iphoto_data(
+                    library_path, snapshot_file=phoshare_main.SNAPSHOT_PATH)
             except ValueError as e:
                 self.thread_queue.put(("done", (False, mode, str(e))))
                 return
 
             msg = "Version %s library with %d images" % (
-                data.applicationVersion, len(data.images))
+                data.applicationVersion, len(data.images_by_id))
             self.write(msg + '\n')
             if mode == "library":
                 # If we just need to check the library, we are done here.
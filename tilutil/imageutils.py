@@ -23,7 +23,6 @@ import re
 import shutil
 import sys
 import tilutil.systemutils as su
-import unicodedata
 
 '''
 # ImageMagick "convert" tool. Obsolete - should use _SIPS_TOOL only.
@@ -148,7 +147,14 @@ def make_image_filename(name):
             result += '-'
         else:
             result += ' '
-    return unicodedata.normalize("NFC", result)
+    return su.nfc(result)
+
+# File extensions of movie files, in lower case.
+MOVIE_EXTENSIONS = ("mov", "avi", "m4v", "mpg", "3pg")
+
+def is_movie_file(file_name):
+    """Tests if the file (name or full path) is a movie file."""
+    return su.getfileextension(file_name) in MOVIE_EXTENSIONS
 
 '''
 def is_image_file(file_name):
@@ -160,10 +166,6 @@ def is_sharable_image_file(file_name):
     """Tests if the file (name or full path) is an image file in a format suitable for sharing."""
     return su.getfileextension(file_name) in ("jpg", "jpeg", "tif", "png")
 
-def is_movie_file(file_name):
-    """Tests if the file (name or full path) is a movie file."""
-    return su.getfileextension(file_name) in ("mov", "avi", "m4v", "mpg", "3pg")
-
 def is_media_file(file_name):
     """Tests if the file (name or full path) is either an image or a movie file
     """
@@ -433,6 +435,20 @@ def get_photo_caption(photo, container, caption_template):
 
 _YEAR_PATTERN_INDEX = re.compile(r'([0-9][0-9][0-9][0-9]) (.*)')
 
+# Template fields that need the date of a photo or album.
+_DATE_FIELD_PATTERN = re.compile(r'{(yyyy|mm|dd)\W')
+
+
+def _get_date_fields(item, template):
+    """Returns the year, month and day of a photo or album as strings, or empty
+    strings if it has no date. The date is only looked up if template uses
+    it, as converting it from the Photos database is not free."""
+    if _DATE_FIELD_PATTERN.search(template):
+        date = item.date
+        if date:
+            return str(date.year), str(date.month).zfill(2), str(date.day).zfill(2)
+    return '', '', ''
+
 
 def format_album_name(album, name, folder_template):
     """Formats a folder name using a template.
@@ -452,15 +468,8 @@ def format_album_name(album, name, folder_template):
     if match:
         nodate_name = match.group(2)
 
-    if album.date:
-        year = str(album.date.year)
-        month = str(album.date.month).zfill(2)
-        day = str(album.date.day).zfill(2)
-    else:
-        year = ''
-        month = ''
-        day = ''
-    
+    year, month, day = _get_date_fields(album, folder_template)
+
     try:
         return folder_template.format(
             album=name,
@@ -486,14 +495,7 @@ def format_photo_name(photo, album_name, index, padded_index,
     orig_basename = re.sub(
         re.compile(r'\.(jpeg|jpg|mpg|mpeg|mov|png|tif|tiff)$',
                    re.IGNORECASE), '', photo.caption)
-    if photo.date:
-        year = str(photo.date.year)
-        month = str(photo.date.month).zfill(2)
-        day = str(photo.date.day).zfill(2)
-    else:
-        year = ''
-        month = ''
-        day = ''
+    year, month, day = _get_date_fields(photo, name_template)
     nodate_album_name = album_name
     match = re.match(_YEAR_PATTERN_INDEX, nodate_album_name)
     if match:
@@ -540,6 +542,44 @@ def format_photo_name(photo, album_name, index, padded_index,
     return make_image_filename(formatted_name)
 
 
+def check_copy_or_link(source, target, dryrun=False, link=False, options=None):
+    """Decides if an image file is to be copied or linked, counting it against
+    the create and update limits of options.
+
+    Returns: True if do_copy_or_link() should be called.
+    """
+    if link:
+        mode = " (link)"
+    else:
+        mode = " (copy)"
+    if os.path.exists(target):
+        _logger.info("Needs update: " + target + mode)
+        if options and not should_update(options):
+            return False
+    else:
+        _logger.info("New file: " + target + mode)
+        if options and not should_create(options):
+            return False
+    if dryrun:
+        return False
+    if link:
+        _logger.debug(u'os.link(%s, %s)', source, target)
+    else:
+        _logger.debug(u'shutil.copy2(%s, %s)', source, target)
+    return True
+
+
+def do_copy_or_link(source, target, link=False):
+    """Copies or links an image file, replacing any existing target. Raises
+    OSError or IOError if that fails."""
+    if os.path.exists(target):
+        os.remove(target)
+    if link:
+        os.link(source, target)
+    else:
+        shutil.copy2(source, target)
+
+
 def copy_or_link_file(source, target, dryrun=False, link=False,
                       options=None):
     """copies or links an image file.
@@ -547,28 +587,9 @@ def copy_or_link_file(source, target, dryrun=False, link=False,
     Returns: True if the file exists.
     """
     try:
-        if link:
-            mode = " (link)"
-        else:
-            mode = " (copy)"
-        if os.path.exists(target):
-            _logger.info("Needs update: " + target + mode)
-            if options and not should_update(options):
-                return True
-            if not dryrun:
-                os.remove(target)
-        else:
-            _logger.info("New file: " + target + mode)
-            if options and not should_create(options):
-                return False
-        if dryrun:
-            return False
-        if link:
-            _logger.debug(u'os.link(%s, %s)', source, target)
-            os.link(source, target)
-        else:
-            _logger.debug(u'shutil.copy2(%s, %s)', source, target)
-            shutil.copy2(source, target)
+        if not check_copy_or_link(source, target, dryrun, link, options):
+            return os.path.exists(target) and not dryrun
+        do_copy_or_link(source, target, link)
         return True
     except (OSError, IOError) as ex:
         _logger.error(u'%s: %s' % (source, str(ex)))
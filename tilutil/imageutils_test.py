@@ -140,6 +140,18 @@ class ImageUtilsTest(unittest.TestCase):
         # Bad template
         self.assertEqual(' badfield ', iu.format_photo_name(image, 'aaaa', 5, '05', '{badfield}'))
 
+    def test_format_photo_name_skips_date(self):
+        class UndatedImage(self.TestImage):
+            def _getdate(self):
+                raise AssertionError('date should not be needed')
+            def _setdate(self, value):
+                pass
+            date = property(_getdate, _setdate)
+
+        image = UndatedImage('tttt', 'dddd')
+        image.event_name = ''
+        self.assertEqual(u'tttt', iu.format_photo_name(image, 'aaaa', 1, '1', '{title}'))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -28,6 +28,16 @@ import MacOS
 
 from Carbon.File import FSResolveAliasFile
 
+# scandir() tells files from folders without a stat() per entry. It is built
+# in from Python 3.5, and available as the scandir package before.
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
 _sysenc = sys.getfilesystemencoding()
 
 '''
@@ -105,6 +115,56 @@ def unicode_string(value):
     return unicode(value, _sysenc)
 
 
+# Strings normalized by nfc(), mapped to their normalized (and shared) value.
+_NFC_CACHE = {}
+_NFC_CACHE_SIZE = 100000
+
+# How nfc() handled the strings it was given.
+_NFC_STATS = {'ascii': 0, 'cached': 0, 'normalized': 0}
+
+
+def nfc(value):
+    """Returns a string in Unicode Normalization Form C.
+
+    ASCII strings are returned as they are. Other strings are normalized once,
+    and the same normalized string is returned for all equal values, so that
+    repeated names and path prefixes share memory.
+    """
+    try:
+        value.encode('ascii')
+        _NFC_STATS['ascii'] += 1
+        return value
+    except UnicodeError:
+        pass
+    normalized = _NFC_CACHE.get(value)
+    if normalized is not None:
+        _NFC_STATS['cached'] += 1
+        return normalized
+    _NFC_STATS['normalized'] += 1
+    if len(_NFC_CACHE) >= _NFC_CACHE_SIZE:
+        _NFC_CACHE.clear()
+    normalized = unicodedata.normalize("NFC", value)
+    normalized = _NFC_CACHE.setdefault(normalized, normalized)
+    _NFC_CACHE[value] = normalized
+    return normalized
+
+
+def get_nfc_stats():
+    """Returns how many strings nfc() passed as ASCII, found in its cache, or
+    had to normalize."""
+    return dict(_NFC_STATS)
+
+
+def get_object_size(obj):
+    """Returns the size in bytes of an object, including its attribute
+    dictionary if it has one (objects with __slots__ have none), but not the
+    objects it refers to."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
 # FileUtil --------------------------------------------------------------------
 
 def os_listdir_unicode(folder):
@@ -112,12 +172,43 @@ def os_listdir_unicode(folder):
     # passing a unicode directory name gives back unicode filenames, passing a
     # str directory name gives back str filenames. On MacOS, filenames come back
     # in Unicode Normalization Form D, so force to form C.
-    file_list = [unicodedata.normalize("NFC", nfd)
-                 for nfd in os.listdir(unicode(folder))]
+    file_list = [nfc(nfd) for nfd in os.listdir(unicode(folder))]
     file_list.sort()
     return file_list
 
 
+def scan_folder(folder):
+    """Lists a folder, like os_listdir_unicode(), and tells which entries are
+    folders.
+
+    Returns: sorted list of (name, is_folder), with the names in Unicode
+        Normalization Form C.
+    """
+    folder = unicode_string(folder)
+    if _scandir is not None:
+        entries = [(nfc(_decode_name(entry.name)), entry.is_dir())
+                   for entry in _scandir(folder)]
+    else:
+        entries = []
+        for name in os.listdir(folder):
+            if isinstance(name, str):
+                path = os.path.join(fsenc(folder), name)
+            else:
+                path = os.path.join(folder, name)
+            entries.append((nfc(_decode_name(name)), os.path.isdir(path)))
+    entries.sort()
+    return entries
+
+
+def _decode_name(name):
+    """Returns a file name as Unicode. Listing a folder gives the names that
+    the file system encoding cannot decode as str; MacOS file names are
+    UTF-8."""
+    if isinstance(name, str):
+        return name.decode('utf-8', 'replace')
+    return name
+
+
 def fsenc(value):
     '''Helper to encode a string using the system encoding'''
     if not value:
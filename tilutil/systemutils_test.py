@@ -14,6 +14,9 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import tilutil.systemutils as su
@@ -26,5 +29,38 @@ class SystemUtilsTest(unittest.TestCase):
         self.assertEquals("/usr", su.resolve_alias("/usr"))
         self.assertEquals("/private/tmp", su.resolve_alias("/tmp"))
 
+    def test_nfc(self):
+        """Tests systemutils.nfc."""
+        ascii_name = u'IMG_0001.JPG'
+        self.assertTrue(su.nfc(ascii_name) is ascii_name)
+
+        stats = su.get_nfc_stats()
+        normalized = su.nfc(u'Cafe\u0301')
+        self.assertEquals(u'Caf\xe9', normalized)
+        self.assertTrue(su.nfc(u'Cafe\u0301') is normalized)
+        self.assertTrue(su.nfc(u'Caf\xe9') is normalized)
+        new_stats = su.get_nfc_stats()
+        self.assertEquals(stats['normalized'] + 1, new_stats['normalized'])
+        self.assertEquals(stats['cached'] + 2, new_stats['cached'])
+
+    def test_scan_folder(self):
+        """Tests systemutils.scan_folder, with and without scandir."""
+        folder = tempfile.mkdtemp()
+        try:
+            # Names as the file system has them, whatever the locale.
+            os.mkdir(os.path.join(folder, 'b'))
+            for name in (u'c.jpg', u'Cafe\u0301.jpg'):
+                open(os.path.join(folder, name.encode('utf-8')), 'w').close()
+            expected = [(u'Caf\xe9.jpg', False), (u'b', True), (u'c.jpg', False)]
+            self.assertEquals(expected, su.scan_folder(folder))
+            scandir = su._scandir
+            su._scandir = None
+            try:
+                self.assertEquals(expected, su.scan_folder(folder))
+            finally:
+                su._scandir = scandir
+        finally:
+            shutil.rmtree(folder)
+
 if __name__ == '__main__':
     unittest.main()